@@ -2,7 +2,7 @@
 
 ## Written by ATUL to work on IR-based phased siRNAs
 
-import os,sys,operator,time,datetime,string,subprocess,difflib,math
+import os,sys,operator,time,datetime,string,subprocess,difflib,math,mmap,tempfile,sqlite3,bisect,json
 from collections import Counter
 import mysql.connector as sql
 from multiprocessing import Process, Queue, Pool
@@ -19,6 +19,7 @@ import matplotlib.font_manager as font_manager
 
 runMode     = 1                                             ## 0: Full run - find candidates, validate candidates 1: finalPairs file exists from earlier run now lib fetching, mapping, and plot files need to be generated 
                                                             ## 2: All earlier file exists, only consensusCands are new
+                                                            ## 3: Benchmark IRfinder against einverted on fastaFile - concordance and speed
 fetchMap    = 0                                             ## 0: Do not fetch or map 1: Fetch libs and map to fasta file, madatory for runMode 0 
 foldback    = 1                                             ## Boolean [0 and 1]. 1: Procedes with only those that are self foldback 0: Proceed with best match between a pait of transcripts (was default mode)
 phase       = 24
@@ -42,10 +43,12 @@ excludeLibs  = [3403,3404,3405,4599,4600,4601,4602,4604,4605,4606,4682,4593,4597
 
 ######## Developer settings ####################
 noiseAbun   = 0         ## 0: Used from the library file provided for mapping [default] | 1: fetched from server using libraries provided above i.e. same as phasiRNAs
+abunLocal   = 1         ## 1: Tag abundances looked up in batches from local store, libraries downloaded once in bulk - later runs need no server connection [default] | 0: Queried from server for every tag and library
 minNoiseLen = 18        ## Min noise length included in chart-input, consensus-input and consensusus file, ## Recommended: 18
 maxNoiseLen = 28        ## Max noise length included in chart-input, consensus-input and consensusus file, ## Recommended: 24
 minPlotLen  = 18        ## Min length considered for plotting
 maxPlotLen  = 28        ## Max length used for plotting
+chartMode   = 1         ## 0: No charts | 1: Chart (PNG) for every pair, rendered in parallel after library is processed [default] | 2: All charts in one multi-page PDF per library | 3: Only chart data as TSV, for plotting later
 gap         = 12        ## Default:12 (from emboss website)
 match       = 3         ## Default:3
 mismatch    = -4        ## Default:-4
@@ -53,6 +56,9 @@ threshold   = 100       ## Default:50
 maxRepLen   = 5000      ## Default: 2000
 server      = "raichu.ddpsc.org"             ## Server to use to fetch library information and smallRNA libraries
 numProc     = 58
+IRmethod    = 0         ## 0: einverted (EMBOSS) | 1: In-process IRfinder (banded Smith-Waterman against reverse complement), einverted then serves for validation only
+benchSeqs   = 500       ## Seqeunces from fastaFile used to benchmark IRfinder against einverted (runMode 3)
+IRchunks    = 4         ## Batches of sequences per core for parallel einverted runs, more batches balance load better
 
 ######## FUNCTIONS #############################
 def inferIRs(list_rc,header,phasSet):
@@ -66,10 +72,13 @@ def inferIRs(list_rc,header,phasSet):
     for i in rc_sort[0:5]:
         print("Sorted example",i)
     
-    ## Retain best pair
+    ## Retain best pair - greedy assignment in order of bitscore. Only transcripts in same connected component of
+    ## BLAST-RC hits affect each other, so components could be run separately, but with set lookups this is one
+    ## linear pass over sorted hits and is not worth splitting over processes
     list5           = [] ## Store assigned 5' pairs
     list3           = [] ## Store assgined 3' pairs
-    candidateList   = [] ## Store both transcripts of pair
+    candidateSet    = set() ## Store both transcripts of pair
+    candidateCount  = 0  ## Transcripts added as candidates, self foldback is counted twice
     uniqList        = [] ## Store uniq results
 
     set5        = set() ## Unique set of transcripts
@@ -93,15 +102,16 @@ def inferIRs(list_rc,header,phasSet):
         set3.add(trans3)
         acount+=1
 
-        if (trans5 not in candidateList) and (trans3 not in candidateList) and length >= 180 and pid >= 85.00 and length >= minLen:
+        if (trans5 not in candidateSet) and (trans3 not in candidateSet) and length >= 180 and pid >= 85.00 and length >= minLen:
 
             if foldback == 1:
                 ## Give priority to only the self foldbacks, and not with others
                 if trans5 == trans3:
                     uniqList.append((trans5,trans3,pid,bitscore,hang5,hang3,match,"IR",i))
                     fh_out.write("%s\tIR\n" % ("\t".join(z for z in i)) )
-                    candidateList.append(trans5)
-                    candidateList.append(trans3)
+                    candidateSet.add(trans5)
+                    candidateSet.add(trans3)
+                    candidateCount += 2
 
                 else:
                     ## SKIP these as user is not interested in interference from other PHAS loci
@@ -110,8 +120,9 @@ def inferIRs(list_rc,header,phasSet):
             else:
                 uniqList.append((trans5,trans3,pid,bitscore,hang5,hang3,match,"IR",i))
                 fh_out.write("%s\tIR\n" % ("\t".join(z for z in i)) )
-                candidateList.append(trans5)
-                candidateList.append(trans3)
+                candidateSet.add(trans5)
+                candidateSet.add(trans3)
+                candidateCount += 2
 
         else:
             # print("either hang5 or hang 3 have a partner assigned - Better pair exists")
@@ -122,8 +133,7 @@ def inferIRs(list_rc,header,phasSet):
 
     ## Results
     allSet = set5.union(set3)           ## Total unique phased transcripts in BLAST Results
-    candidateSet = set(candidateList)   ## All transcripts that have a pair
-    print("Total phased transcripts:%s | Uniq transcripts in BLAST_RC:%s | Candidate paired Transcipts:%s | Uniq paired Transcripts:%s" % (len(phasSet),len(allSet),len(candidateList),len(candidateSet)))
+    print("Total phased transcripts:%s | Uniq transcripts in BLAST_RC:%s | Candidate paired Transcipts:%s | Uniq paired Transcripts:%s" % (len(phasSet),len(allSet),candidateCount,len(candidateSet)))
 
     return uniqList,candidateSet,allSet
 
@@ -198,18 +208,18 @@ def isoformChecker(phasSet,unassignList,pairedSet,isoDict,list_rc,header,phasLis
     ## Write results for non-IRs
     acount  = 0 ## Count if these non-IRs have some blast-result - These still could be canidate IRs, if we would have had a genome
     bcount  = 0 ## Count if these even have no BLAST-RC results - These could be canddates in which either 5' or 3' arm is not detected
+    
+    ## Index BLAST RC results by transcript, as query or subject
+    rcDict = {}
+    for ent in list_rc:
+        query = ent[0]
+        sub   = ent[1]
+        rcDict.setdefault(query,[]).append(ent)
+        if sub != query:
+            rcDict.setdefault(sub,[]).append(ent)
+
     for trans in noIsoPair:
-        blast_res = [] ### Store BLAST RC rsults for noIR
-        
-        for ent in list_rc:
-            query = ent[0]
-            sub   = ent[1]
-            if query == trans or sub == trans:
-                blast_res.append(ent)
-                
-            else:
-                # print("No BLAST results for these final unassigned (Non_IRs):%s" % (trans) ) 
-                pass
+        blast_res = rcDict.get(trans,[]) ### Store BLAST RC rsults for noIR
 
         if blast_res:
             # print(blast_res)
@@ -254,24 +264,24 @@ def isoformWriter(list_nor,isoPair,header,pairedSet):
     fh_out = open("isoformToPaired.txt", 'w')
     fh_out.write("%s\ttype\tpaired\tisoform\n" % (header))
     
+    ### Index BLAST NORMAL results by transcript, as query or subject - in order of bitscore
+    norDict = {}
+    for ent in list_nor:
+        query = ent[0]
+        sub   = ent[1]
+        if query.strip() != sub.strip(): ## It's not a self match
+            norDict.setdefault(query,[]).append(ent)
+            norDict.setdefault(sub,[]).append(ent)
+        else:
+            # print("Self match")
+            pass
+
     ### Extract BLAST NORMAL results for transcripts that are isoform to paired
     ############
     acount =    0 ## Count numer of results for isoform written, these should match number of identified isoform to piared
     for trans in isoPair:
         # print("check-0",trans)
-        blast_res = [] ### Store BLAST RC rsults for noIR
-        
-        for ent in list_nor:
-            # print("Check-1:",ent)
-            query = ent[0]
-            sub   = ent[1]
-            if query.strip() != sub.strip(): ## It's not a self match
-                if query == trans or sub == trans:
-                    # print("check-2")
-                    blast_res.append((ent))
-            else:
-                # print("Self match")
-                pass
+        blast_res = norDict.get(trans,[]) ### Store BLAST RC rsults for noIR
 
         #### Find the best paired isoform and write results
         ##########
@@ -377,13 +387,11 @@ def collapseNoIsoforms(isoDict,noIsoPair,header,summaryFile):
 
 def validateIR (clustfile,uniqList,phasList,fastaFile,header,phasSet):
 
-    ## Get clusters list
-    fh_in       = open(clustfile,'r')
-    clusters    = fh_in.read().split('>')
-    fh_in.close()
+    ## Get indexed clusters
+    clusters    = clustIndex(clustfile)
 
-    ## Get phased fasta list
-    fastaList,fastaDict = fastaReader(fastaFile)
+    ## Get indexed phased fasta
+    fastaM,faiD = cacheGenome(fastaFile)
 
     ## Prepare output file
     resfile     = 'finalPairs.txt'
@@ -394,6 +402,15 @@ def validateIR (clustfile,uniqList,phasList,fastaFile,header,phasSet):
     fh_out1     = open(clustFile,'w')
 
 
+    ## Run einverted for candidate pairs with phased loci in parallel
+    phasTrans   = set(i[2] for i in phasList)
+    IRD         = PPIRcoords(fastaM,faiD,[(pair[0],pair[1]) for pair in uniqList if pair[0] in phasTrans and pair[1] in phasTrans])
+
+    ## Index phased loci by transcript
+    phasDict    = {}
+    for i in phasList:
+        phasDict.setdefault(i[2],[]).append(i)
+
     ### Get the phasing information for pairs ###
     validList  = [] ## List that will store results of this module for further connectivity
     pairedList = [] ## List to store final IR pairs 
@@ -402,29 +419,14 @@ def validateIR (clustfile,uniqList,phasList,fastaFile,header,phasSet):
         print("\nFetching phased loci for both partners:%s-%s"% (trans5,trans3))
 
         ### Get phased entry
-        trans5Phas = []
-        trans3Phas = []
-        
         if trans5 != trans3: ## Not self foldback i.e. not true IR
-            for i in phasList:
-                name,pval,trans,start,end,strand,lib = i
-                if trans == trans5:
-                    trans5Phas.append((i))
-                    # aphasistrand = 'w'
-                elif trans == trans3:
-                    trans3Phas.append((i))
-                    # bphasistrand = 'w'
-                else:
-                    # print("No match")
-                    pass
+            trans5Phas = list(phasDict.get(trans5,[]))
+            trans3Phas = list(phasDict.get(trans3,[]))
         else: ## Self foldback, True IR
-            for i in phasList:
-                name,pval,trans,start,end,strand,lib = i
-                if trans == trans5: ## Get all phased coords for this direct IT, which might be a single entry or two entries with different phasing positions
-                    trans5Phas.append((i)) ## Same transcipt as trans5 and same as trans3 - Phased coords could be same or different
-                    trans3Phas.append((i))
-                    # aphasistrand = 'w' ## Need to catch both strands
-                    # bphasistrand = 'c'
+            ## Get all phased coords for this direct IT, which might be a single entry or two entries with different phasing positions
+            ## Same transcipt as trans5 and same as trans3 - Phased coords could be same or different
+            trans5Phas = list(phasDict.get(trans5,[]))
+            trans3Phas = list(phasDict.get(trans5,[]))
 
         # print("Matching trans5 phas:%s" % (str(len(trans5Phas))))
         # print("Matching trans3 phas:%s" % (str(len(trans3Phas))))
@@ -456,7 +458,7 @@ def validateIR (clustfile,uniqList,phasList,fastaFile,header,phasSet):
                     continue
 
                 ## Get foldback coordinates
-                IRcoords,trans5len,trans3len = getIRcoords(fastaList,trans5,trans3)
+                IRcoords,trans5len,trans3len = getIRcoords(fastaM,faiD,trans5,trans3,IRD)
                 print("+These are einverted results:%s" % (IRcoords))
                 print("+This trans5Len:%s | Trans3Len:%s" % (trans5len,trans3len))
 
@@ -567,15 +569,11 @@ def validateIR (clustfile,uniqList,phasList,fastaFile,header,phasSet):
                 validList.append((blastent,totalPhasi,len(avalidcoords),len(bvalidcoords),finalstatus))
                 fh_out.write("%s\tIR\t%s\t%s\t%s\t%s\n" % ("\t".join(z for z in blastent),totalPhasi,len(avalidcoords),len(bvalidcoords),finalstatus))
 
-                ## For further summarization of results
-                pairedSet = set(pairedList) ## All transcripts that have a pair
-                ## Identify unpaired from total phased transcripts
-                unassignList = [] ## List to store those transcripts that are missing from pair-test or didn't had unoq pair
-                for i in phasSet:
-                    if i not in pairedSet:
-                        unassignList.append(i)
-                print("Total phased transcripts:%s | Unassigned transcripts:%s" % (len(phasSet),len(unassignList)))
-
+    ## For further summarization of results
+    pairedSet = set(pairedList) ## All transcripts that have a pair
+    ## Identify unpaired from total phased transcripts
+    unassignList = [i for i in phasSet if i not in pairedSet] ## List to store those transcripts that are missing from pair-test or didn't had unoq pair
+    print("Total phased transcripts:%s | Unassigned transcripts:%s" % (len(phasSet),len(unassignList)))
 
     fh_out.close()
     fh_out1.close()
@@ -585,22 +583,37 @@ def validateIR (clustfile,uniqList,phasList,fastaFile,header,phasSet):
 
     return validList,resfile,clustFile,pairedSet,unassignList
 
-def prepareChartFiles(validList,clustFile,userLibs,fastaFile,con):
+def prepareChartFiles(validList,clustFile,userLibs,fastaFile,con=None):
     '''
     This function will prepare chart files for every pair, which will include phasiRNAs
-    and non-phased sRNAs
+    and non-phased sRNAs. If local abundance store covers the libraries, server is not connected
     '''
 
-    cur= con.cursor()
-    queryLibs,sumLibs,finalLibs = prepareQuery(excludeLibs,cur)
+    finalLibs = storeLibs(excludeLibs) if abunLocal == 1 else None
+    if finalLibs:
+        cur   = None
+        store = abunStore(cur,finalLibs)
+    else:
+        if con is None:
+            con = ConnectToDB(server)
+        cur= con.cursor()
+        queryLibs,sumLibs,finalLibs = prepareQuery(excludeLibs,cur)
+        if abunLocal == 1:
+            store = abunStore(cur,finalLibs)
+            storeLibs(excludeLibs,finalLibs)
+        else:
+            store = None
 
     print("\n #### Fn: prepareChartFiles ##################")
-    ## Get phased fasta list
-    fastaList,fastaDict = fastaReader(fastaFile)
+    ## Get indexed phased fasta
+    fastaM,faiD = cacheGenome(fastaFile)
 
     ## Fetch phased phasiRNAs from cluster file and make a dictionary with transcript name as key
     ## and phasiRNAs as values
     phasedDict = clust2Dict(clustFile)
+
+    ## Run einverted for valid pairs in parallel, once for all libraries
+    IRD = PPIRcoords(fastaM,faiD,[(pair[0][0],pair[0][1]) for pair in validList if pair[-1] == 'IR'])
     
     ## Fetch sRNA dict for specified library
     for lib in userLibs:
@@ -625,6 +638,7 @@ def prepareChartFiles(validList,clustFile,userLibs,fastaFile,con):
 
         ## Start the process of making a trans5cluster and trans3cluster list
         processedSet = set()
+        chartL       = [] ## Charts are rendered after all pairs of library are processed
         
         for pair in validList:
             # print("\nPAIR:",pair)
@@ -636,12 +650,12 @@ def prepareChartFiles(validList,clustFile,userLibs,fastaFile,con):
                 if akey not in processedSet:
                     processedSet.add(akey)
                     print("\n+IR pair:%s-%s | status:%s being processed" % (trans5,trans3,astatus))
-                    atransclust = mergeRNAs(trans5,sRNADict,phasedDict,fastaDict,cur,finalLibs)
-                    btransclust = mergeRNAs(trans3,sRNADict,phasedDict,fastaDict,cur,finalLibs)
+                    atransclust = mergeRNAs(trans5,sRNADict,phasedDict,fastaM,faiD,cur,finalLibs,store)
+                    btransclust = mergeRNAs(trans3,sRNADict,phasedDict,fastaM,faiD,cur,finalLibs,store)
 
                     ## Get IR coords ####################################################
                     #####################################################################
-                    IRcoords,trans5len,trans3len = getIRcoords(fastaList,trans5,trans3)
+                    IRcoords,trans5len,trans3len = getIRcoords(fastaM,faiD,trans5,trans3,IRD)
                     print ("+These are einverted results:%s" % (IRcoords))
                     
                     ## Convert coordinates to IR transcript ############################
@@ -741,7 +755,7 @@ def prepareChartFiles(validList,clustFile,userLibs,fastaFile,con):
                         fh_out.write("%s\t%s\t%s\n" % (combName,'\t'.join(str(x) for x in phasi),phasiarm)) ## combname,phasiname,phasistrand,phasiabun,phasiseq,phasilen,phasihits,phasiflag,phasipos.phasiarm
 
                     ### Prepare abundance chart for this pair
-                    chart(trans5,trans3,anormclust,bnormclust,IRcoords)
+                    chartL.append((trans5,trans3,anormclust,bnormclust,IRcoords))
 
 
                     ## Write results that are normalized to align different IRs together
@@ -762,8 +776,13 @@ def prepareChartFiles(validList,clustFile,userLibs,fastaFile,con):
                     # print("## chart input files will have just one entry with phasiRNAs from all PHAS in PHAS list")
                     pass
 
+        ## Abundance charts for pairs of this library
+        chartWriter(chartL,lib)
+
     fh_out.close()
     fh_out2.close()
+    if store is not None:
+        store.close()
 
     return chartInput,consensusInput
 
@@ -1028,147 +1047,154 @@ def inferDirection(aconsensusclust,bconsensusclust,aflag,bflag):
 
     return resL
 
-def chart(trans5,trans3,anormclust,bnormclust,IRcoords):
+def chartWriter(chartL,lib):
+    '''
+    Renders abundance charts for pairs of a library as per chartMode - PNG for every pair in parallel, all pairs 
+    in one multi-page PDF, or only the plotted data as TSV
+    '''
+
+    print("\nFn: chartWriter")
+    if not chartL or chartMode == 0:
+        print("+Charts skipped for library:%s" % (lib))
+        return None
+
+    if chartMode == 1:
+        PPChart(chartL)
+        print("+Charts for %s pairs ready" % (len(chartL)))
+
+    elif chartMode == 2:
+        from matplotlib.backends.backend_pdf import PdfPages
+        pdfFile = "%s.charts.pdf" % (lib)
+        pdf     = PdfPages(pdfFile)
+        for ent in chartL:
+            chart(*ent,pdf=pdf)
+        pdf.close()
+        print("+Charts for %s pairs written to:%s" % (len(chartL),pdfFile))
+
+    elif chartMode == 3:
+        dataFile = "%s.chart.data.txt" % (lib)
+        fh_out  = open(dataFile,'w')
+        fh_out.write("pairname\tarm\tarmLen\tphasipos\tlog2abun\tphasilen\tphasiflag\n")
+        for ent in chartL:
+            cdata = chartData(*ent)
+            for arm in ("5","3"):
+                for phasipos,phasiabun,phasilen,phasiflag in cdata[arm]["points"]:
+                    fh_out.write("%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (cdata["name"],arm,cdata[arm]["armLen"],phasipos,phasiabun,phasilen,phasiflag))
+        fh_out.close()
+        print("+Chart data for %s pairs written to:%s" % (len(chartL),dataFile))
+
+    else:
+        print("Wrong chartMode selected - check settings, script will exit")
+        sys.exit()
+
+    return None
+
+def PPChart(chartL):
+    '''
+    Renders charts across cores, pairs are sent to workers in batches and each worker reuses one figure
+    '''
+
+    achunk  = max(1,math.ceil(len(chartL)/(nproc*IRchunks)))
+    batchL  = [chartL[x:x+achunk] for x in range(0,len(chartL),achunk)]
+    npool   = Pool(min(nproc,len(batchL)))
+    npool.map(chartWorker,batchL)
+    npool.close()
+    npool.join()
+
+    return None
+
+def chartWorker(batch):
+    '''
+    Renders a batch of charts
+    '''
+    for ent in batch:
+        chart(*ent)
+
+    return len(batch)
+
+chartFig    = None  ## Figure and axes reused for every chart by a process
+chartAx     = None
+
+def chartFigure():
     '''
-    This prepares line plot for pair
+    Returns the figure and cleared axes of this process, created on first use
     '''
+    global chartFig,chartAx
+    if chartFig is None:
+        chartFig    = plt.figure()
+        chartAx     = chartFig.add_subplot(111)
+    else:
+        chartAx.clear()
 
-    print("\nFn: Chart")
+    return chartFig,chartAx
+
+def chartData(trans5,trans3,anormclust,bnormclust,IRcoords):
+    '''
+    Prepares positions and log2 abundances to plot for both arms, 3' arm abundances are negative
+    '''
 
     ## Foldback coords
     start1      = int(IRcoords[0][6])
     end1        = int(IRcoords[0][7])
     start2      = int(IRcoords[0][8])
     end2        = int(IRcoords[0][9])
-    aarmLen     = end1-start1+1
-    barmLen     = end2-start2+1
-    
-    ## Prepare #####
-    plotFile        = "%s-%s" % (trans5,trans3) 
-    anormclust_s    = sorted(anormclust,key=lambda x: float(x[7]),reverse=False)
-    bnormclust_s    = sorted(bnormclust,key=lambda x: float(x[7]),reverse=False)
-    ### Prepare abundance and positions list for A
-    #############################################
-    print("Prepare list for 'A' for plotting")
-    a21x = [] ## Record size specific positions
-    a22x = []
-    a23x = []
-    a24x = []
-    aOthersx = [] ## Other sizes in allowed in plotLen
-    a21y = [] ## Record size specific abundances
-    a22y = []
-    a23y = []
-    a24y = []
-    aOthersy = [] ## Other sizes in allowed in plotLen
-    aALLx = [] ## Collect psoitions for all sizes (sorted)
-    aALLy = [] ## Collect abundances for all sizes (sorted on position)
-    aphasposS  = set() ### Records all phased psoition to define x-axis
-    for aphasi in anormclust_s:
-        print("Ent",aphasi)
-        phasipos    = int(aphasi[7])
-        phasiabun   = round(math.log(int(aphasi[2]),2),2)
-        phasilen    = int(aphasi[4])
-        phasiflag   = aphasi[6]
-        # print("Phasi Abundance:%s" % (phasiabun))
-        if phasiflag == "P": ## Record the psoition to define x-axis
-            aphasposS.add(phasipos)
-
-        aALLx.append(phasipos)
-        aALLy.append(phasiabun)
-
-        if phasilen     == 21:
-            a21x.append(phasipos)
-            a21y.append(phasiabun)
-        elif phasilen   == 22:
-            a22x.append(phasipos)
-            a22y.append(phasiabun)
-        elif phasilen   == 23:
-            a23x.append(phasipos)
-            a23y.append(phasiabun)
-        elif phasilen   == 24:
-            a24x.append(phasipos)
-            a24y.append(phasiabun)
-        elif phasilen >= minPlotLen and phasilen <= maxPlotLen:
-            aOthersx.append(phasipos)
-            aOthersy.append(phasiabun)
-        else:
-            print("The sRNA length not allowed for plotting - will be trashed")
-            pass
-    print("Length of 21 list:%s | 22 list:%s | 23 list:%s | 24 list:%s" % (len(a21x),len(a22y),len(a23x),len(a24x)))
-    # print("phased positions on A:",aphasposS)
-
-
-    ### Prepare abudnace and positions list for B
-    ###############################################
-    print("Prepare list for 'B' for plotting")
-    b21x = []
-    b22x = []
-    b23x = []
-    b24x = []
-    bOthersx = [] ## Other sizes in allowed in plotLen
-    b21y = []
-    b22y = []
-    b23y = []
-    b24y = []
-    bOthersy = [] ## Other sizes in allowed in plotLen
-    bALLx = [] ## Collect psoitions for all sizes (sorted)
-    bALLy = [] ## Collect abundances for all sizes (sorted on position)
-    bphasposS  = set() ### Records all phased psoition to define x-axis
-    for bphasi in bnormclust_s:
-        # print("Ent",bphasi)
-        phasipos    = int(bphasi[7])
-        phasiabun   = round(-1*(math.log(int(bphasi[2]),2)),2)
-        phasilen    = int(bphasi[4])
-        phasiflag   = bphasi[6]
-        # print("Phasi Abundance:%s" % (phasiabun))
-        if phasiflag == "P": ## Record the psoition to define x-axis
-            bphasposS.add(phasipos)
-            # maxabunS
-        
-        bALLx.append(phasipos)
-        bALLy.append(phasiabun)
-
-        if phasilen     == 21:
-            b21x.append(phasipos)
-            b21y.append(phasiabun)
-        elif phasilen   == 22:
-            b22x.append(phasipos)
-            b22y.append(phasiabun)
-        elif phasilen   == 23:
-            b23x.append(phasipos)
-            b23y.append(phasiabun)
-        elif phasilen   == 24:
-            b24x.append(phasipos)
-            b24y.append(phasiabun)
-        elif phasilen >= minPlotLen and phasilen <= maxPlotLen:
-            bOthersx.append(phasipos)
-            bOthersy.append(phasiabun)
-        else:
-            print("The sRNA length not allowed for plotting - will be trashed")
-            pass
-    print("Length of 21 list:%s | 22 list:%s | 23 list:%s | 24 list:%s" % (len(b21x),len(b22y),len(b23x),len(b24x)))
-    # print("phased positions on B:",bphasposS)
 
+    cdata       = {"name":"%s-%s" % (trans5,trans3)}
+    for arm,normclust,asign,armLen in (("5",anormclust,1,end1-start1+1),("3",bnormclust,-1,end2-start2+1)):
+        normclust_s = sorted(normclust,key=lambda x: float(x[7]),reverse=False)
+        sizeD       = dict((x,([],[])) for x in (21,22,23,24,"others")) ## Size specific positions and abundances
+        allx        = [] ## Collect positions for all sizes (sorted)
+        ally        = [] ## Collect abundances for all sizes (sorted on position)
+        phasposS    = set() ### Records all phased position to define x-axis
+        points      = []
+        for aphasi in normclust_s:
+            phasipos    = int(aphasi[7])
+            phasiabun   = round(asign*(math.log(int(aphasi[2]),2)),2)
+            phasilen    = int(aphasi[4])
+            phasiflag   = aphasi[6]
+            if phasiflag == "P": ## Record the position to define x-axis
+                phasposS.add(phasipos)
+
+            allx.append(phasipos)
+            ally.append(phasiabun)
+
+            if phasilen in sizeD:
+                akey = phasilen
+            elif phasilen >= minPlotLen and phasilen <= maxPlotLen:
+                akey = "others"
+            else:
+                # print("The sRNA length not allowed for plotting - will be trashed")
+                continue
+            sizeD[akey][0].append(phasipos)
+            sizeD[akey][1].append(phasiabun)
+            points.append((phasipos,phasiabun,phasilen,phasiflag))
+
+        cdata[arm]  = {"sizes":sizeD,"allx":allx,"ally":ally,"phaspos":phasposS,"armLen":armLen,"points":points}
 
+    return cdata
 
-    #### Prepare chart ###############
-    ##################################
+def chart(trans5,trans3,anormclust,bnormclust,IRcoords,pdf=None):
+    '''
+    This prepares line plot for pair, saved as PNG or as a page of pdf if provided
+    '''
 
-    a21 = plt.scatter(a21x, a21y, s=[n**2 for n in a21y], c='#27408B', lw = 0, alpha=0.5)
-    a22 = plt.scatter(a22x, a22y, s=[n**2 for n in a22y], c='#2E8B57', lw = 0, alpha=0.5)
-    a23 = plt.scatter(a23x, a23y, s=[n**2 for n in a23y], c='#7D26CD', lw = 0, alpha=0.5)
-    a24 = plt.scatter(a24x, a24y, s=[n**2 for n in a24y], c='#EE9A00', lw = 0, alpha=0.5)
-    aOthers = plt.scatter(aOthersx, aOthersy, s=[n**2 for n in aOthersy], c='#383838', lw = 0, alpha=0.5)
-    aAll = plt.plot(aALLx,aALLy, c='#828282', lw = 0.5)
+    # print("\nFn: Chart")
+    cdata           = chartData(trans5,trans3,anormclust,bnormclust,IRcoords)
+    plotFile        = cdata["name"]
+    fig,ax          = chartFigure()
 
-    b21 = plt.scatter(b21x, b21y, s=[n**2 for n in b21y], c='#27408B', lw = 0, alpha=0.5) ### Size values need not be in negative like y-axis
-    b22 = plt.scatter(b22x, b22y, s=[n**2 for n in b22y], c='#2E8B57', lw = 0, alpha=0.5)
-    b23 = plt.scatter(b23x, b23y, s=[n**2 for n in b23y], c='#7D26CD', lw = 0, alpha=0.5)
-    b24 = plt.scatter(b24x, b24y, s=[n**2 for n in b24y], c='#EE9A00', lw = 0, alpha=0.5)
-    bOthers = plt.scatter(bOthersx, bOthersy, s=[n**2 for n in bOthersy], c='#383838', lw = 0, alpha=0.5)
-    bAll = plt.plot(bALLx,bALLy, c='#828282', lw = 0.5)
+    #### Prepare chart ###############
+    ##################################
+    colors = {21:'#27408B',22:'#2E8B57',23:'#7D26CD',24:'#EE9A00',"others":'#383838'}
+    for arm in ("5","3"):
+        for akey in (21,22,23,24,"others"):
+            x,y = cdata[arm]["sizes"][akey]
+            ax.scatter(x, y, s=[n**2 for n in y], c=colors[akey], lw = 0, alpha=0.5) ### Size values need not be in negative like y-axis
+        ax.plot(cdata[arm]["allx"],cdata[arm]["ally"], c='#828282', lw = 0.5)
 
     ##### Add phasing lines #############
+    aphasposS   = cdata["5"]["phaspos"]
+    bphasposS   = cdata["3"]["phaspos"]
     aphasmin    = min(aphasposS)
     aphasmax    = max(aphasposS)
     aphasx_marker = list(np.arange(aphasmin,aphasmax+phase,step=phase)) ## Phased position from first till last phase, plus an extra marker added
@@ -1176,26 +1202,27 @@ def chart(trans5,trans3,anormclust,bnormclust,IRcoords):
     bphasmax    = max(bphasposS)
     bphasx_marker = list(np.arange(bphasmin,bphasmax+phase,step=phase)) ## Phased position from first till last phase, plus an extra marker added
 
-    aphasy_marker = [max(aALLy)]*len(aphasx_marker) ## Most abundant value on y-axis multipled the times of x marker to get list of same size as aphasx_marker
-    bphasy_marker = [min(bALLy)]*len(bphasx_marker) ## Most abundant value on y-axis multipled the times of x marker to get list of same size as bphasx_marker
+    aphasy_marker = [max(cdata["5"]["ally"])]*len(aphasx_marker) ## Most abundant value on y-axis multipled the times of x marker to get list of same size as aphasx_marker
+    bphasy_marker = [min(cdata["3"]["ally"])]*len(bphasx_marker) ## Most abundant value on y-axis multipled the times of x marker to get list of same size as bphasx_marker
 
     for i,j in zip(aphasx_marker,aphasy_marker):
-        # plt.axvline(i,linewidth=0.5, color='#454545')
-        plt.plot((i,i),(0,j),linewidth=0.3, color='#454545',linestyle='--') ## plt.plot((x1, x2), (y1, y2), 'k-')
+        ax.plot((i,i),(0,j),linewidth=0.3, color='#454545',linestyle='--') ## plt.plot((x1, x2), (y1, y2), 'k-')
     for x,y in zip(bphasx_marker,bphasy_marker):
-        plt.plot((x,x),(0,y),linewidth=0.2, color='#454545',linestyle='--') ## plt.plot((x1, x2), (y1, y2), 'k-')
-
+        ax.plot((x,x),(0,y),linewidth=0.2, color='#454545',linestyle='--') ## plt.plot((x1, x2), (y1, y2), 'k-')
 
-    atitle      = "%s-%s" % (trans5,trans3) 
-    plt.axhline(linewidth=0.5, color='#454545')
-    plt.ylabel('Abundance', fontproperties=font_manager.FontProperties(size=8))
-    plt.xlabel('Fold-back normalized positions [phas-lines computed on first phasiRNA - for indicative purpose only]', fontproperties=font_manager.FontProperties(size=7))
-    plt.title("First phase: %s(5') - %s(3') | Last phase: %s(5') - %s(3') | Total phase: %s(5') - %s(3') | Arm Length: %s(5') - %s(3')" % (aphasmin,bphasmin,aphasmax,bphasmax,len(aphasx_marker)-1,len(bphasx_marker)-1,aarmLen,barmLen),fontproperties=font_manager.FontProperties(size=7)) ## In figures 1 or 2 phases might be extra, these are noise sRNAs showing up in phass
+    aarmLen     = cdata["5"]["armLen"]
+    barmLen     = cdata["3"]["armLen"]
+    ax.axhline(linewidth=0.5, color='#454545')
+    ax.set_ylabel('Abundance', fontproperties=font_manager.FontProperties(size=8))
+    ax.set_xlabel('Fold-back normalized positions [phas-lines computed on first phasiRNA - for indicative purpose only]', fontproperties=font_manager.FontProperties(size=7))
+    ax.set_title("First phase: %s(5') - %s(3') | Last phase: %s(5') - %s(3') | Total phase: %s(5') - %s(3') | Arm Length: %s(5') - %s(3')" % (aphasmin,bphasmin,aphasmax,bphasmax,len(aphasx_marker)-1,len(bphasx_marker)-1,aarmLen,barmLen),fontproperties=font_manager.FontProperties(size=7)) ## In figures 1 or 2 phases might be extra, these are noise sRNAs showing up in phass
 
-    plt.savefig(plotFile, format=None , facecolor='w', edgecolor='w', orientation='portrait', papertype=None,  transparent=False, bbox_inches=None, pad_inches=0)
-    plt.clf() ## Clear figure so that next plot is different file
+    if pdf is not None:
+        pdf.savefig(fig)
+    else:
+        fig.savefig(plotFile, format=None , facecolor='w', edgecolor='w', orientation='portrait', transparent=False, bbox_inches=None, pad_inches=0)
 
-    print("\nFn: Exiting Chart")
+    # print("\nFn: Exiting Chart")
 
     return None
 
@@ -1261,12 +1288,17 @@ def isoformsDict(list_nor,phasSet,unassignList):
     ''' This function identifies phased transcripts that are isoforms of other phased transcripts
     and provide a non-redundant set of phased transcripts'''
 
+    ### Index BLAST results by query
+    norDict = {}
+    for ent in list_nor:
+        norDict.setdefault(ent[0].strip(),[]).append(ent)
+
     ### Make dictionary of isoforms
     isoDict = {}
     for trans in phasSet:
         # print("\nCaching isoforms for:%s" % (trans))
         isoforms = [] ### List to store trans wise isoforms
-        for ent in list_nor:
+        for ent in norDict.get(trans.strip(),[]):
             query   = ent[0]
             sub     = ent[1]
             pid     = float(ent[2])
@@ -1311,24 +1343,40 @@ def isoformsDict(list_nor,phasSet,unassignList):
 
     return isoDict
 
-def getIRcoords(fastaList,trans5,trans3):
+def getIRcoords(fastaM,faiD,trans5,trans3,IRD=None):
     
     '''
     This function will take pair name, fetch fasta, cat both and run inverted repeat, finally report back 
-    start1,end1,start2,end2
-    '''
-
-    ## Fetch seq for trans5 and trans3 ##
-    for aseq in fastaList:
-        name,seq,alen = aseq
-        if name == trans5:
-            trans5seq = seq
-            trans5len = alen
-        elif name == trans3:
-            trans3seq = seq
-            trans3len = alen
-        else:
-            pass
+    start1,end1,start2,end2. If IR coords were computed in batch by PPIRcoords, these are looked up from IRD
+    '''
+
+    combName,combSeq,trans5len,trans3len = pairSeq(fastaM,faiD,trans5,trans3)
+
+    if IRD is not None and combName in IRD:
+        IRcoords    = IRD[combName]
+    else:
+        ## Run inverted repaet and fetch IR coords
+        aname,IRcoords = IRworker((combName,combSeq))
+        if IRcoords is None:
+            sys.exit()
+
+    return IRcoords,trans5len,trans3len
+
+def pairSeq(fastaM,faiD,trans5,trans3):
+    '''
+    Fetches seqeunces for a pair from indexed fasta and concatanates these for einverted, in case of self
+    foldback just one transcript is used
+    '''
+
+    ## Fetch seq for trans5 and trans3 from indexed fasta ##
+    trans5seq,trans5len = '',0
+    trans3seq,trans3len = '',0
+    if trans5 in faiD:
+        trans5len = faiD[trans5][0]
+        trans5seq = fetchWindow(fastaM,faiD,trans5,1,trans5len)
+    if trans3 in faiD and trans3 != trans5:
+        trans3len = faiD[trans3][0]
+        trans3seq = fetchWindow(fastaM,faiD,trans3,1,trans3len)
     
 
     # print("+trans5:%s | len:%s" % (trans5,trans5len))
@@ -1354,11 +1402,67 @@ def getIRcoords(fastaList,trans5,trans3):
             print("No seqeunces found self foldback trans5:%s" % (trans5))
             sys.exit()
 
-    ## Run inverted repaet and fetch IR coords
-    outseq,outinv   = IRchecker(combSeq,combName)
-    IRcoords        = IRparser(outseq,outinv,combName)
+    return combName,combSeq,trans5len,trans3len
 
-    return IRcoords,trans5len,trans3len
+def PPIRcoords(fastaM,faiD,pairs):
+    '''
+    Runs einverted for all uniq pairs in parallel before these are validated or charted, pairs with missing
+    seqeunces are left to getIRcoords. Returns dict with combName as key and IRcoords as value
+    '''
+
+    print("\nFUNCTION - PPIRcoords")
+    seqL    = []
+    seqset  = set()
+    for trans5,trans3 in pairs:
+        if trans5 not in faiD or trans3 not in faiD:
+            continue
+        combName = trans5 if trans5 == trans3 else "%s-%s" % (trans5,trans3)
+        if combName not in seqset:
+            seqset.add(combName)
+            combName,combSeq,trans5len,trans3len = pairSeq(fastaM,faiD,trans5,trans3)
+            seqL.append((combName,combSeq))
+
+    IRD = PPIR(seqL)
+    print("+IR coords computed for %s uniq pairs" % (len(IRD)))
+
+    return IRD
+
+def clustIndex(clustFile):
+    '''
+    Indexes clusters file once - cluster coordinates are parsed from headers and recorded by transcript (chr_id), sorted on start,
+    along with offsets of cluster in memory-mapped file. phasiRNA lines are read by getPhase only for matched clusters
+    '''
+
+    print("\nFUNCTION - clustIndex")
+    fh_in       = open(clustFile,'rb')
+    clustM      = mmap.mmap(fh_in.fileno(),0,access=mmap.ACCESS_READ)
+    fh_in.close()
+
+    tempD       = {}    ## chr_id as key and clusters as value
+    acount      = 0     ## Clusters in file, also the order of cluster in file
+    bstart      = clustM.find(b'>')
+    while bstart != -1:
+        bend    = clustM.find(b'>',bstart+1)
+        hend    = clustM.find(b'\n',bstart+1)
+        if hend == -1 or (bend != -1 and hend > bend):
+            hend = bend if bend != -1 else len(clustM)
+        header  = clustM[bstart+1:hend].decode().split()
+        clust_id= header[2]
+        chr_id  = header[6].replace("chr","").replace("Chr","")
+        start   = int(header[10])
+        end     = int(header[12])
+        tempD.setdefault(chr_id,[]).append((start,end,clust_id,acount,bstart+1,bend if bend != -1 else len(clustM)))
+        acount += 1
+        bstart  = bend
+
+    clustD      = {}    ## chr_id as key and (starts,clusters,longest cluster) as value
+    for chr_id,aclusts in tempD.items():
+        aclusts.sort()
+        clustD[chr_id] = ([x[0] for x in aclusts],aclusts,max(x[1]-x[0] for x in aclusts))
+
+    print("+Clusters indexed:%s | Transcripts:%s" % (acount,len(clustD)))
+
+    return clustM,clustD
 
 def getPhase(aphas,clusters):
 
@@ -1385,7 +1489,7 @@ def getPhase(aphas,clusters):
                                                             
                                                                             
     phasID,pval,get_chr_id,get_start,get_end,trash,get_lib = aphas                        ## Given an entry in coords file
-    get_value  = (list(range(int(str(get_start)),int(str(get_end)))))
+    get_start,get_end = int(str(get_start)),int(str(get_end))
     # print("This is the PhasId: %s | values:%s" % (phasID,get_value))
     print("+PhaseID being queried:%s ##############" % (phasID))
     phasCount +=1 
@@ -1397,88 +1501,91 @@ def getPhase(aphas,clusters):
     # finalMatchList  = []       ## Holds best cluster, from multiple libraries
     finalMatchList  = []       ## Holds cluster for given PHAS locus, only one cluster is expected since we are checking for same transcript, start and stop
     tempAllList     = []     ## Hold phasiRNAs from all matching clusters, of use for phased transcripts to capture allphasiRNAs, must be used with low matchThres
-    for aclust in clusters[1:]:
+    ## Clusters of same transcript that could match - with a non-zero threshold only overlapping clusters can match, these
+    ## start after (start of PHAS - longest cluster) and before end of PHAS. Candidates are checked in order of file
+    clustM,clustD   = clusters
+    candL           = []
+    if get_chr_id in clustD:
+        starts,aclusts,maxlen = clustD[get_chr_id]
+        if matchThres > 0:
+            candL = aclusts[bisect.bisect_right(starts,get_start-maxlen):bisect.bisect_left(starts,get_end)]
+        else:
+            candL = aclusts
+        candL = sorted(candL,key=operator.itemgetter(3))
+
+    for start,end,clust_id,aorder,bstart,bend in candL:
         tempMatchList   = [] ## To hold results of current matching cluster
-        aclust_splt     = aclust.split('\n')
-        header          = aclust_splt[0].split()
-        clust_id        = header[2]
-        chr_id          = header[6].replace("chr","").replace("Chr","")
-        start           = header[10]
-        end             = header[12] ##1 added because when opening a range using start and end, end number is not included in range
-        value           = (list(range(int(str(start)),int(str(end)))))
-
-        if get_chr_id == chr_id: ## Only chr_id i.e. transcript is checked to increase speed
-            sm=difflib.SequenceMatcher(None,get_value,value) ## The rratio corresponds to larger loci i.e. match/length of longer nucleotides
-            # print("Get Value:",get_value)
-            # print("Current value",value)
-            aratio  = round(sm.ratio(),2)
-            # print("Ratio:%s" % (aratio))
+
+        ## Ratio of ranges as difflib.SequenceMatcher would give i.e. 2*overlap/(sum of lengths), computed arithmetically
+        alen    = max(0,get_end-get_start)
+        blen    = max(0,end-start)
+        overlap = max(0,min(get_end,end)-max(get_start,start)) if alen and blen else 0
+        aratio  = 2.0*overlap/(alen+blen) if alen+blen else 1.0
+        # print("Ratio:%s" % (aratio))
+        
+        if round(aratio,2) >= matchThres:
+            aclust_splt     = clustM[bstart:bend].decode().split('\n') ## phasiRNA lines read only for matched cluster
+            ### Matched - phasiRNA from this cluster
+            # print ('\nMatching cluster found:%s' % ''.join(header))
+            # print("Allowed Ratio:%s | Current Ratio:%s" % (matchThres,aratio))
+            matchCount +=1
+
+            phasiCyc = 0 ## Stores phasing cycles
+            phasiSig = 0 ## Stores total abundance of phased sRNAs
             
-            if round(sm.ratio(),2) >= matchThres:
-                ### Matched - phasiRNA from this cluster
-                # print ('\nMatching cluster found:%s' % ''.join(header))
-                # print("Allowed Ratio:%s | Current Ratio:%s" % (matchThres,aratio))
-                matchCount +=1
-
-                phasiCyc = 0 ## Stores phasing cycles
-                phasiSig = 0 ## Stores total abundance of phased sRNAs
-                
-                for i in aclust_splt[1:-1]:## Because header was the first entry of block and not required here, Last entry is always empty
-                    # print ("Matched Cluster:\n",i)
-                    phasient    = i.split('\t')
-                    phasiname   = phasient[4].replace("|","_")
-                    phasiseq    = phasient[5]
-                    phasilen    = int(phasient[6])
-                    phasiabun   = int(phasient[7])
-                    phasihits   = int(phasient[10].split("=")[1])
-                    phasipos    = int(phasient[3])
-                    phasistrand = str(phasient[2]).translate(str.maketrans("+-","wc"))
-                    phasipval   = phasient[12]
-                    # print(phasistrand)
-
-                    # print("+phasiRNAs: %s,%s,%s,%s,%s,%s,%s"% (phasiname,phasistrand,phasiabun,phasiseq,phasilen,phasihits,phasipos))
-                    tempMatchList.append((phasiname,phasistrand,phasiabun,phasiseq,phasilen,phasihits,phasipos))
-                    tempAllList.append((phasiname,phasistrand,phasiabun,phasiseq,phasilen,phasihits,phasipos)) ## Records all phasiRNAs from all clusters
-                    # sys.exit()
+            for i in aclust_splt[1:-1]:## Because header was the first entry of block and not required here, Last entry is always empty
+                # print ("Matched Cluster:\n",i)
+                phasient    = i.split('\t')
+                phasiname   = phasient[4].replace("|","_")
+                phasiseq    = phasient[5]
+                phasilen    = int(phasient[6])
+                phasiabun   = int(phasient[7])
+                phasihits   = int(phasient[10].split("=")[1])
+                phasipos    = int(phasient[3])
+                phasistrand = str(phasient[2]).translate(str.maketrans("+-","wc"))
+                phasipval   = phasient[12]
+                # print(phasistrand)
+
+                # print("+phasiRNAs: %s,%s,%s,%s,%s,%s,%s"% (phasiname,phasistrand,phasiabun,phasiseq,phasilen,phasihits,phasipos))
+                tempMatchList.append((phasiname,phasistrand,phasiabun,phasiseq,phasilen,phasihits,phasipos))
+                tempAllList.append((phasiname,phasistrand,phasiabun,phasiseq,phasilen,phasihits,phasipos)) ## Records all phasiRNAs from all clusters
+                # sys.exit()
 
-                    if int(phasilen) == phase:
-                        phasiCyc +=1
-                        phasiSig += phasiabun
-                    
-                # print("Current Cycles:%s | Current sig. strength:%s" % (phasiCyc,phasiSig))
-                tempMatchList.append((phasiCyc,phasiSig,phasID,clust_id))
-
-                ## Decide the best and remove other from list ##############################
-                ############################################################################
-                if finalMatchList:
-                    ## There exists a previosly matched cluster
-                    exist_phasiCyc = finalMatchList[-1][0]
-                    exist_phasiSig = finalMatchList[-1][1]
-                    # print("Existing Cycles:%s | Existing sig. strength:%s" % (exist_phasiCyc,exist_phasiSig))
-
-                    if phasiCyc > exist_phasiCyc: ## New cluster has more cycles
+                if int(phasilen) == phase:
+                    phasiCyc +=1
+                    phasiSig += phasiabun
+                
+            # print("Current Cycles:%s | Current sig. strength:%s" % (phasiCyc,phasiSig))
+            tempMatchList.append((phasiCyc,phasiSig,phasID,clust_id))
+
+            ## Decide the best and remove other from list ##############################
+            ############################################################################
+            if finalMatchList:
+                ## There exists a previosly matched cluster
+                exist_phasiCyc = finalMatchList[-1][0]
+                exist_phasiSig = finalMatchList[-1][1]
+                # print("Existing Cycles:%s | Existing sig. strength:%s" % (exist_phasiCyc,exist_phasiSig))
+
+                if phasiCyc > exist_phasiCyc: ## New cluster has more cycles
+                    del finalMatchList[0:]
+                    finalMatchList = list(tempMatchList)
+                    # print("--- New cluster selected ---")
+
+                elif phasiCyc == exist_phasiCyc: ## Both have same cycles
+                    if phasiSig > exist_phasiSig: ## New one has more total abundance of phased siRNAs
                         del finalMatchList[0:]
                         finalMatchList = list(tempMatchList)
                         # print("--- New cluster selected ---")
+                
+                else: ## Existing/old one was long i.e. had more cycles
+                    # print("Earlier recorded cluster is retained")
+                    pass
 
-                    elif phasiCyc == exist_phasiCyc: ## Both have same cycles
-                        if phasiSig > exist_phasiSig: ## New one has more total abundance of phased siRNAs
-                            del finalMatchList[0:]
-                            finalMatchList = list(tempMatchList)
-                            # print("--- New cluster selected ---")
-                    
-                    else: ## Existing/old one was long i.e. had more cycles
-                        # print("Earlier recorded cluster is retained")
-                        pass
-
-                else: ## This is the first cluster
-                    finalMatchList  = list(tempMatchList)
-                    allphasiList    = list(tempMatchList) 
+            else: ## This is the first cluster
+                finalMatchList  = list(tempMatchList)
+                allphasiList    = list(tempMatchList) 
 
-                    # print("\nFinal Match List:",finalMatchList)
-        else:
-            # print("No Match with this cluster")
-            pass
+                # print("\nFinal Match List:",finalMatchList)
 
 
     # print("Selected cluster:%s" % (finalMatchList))
@@ -1531,6 +1638,105 @@ def getPhase(aphas,clusters):
 
     return phasCoordList,matchClust            
 
+def faiIndex(fastaFile):
+    '''
+    Reads index (.fai) of fasta file, index is built once (samtools faidx format) and rebuilt only if fasta is newer
+    than index. Returns dict of name: (length, offset of seqeunce, bases per line, bytes per line)
+    '''
+    print("\nFUNCTION - faiIndex")
+
+    faiFile     = "%s.fai" % (fastaFile)
+    faiD        = {}
+
+    if os.path.isfile(faiFile) and os.path.getmtime(faiFile) >= os.path.getmtime(fastaFile):
+        print("-Reading index:%s" % (faiFile))
+        fh_in   = open(faiFile,'r')
+        for line in fh_in:
+            aname,alen,aoffset,linebases,linebytes = line.strip('\n').split('\t')[:5]
+            faiD[aname] = (int(alen),int(aoffset),int(linebases),int(linebytes))
+        fh_in.close()
+        return faiD
+
+    print("-Building index:%s" % (faiFile))
+    fh_in       = open(fastaFile,'rb')
+    aname       = None
+    aoffset     = 0     ## Byte offset of current line
+    for line in fh_in:
+        if line.startswith(b'>'):
+            if aname is not None:
+                faiD[aname] = (alen,seqoffset,linebases,linebytes)
+            aname       = line[1:].split()[0].decode()
+            seqoffset   = aoffset+len(line)
+            alen        = 0
+            linebases   = 0
+            linebytes   = 0
+            lastline    = False ## Shorter line seen, which must be last line of seqeunce
+        
+        elif aname is not None:
+            bases       = len(line.rstrip(b'\r\n'))
+            if bases and lastline:
+                print("Different line lengths in seqeunce of '%s' - fasta can't be indexed" % (aname))
+                print("Please use fasta with same number of bases per line - Script will exit now")
+                sys.exit()
+            if linebases == 0:
+                linebases   = bases
+                linebytes   = len(line)
+            elif bases != linebases:
+                lastline    = True
+            alen       += bases
+        
+        aoffset += len(line)
+
+    if aname is not None:
+        faiD[aname] = (alen,seqoffset,linebases,linebytes)
+    fh_in.close()
+
+    try:
+        fh_out  = open(faiFile,'w')
+        for aname,(alen,seqoffset,linebases,linebytes) in faiD.items():
+            fh_out.write("%s\t%s\t%s\t%s\t%s\n" % (aname,alen,seqoffset,linebases,linebytes))
+        fh_out.close()
+    except OSError:
+        print("-Index couldn't be written to %s - it will be built again in next run" % (faiFile))
+
+    return faiD
+
+def cacheGenome(fastaFile):
+    '''
+    Indexes and memory-maps the fasta file, seqeunces are fetched on demand by fetchWindow
+    without reading whole file in memory
+    '''
+    print("\nFUNCTION - cacheGenome")
+
+    faiD        = faiIndex(fastaFile)
+    fh_in       = open(fastaFile,'rb')
+    fastaM      = mmap.mmap(fh_in.fileno(),0,access=mmap.ACCESS_READ)
+    fh_in.close()   ## mmap holds its own reference to file
+
+    print("-Total entries indexed:%s" % (len(faiD)))
+
+    return fastaM,faiD
+
+def fetchWindow(fastaM,faiD,aname,astart,aend):
+    '''
+    Fetches seqeunce from start to end (1-based and inclusive) of a chr/trans from memory-mapped fasta,
+    window is clamped to the ends of seqeunce i.e. flanks that run over the ends are trimmed
+    '''
+    alen,aoffset,linebases,linebytes = faiD[aname]
+    astart  = max(astart,1)
+    aend    = min(aend,alen)
+    if aend < astart:
+        return ''
+
+    bstart  = aoffset + ((astart-1)//linebases)*linebytes + (astart-1)%linebases
+    bend    = aoffset + ((aend-1)//linebases)*linebytes + (aend-1)%linebases + 1
+    aseq    = fastaM[bstart:bend]
+    if linebases < alen:
+        ## Seqeunce spans multiple lines
+        aseq = aseq.replace(b'\n',b'').replace(b'\r',b'')
+
+    return aseq.decode()
+
 def fastaReader(fastaFile):
     
     '''Cleans FASTA file - multi-line fasta to single line, header clean, empty lines removal'''
@@ -1566,110 +1772,265 @@ def fastaReader(fastaFile):
 def IRchecker(combSeq,combName):
     '''
     This function takes a seqeunce, and runs einverted and reports back
-    coordinates
+    alignments. Every run gets its own temp directory so that parallel runs
+    do not collide, results are read back in memory and temp files removed
     '''
 
-    print("\nFUNCTION - IRchecker")
+    # print("\nFUNCTION - IRchecker")
     seq         = combSeq
     name        = combName
-    tempInput   = "tempSeq.fa"
-    fh_out      = open(tempInput,'w')
-    fh_out.write('>%s\n%s\n' % (name,seq))
-    fh_out.close()
-
-    outseq = "%s.fa.temp" % name
-    outinv = "%s.inv.temp" % name
-
-    retcode = subprocess.call(["einverted", "-sequence", tempInput, "-gap", str(gap), "-threshold", str(threshold), "-match",str(match),"-mismatch", str(mismatch), "-maxrepeat",str(maxRepLen), "-outfile",outinv, "-outseq",outseq ])
-
-    if retcode == 0:## The bowtie mapping exit with status 0, all is well
-        print('\n+einverted for %s\n' % (name) )
-    else:
-        print('Something wrong happened while running einverted for sequence: %s - - Debug for reason' % (name))
-        sys.exit()
+    with tempfile.TemporaryDirectory(prefix="einverted_") as tempdir:
+        tempInput   = os.path.join(tempdir,"tempSeq.fa")
+        outseq      = os.path.join(tempdir,"tempSeq.fa.temp")
+        outinv      = os.path.join(tempdir,"tempSeq.inv.temp")
+        fh_out      = open(tempInput,'w')
+        fh_out.write('>%s\n%s\n' % (name,seq))
+        fh_out.close()
+
+        ares    = subprocess.run(["einverted", "-sequence", tempInput, "-gap", str(gap), "-threshold", str(threshold), "-match",str(match),"-mismatch", str(mismatch), "-maxrepeat",str(maxRepLen), "-outfile",outinv, "-outseq",outseq ],stderr=subprocess.PIPE)
+        retcode = ares.returncode
+
+        if retcode == 0:## The einverted exit with status 0, all is well
+            # print('\n+einverted for %s\n' % (name) )
+            pass
+        else:
+            print('Something wrong happened while running einverted for sequence: %s - einverted reported:' % (name))
+            print(ares.stderr.decode(errors='replace').strip())
+            return None
 
-    ## Cleanup entry specifc FASTA file
-    if os.path.exists(tempInput):
-        os.remove(tempInput)
+        fh_in   = open(outinv,'r')
+        invtext = fh_in.read()
+        fh_in.close()
 
-    return outseq,outinv
+    return invtext
 
-def IRparser(outseq,outinv,combName):
+def IRparser(invtext,combName):
     '''
-    parse results and delete input files
+    parse einverted results from memory
     '''
-    print("\nFUNCTION - IRparser")
-    print ("+Parsing %s results" % (outinv))
+    # print("\nFUNCTION - IRparser")
+    # print ("+Parsing %s results" % (combName))
 
-    ## File to record results
-    # resOut= "RES_%s.csv" % (combName)
-    # fh_out = open(resOut,'w')
     IRcoords = [] ## Store coordinates for this inverted repeat
-    # fh_out.write("EntryName,Score,Matches,Perc,Gaps,AlignLen,5'Start,5'End,3'start,3'end,Loop\n")
 
-    ## Get list of files
-    afile = outinv
     name = combName
-    # print("Seqeunce being parsed:%s" % (afile))
-    try:
-        if os.stat(afile).st_size > 0:
-            print ("+Sequence %s - Results !!!!" % (afile.split(".")[0]))
-            fh_in = open(afile,'r')
-            invs = fh_in.read().split("\n\n")
-            # print("Empty line splitted:",invs)
+    if invtext.strip():
+        # print ("+Sequence %s - Results !!!!" % (name))
+        invs = invtext.split("\n\n")
+        
+        for i in invs:
+            if not i.strip():
+                continue
+            invLines = i.strip('\n').split('\n')
             
-            for i in invs:
-                # print('\nInverted:',i.strip('\n'))
-                invLines = i.strip('\n').split('\n')
-                # print(invLines)
-                
-                resBlock_splt = invLines[0].split(":")
-                # print(resBlock_splt)
-                score = resBlock_splt[1].split()[1]
-                # print(resBlock_splt[1].split())
-                matchesInfo,gapsInfo = resBlock_splt[2].split(",")
-                # print(matchesInfo,gapsInfo)
-                gaps = gapsInfo.split()[0]
-                
-                # print(matchesInfo.strip().split())
+            resBlock_splt = invLines[0].split(":")
+            score = resBlock_splt[1].split()[1]
+            matchesInfo,gapsInfo = resBlock_splt[2].split(",")
+            gaps = gapsInfo.split()[0]
+
+            matches = matchesInfo.strip().split()[0]
+            matched,total = matches.split("/")
+            alignLen = int(total)*2
+            perc = round(int(matched)/int(total),2)
+
+            arm5 = invLines[1].strip()
+            start5,seq5,end5 = arm5.split(" ")
+
+            arm3 = invLines[3].strip()
+            end3,seq3,start3 = arm3.split(" ")
 
-                matches = matchesInfo.strip().split()[0]
-                matched,total = matches.split("/")
-                alignLen = int(total)*2
-                perc = round(int(matched)/int(total),2)
+            loop = int(start3)-int(end5)
+
+            IRcoords.append((name,score,matches,str(perc),gaps,str(alignLen),start5,end5,start3,end3,loop))
+
+    else:
+        # print ("Sequence %s - No results" % (name))
+        pass
 
-                # matches,garbage1,perc,garbage2 = matchesInfo.strip().split()
-                # alignLen = int(matches.split("/")[1])*2
-                # print(score,matches,gaps)
+    return IRcoords
 
-                arm5 = invLines[1].strip()
-                start5,seq5,end5 = arm5.split(" ")
+def IRfinder(aseq,aname):
+    '''
+    In-process alternative to einverted - local alignment (Smith-Waterman) of seqeunce against its reverse complement,
+    using match, mismatch and linear gap penalty from settings. Only the band where 3' arm ends within maxRepLen of
+    5' arm start is scored, each row of band is computed as a vector. Best cell of every row scoring above threshold
+    is a candidate, candidates are traced back best first and kept if arms do not overlap an IR already reported.
+    Returns coords in same format as IRparser, best IR first
+    '''
 
-                arm3 = invLines[3].strip()
-                end3,seq3,start3 = arm3.split(" ")
+    codes       = np.frombuffer(aseq.upper().encode(),dtype=np.uint8)
+    acode       = np.full(256,4,dtype=np.int8)                    ## A:0 C:1 G:2 T:3 others:4
+    for abase,x in zip(b'ACGTU',(0,1,2,3,3)):
+        acode[abase] = x
+    seqC        = acode[codes]
+    compC       = np.where(seqC < 4,3-seqC,5)                   ## Complement, 'N' never pairs
+    alen        = len(seqC)
+    aband       = min(alen,int(maxRepLen))
+    
+    IRcoords    = []
+    if alen < 2:
+        return IRcoords
+
+    ## Score band #######################################
+    ## Row is 5' arm position (i), column is 3' arm position (j>i) walking towards 5' end of 3' arm
+    ## Directions for traceback 0:start 1:diagonal 2:gap in 3' arm 3:gap in 5' arm
+    dirM        = np.zeros((alen,aband),dtype=np.int8)
+    ## Two row buffers are reused - a row reads previous row up to hi+1, beyond what rows before it wrote, so stale cells are never read
+    prevH       = np.zeros(alen+1,dtype=np.int32)
+    curH        = np.zeros(alen+1,dtype=np.int32)
+    candL       = []                                            ## Best cell of every row above threshold
+    for i in range(alen):
+        lo      = i+1
+        hi      = min(alen,i+1+aband)
+        if lo >= hi:
+            break                                               ## Last row, no 3' arm positions left
+        cols    = np.arange(lo,hi)
+        diag    = prevH[lo+1:hi+1]+np.where(seqC[lo:hi] == compC[i],match,mismatch)
+        up      = prevH[lo:hi]-gap
+        T       = np.maximum(np.maximum(diag,up),0)
+        ## Gap in 5' arm i.e. from j+1 in same row - H[j] = max(T[j],H[j+1]-gap) as reverse running max
+        H       = np.maximum.accumulate((T-gap*cols)[::-1])[::-1]+gap*cols
+        adir    = np.where(H == 0,0,np.where((H == diag) & (diag > 0),1,np.where((H == up) & (up > 0),2,3)))
+        dirM[i,:hi-lo] = adir
+        curH[lo:hi] = H
+        x       = int(np.argmax(H))
+        if H[x] >= threshold:
+            candL.append((int(H[x]),i,lo+x))
+        prevH,curH = curH,prevH
+
+    ## Traceback ########################################
+    armL        = []                                            ## Arms of reported IRs (start5,end5,start3,end3)
+    for ascore,iend,jend in sorted(candL,key=lambda x: (-x[0],x[1])):
+        if any(a5 <= iend+1 <= b5 or a3 <= jend+1 <= b3 for a5,b5,a3,b3 in armL):     ## Ends inside a reported arm, arms are 1-based
+            continue
+        i,j         = iend,jend
+        matched     = 0
+        total       = 0
+        gaps        = 0
+        while i >= 0 and j < alen and j-i <= aband:            ## Cells outside band are start of alignment
+            adir = dirM[i,j-i-1]
+            if adir == 0:
+                break
+            istart,jstart = i,j
+            total += 1
+            if adir == 1:
+                if seqC[j] == compC[i]:
+                    matched += 1
+                i -= 1
+                j += 1
+            elif adir == 2:
+                gaps += 1
+                i -= 1
+            else:
+                gaps += 1
+                j += 1
+        start5,end5,start3,end3 = istart+1,iend+1,jend+1,jstart+1  ## 1-based as einverted
+        if any(not (end5 < a5 or start5 > b5) or not (end3 < a3 or start3 > b3) for a5,b5,a3,b3 in armL):
+            continue
+        armL.append((start5,end5,start3,end3))
+        perc        = round(matched/total,2)
+        IRcoords.append((aname,str(ascore),"%s/%s" % (matched,total),str(perc),str(gaps),str(total*2),str(start5),str(end5),str(start3),str(end3),start3-end5))
 
-                loop = int(start3)-int(end5)
+    return IRcoords
 
-                IRcoords.append((name,score,matches,str(perc),gaps,str(alignLen),start5,end5,start3,end3,loop))
-                # fh_out.write("%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n" % (afile.split(".")[0],score,matches,str(perc),gaps,str(alignLen),start5,end5,start3,end3,loop)) ## name of file,score,match,gaps
+def IRbenchmark(fastaFile):
+    '''
+    Benchmarks IRfinder against einverted on seqeunces from fastaFile, time taken by both is recorded and best IR 
+    (highest score) compared - concordant if both arms of IRs overlap. Results are written to IRbenchmark.txt
+    '''
 
-            # Clean up ### 
-            garbage = [afile for afile in os.listdir('./') if afile.endswith (('.fa.temp','.inv.temp'))]
-            for afile in garbage:
-                print("+Deleting %s" % (afile))
-                os.remove(afile)
+    print("\nFUNCTION - IRbenchmark")
+    fastaList,fastaDict = fastaReader(fastaFile)
 
+    resfile     = "IRbenchmark.txt"
+    fh_out      = open(resfile,'w')
+    fh_out.write("name\tlen\teinvertedTime\tIRfinderTime\teinvertedBest\tIRfinderBest\tstatus\n")
+
+    statusC     = Counter()
+    einvtime    = 0
+    findtime    = 0
+    for name,seq,alen in fastaList[:benchSeqs]:
+        start       = time.time()
+        invtext     = IRchecker(seq,name)
+        if invtext is None:
+            sys.exit()
+        einvL       = IRparser(invtext,name)
+        end         = time.time()
+        findL       = IRfinder(seq,name)
+        end2        = time.time()
+        einvtime   += end-start
+        findtime   += end2-end
+
+        ## Compare best IR ##########
+        einvbest    = max(einvL,key=lambda x: int(x[1])) if einvL else None
+        findbest    = max(findL,key=lambda x: int(x[1])) if findL else None
+        if not einvbest and not findbest:
+            status  = "none"
+        elif not findbest:
+            status  = "einverted-only"
+        elif not einvbest:
+            status  = "IRfinder-only"
         else:
-            # print ("Sequence %s - No results" % (afile.split(".")[0]))
-            pass
+            a5,b5,a3,b3 = (int(x) for x in einvbest[6:10])
+            c5,d5,c3,d3 = (int(x) for x in findbest[6:10])
+            if a5 <= d5 and c5 <= b5 and a3 <= d3 and c3 <= b3:
+                status = "concordant"
+            else:
+                status = "discordant"
+        statusC[status] += 1
 
-    except OSError:
-        print("+No result file for sequence %s found - Please check" % (afile))
-        print("+System will exit")
-        sys.exit()
+        fh_out.write("%s\t%s\t%.4f\t%.4f\t%s\t%s\t%s\n" % (name,alen,end-start,end2-end,','.join(str(x) for x in einvbest[1:]) if einvbest else "NA",','.join(str(x) for x in findbest[1:]) if findbest else "NA",status))
 
+    fh_out.close()
 
-    return IRcoords
+    both        = statusC["concordant"]+statusC["discordant"]
+    print("+Seqeunces:%s | Concordant:%s | Discordant:%s | einverted only:%s | IRfinder only:%s | None:%s" % (sum(statusC.values()),statusC["concordant"],statusC["discordant"],statusC["einverted-only"],statusC["IRfinder-only"],statusC["none"]))
+    if both:
+        print("+Concordance where both found IR:%s" % (round(statusC["concordant"]/both,3)))
+    print("+Time einverted:%ss | IRfinder:%ss" % (round(einvtime,2),round(findtime,2)))
+    print("+Benchmark written to:%s" % (resfile))
+
+    return resfile
+
+def IRworker(aent):
+    '''
+    Finds inverted repeats for one (name,seq) using method in settings and returns parsed results, IRcoords is None if einverted failed
+    '''
+    aname,aseq  = aent
+    if IRmethod == 1:
+        return aname,IRfinder(aseq,aname)
+
+    invtext     = IRchecker(aseq,aname)
+    if invtext is None:
+        return aname,None
+
+    return aname,IRparser(invtext,aname)
+
+def PPIR(seqL):
+    '''
+    Runs einverted on a list of (name,seq) across cores, seqeunces are sent to workers in batches and results
+    parsed in memory. Returns dict with name as key and IRcoords as value
+    '''
+
+    print("\nFUNCTION - PPIR")
+    IRD = {}
+    if not seqL:
+        return IRD
+
+    achunk  = max(1,math.ceil(len(seqL)/(nproc*IRchunks)))
+    print("+Seqeunces:%s | Cores:%s | Batch size:%s" % (len(seqL),nproc,achunk))
+    npool   = Pool(nproc)
+    resL    = npool.map(IRworker,seqL,chunksize=achunk)
+    npool.close()
+    npool.join()
+
+    for aname,IRcoords in resL:
+        if IRcoords is None:
+            print("+einverted failed for %s - System will exit" % (aname))
+            sys.exit()
+        IRD[aname] = IRcoords
+
+    return IRD
 
 def checkOverhang(atrimcoords,btrimcoords):
     '''
@@ -2024,74 +2385,41 @@ def mapLibs(fastaFile,fetchedLibs):
 
 def map2Dict(alib):
     '''
-    parse the bowtie map, it assumes that map file have been generated already
+    parse the bowtie map, it assumes that map file have been generated already. Map is streamed and sRNAs
+    grouped by transcript in single pass, strand and length filters applied while reading
     '''
 
     print("\nFUNCTION: map2Dict")
 
-    ## Rad sRNA map file
+    ## Read sRNA map file
     mapFile = './%s.map' % (alib)
     fh_in   = open(mapFile,'r')
-    mapRead = fh_in.readlines()
-    fh_in.close()
 
-    ## Prepare list of mapped sRNAs, uniq trans names before dictionary prepration
-    mapList     = [] ## List of all mapped sRNAs
-    transSet    = set() ## Set of uniq transcripts name
-    for i in mapRead:
+    ### Prepare the sRNA dictionary, every transcript with a mapped sRNA is a key
+    print("-Preparing dictionaries of sRNAs")
+    srnaDict    = {}
+    acount      = 0 ## sRNAs that passed filters
+    for i in fh_in:
         ent     = i.strip('\n').split("\t")
         aname,astrand,atrans,apos,phasiseq,trash1,hits,trash2 = ent ## Last column is Comma-separated list of mismatch descriptors. 
-        phasiname,phasiabun = aname.strip().split("|") ## Updated to match tag2Fasta v03
+        transname           = atrans.strip()
+        value               = srnaDict.get(transname)
+        if value is None:
+            value           = srnaDict[transname] = []
+        
         phasistrand         = str(astrand).translate(str.maketrans("+-","wc"))
         phasilen            = int(len(phasiseq.strip()))
-        phasihits           = int(hits)+1 ## This is not a good poxy of sRNA hits, more processing required to get hits, so this number can't be trusted
-        phasiflag           = 'S' ## sRNA from bowtie map file
-        phasipos            = int(apos)+1 ## Convert 0-based offset to 1-based offset like Pingchuans cluster file
-        transname           = atrans.strip()
-        # print(aname,phasistrand,transname,phasiabun,phasiseq,phasilen,phasihits,phasiflag,phasipos)
-        transSet.add(transname)
         if phasistrand == 'w' and phasilen >= minNoiseLen and phasilen <= maxNoiseLen: ## sRNAs of only positive strand used - OK
-            mapList.append((aname,phasistrand,transname,phasiabun,phasiseq,phasilen,phasihits,phasiflag,phasipos))
-    # sys.exit()
-    mapList_s = sorted(mapList,key=operator.itemgetter(2))
-    # print("-Snippet of sorted mapped list:",[mapList_s[:50]]) ## Tested OK
-    print("-List of lib:%s sRNAs prepared with %s entries" % (alib,len(mapList)))
-    print("-Total transcipts recorded:%s" % (str(len(transSet))))
-
-    ### Now prepare the sRNA dictionary
-    print("-Preparing dictionaries of sRNAs")
-    
-    srnaDict = {}
-    for atrans in transSet:
-        value       = []    ## Store values for key
-        matchFlag   = 0     ## This jumps the loop once match is done
-        # print("\n-Caching sRNAs for trans:%s" % (atrans))
-        
-        for i in mapList_s: ## For entry in mapped list
-            # print("-sRNA entry:",i)
-            aname,phasistrand,transname,phasiabun,phasiseq,phasilen,phasihits,phasiflag,phasipos = i
-            # print(i)
-            
-            if transname == atrans and matchFlag == 0: ## This is the first phasiRNA for this transcript
-                matchFlag = 1 ## Match detected, now followinf sRNAs belong to this transcripts
-                value.append((aname,phasistrand,phasiabun,phasiseq,phasilen,phasihits,phasiflag,phasipos))
-
-            elif transname == atrans and matchFlag == 1: ## These are phasiRNAs for this transcript, other then the first one
-                value.append((aname,phasistrand,phasiabun,phasiseq,phasilen,phasihits,phasiflag,phasipos))
-
-            elif transname != atrans and matchFlag == 1: ## phasiRNAs for this transcripts have been cached already, jump to next transcript
-                # print("-phasiRNAs already cached for trans:%s - Jumping the loop" % (transname))
-                continue
-
-            else:
-                # print("phasiRNAs from %s do not belong transcript %s being cached" % (transname,atrans))
-                pass
-
-
-        ## Add to dictionary 
-        # print("Key:%s | values:%s" % (atrans,value))
-        srnaDict[atrans] = value
+            phasiname,phasiabun = aname.strip().split("|") ## Updated to match tag2Fasta v03
+            phasihits           = int(hits)+1 ## This is not a good poxy of sRNA hits, more processing required to get hits, so this number can't be trusted
+            phasiflag           = 'S' ## sRNA from bowtie map file
+            phasipos            = int(apos)+1 ## Convert 0-based offset to 1-based offset like Pingchuans cluster file
+            value.append((aname,phasistrand,phasiabun,phasiseq,phasilen,phasihits,phasiflag,phasipos))
+            acount += 1
+    fh_in.close()
 
+    print("-List of lib:%s sRNAs prepared with %s entries" % (alib,acount))
+    print("-Total transcipts recorded:%s" % (str(len(srnaDict))))
     print("-Dictionary with entries for %s transcipts prepared" % (str(len(srnaDict))))
 
     return srnaDict
@@ -2187,7 +2515,7 @@ def clust2Dict(clustFile):
 
     return phasedDict
 
-def mergeRNAs(trans,sRNADict,phasedDict,fastaDict,cur,finalLibs):
+def mergeRNAs(trans,sRNADict,phasedDict,fastaM,faiD,cur,finalLibs,store=None):
     '''
     This function merges sRNAs and phasiRNAs for trans5 and same for trans3. In case of direct IRs
     phasiRNAs would be uniq in seq and position will be retained. And for 'c' strand mapping for which no 'w' mapping found in cluster (clust2dict), it
@@ -2223,13 +2551,18 @@ def mergeRNAs(trans,sRNADict,phasedDict,fastaDict,cur,finalLibs):
     #### Fetch phasiRNAs abundance, find 'w' psoitions for 'c' mapped phasiRNAs and prepare list to substract with sRNAs
     ####################################################################################################################
     phasiList = [] ## List to store phased tags, so that sRNAs can be filtered out that match to phasiRNAs
+    if store is not None:
+        abunD = storeAbundance(store,[ent[3] for ent in phasivalues],finalLibs)
     for ent in phasivalues:
         # print("-phasiRNAs",ent)
         phasiseq    = ent[3]
         phasistrand = ent[1]
         phasipos    = ent[7]
         ## Fetch abundances for library(s) if interest
-        atag,phasilibabun,lib_abun = getAbundance(cur,phasiseq,finalLibs)
+        if store is not None:
+            atag,phasilibabun,lib_abun = abunD[phasiseq]
+        else:
+            atag,phasilibabun,lib_abun = getAbundance(cur,phasiseq,finalLibs)
         ### Sanity check
         if not lib_abun:
             print("No abundance found for this tag:%s" % (phasiseq))
@@ -2249,7 +2582,7 @@ def mergeRNAs(trans,sRNADict,phasedDict,fastaDict,cur,finalLibs):
             if phasistrand == 'c':
                 ## Fetch position for 'w' strand from sRNA mapping
                 print("Position of %s on 'c' strand:%s" % (phasiseq,phasipos))
-                aseq = fastaDict[trans]         ## get the transcript
+                aseq = fetchWindow(fastaM,faiD,trans,1,faiD[trans][0]) ## get the transcript
                 # print(aseq)
                 startindex = aseq.find(phasiseq)## Get the start site in python '0' format
                 if startindex > 0:
@@ -2302,10 +2635,15 @@ def mergeRNAs(trans,sRNADict,phasedDict,fastaDict,cur,finalLibs):
             if srnaseq not in phasiList:
                 transClust.append((ent[0],ent[1],ent[2],ent[3],ent[4],ent[5],ent[6],int(ent[7])))
     elif noiseAbun  == 1:
+        if store is not None:
+            abunD = storeAbundance(store,[ent[3] for ent in sRNAvalues if ent[3] not in phasiList],finalLibs)
         for ent in sRNAvalues:
             srnaseq = ent[3]
             if srnaseq not in phasiList:
-                atag,noiselibabun,lib_abun  = getAbundance(cur,srnaseq,finalLibs)
+                if store is not None:
+                    atag,noiselibabun,lib_abun  = abunD[srnaseq]
+                else:
+                    atag,noiselibabun,lib_abun  = getAbundance(cur,srnaseq,finalLibs)
                 transClust.append((ent[0],ent[1],int(noiselibabun),ent[3],ent[4],ent[5],ent[6],int(ent[7])))
     else:
         print("Wrong noiseAbun mode selected - check settings, script will exit")
@@ -2438,6 +2776,100 @@ def getAbundance(cur,tag,finalLibs):
 
     return tag,abun_sum,lib_abun
             
+def abunStore(cur,finalLibs):
+    '''
+    Local tag abundance store (SQLite, one per sRNA DB) for libraries in finalLibs. Libraries missing from store 
+    are downloaded from server in bulk, once - later runs answer all lookups from store. Returns connection to store
+    '''
+
+    print("\nFUNCTION: abunStore")
+    storeFile   = "%s.tagAbun.sqlite" % (db)
+    store       = sqlite3.connect(storeFile)
+    scur        = store.cursor()
+    scur.execute("CREATE TABLE IF NOT EXISTS abun (tag TEXT, lib TEXT, norm NUMERIC, PRIMARY KEY (tag,lib)) WITHOUT ROWID")
+    scur.execute("CREATE TABLE IF NOT EXISTS libs (lib TEXT PRIMARY KEY, tags INTEGER)")
+    scur.execute("SELECT lib FROM libs")
+    storedLibs  = set(x[0] for x in scur.fetchall())
+
+    for alib in finalLibs:
+        if str(alib) in storedLibs:
+            continue
+        print("+Downloading tag abundances for library:%s" % (alib))
+        cur.execute("SELECT tag,norm FROM %s.run_master where lib_id = %s" % (db,alib))
+        acount = 0
+        while True:
+            info = cur.fetchmany(100000)
+            if not info:
+                break
+            ## Entries are redundant, one for every hit - first is kept as in getAbundance
+            scur.executemany("INSERT OR IGNORE INTO abun VALUES (?,?,?)", ((atag,str(alib),norm) for atag,norm in info))
+            acount += len(info)
+        scur.execute("INSERT INTO libs VALUES (?,?)", (str(alib),acount))
+        store.commit()                  ## Library is recorded only when complete
+        print("+Library:%s stored with %s entries" % (alib,acount))
+
+    print("+Tag abundance store:%s ready for %s libraries" % (storeFile,len(finalLibs)))
+
+    return store
+
+def storeLibs(excludeLibs,finalLibs=None):
+    '''
+    Libraries selected by prepareQuery are saved in local abundance store for an excludeLibs setting, when finalLibs
+    is given. Otherwise these are returned if all are in store, so that server need not be queried - None if not
+    '''
+
+    storeFile   = "%s.tagAbun.sqlite" % (db)
+    if finalLibs is None and not os.path.isfile(storeFile):
+        return None
+
+    akey        = "finalLibs:%s" % (",".join(sorted(str(x) for x in excludeLibs)))
+    store       = sqlite3.connect(storeFile)
+    scur        = store.cursor()
+    scur.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    if finalLibs is not None:
+        scur.execute("INSERT OR REPLACE INTO meta VALUES (?,?)", (akey,json.dumps(finalLibs)))
+        store.commit()
+        store.close()
+        return finalLibs
+
+    scur.execute("SELECT value FROM meta WHERE key = ?", (akey,))
+    res         = scur.fetchone()
+    savedLibs   = json.loads(res[0]) if res else None
+    if savedLibs:
+        scur.execute("SELECT lib FROM libs")
+        storedLibs = set(x[0] for x in scur.fetchall())
+        if not all(str(alib) in storedLibs for alib in savedLibs):
+            savedLibs = None
+    store.close()
+
+    if savedLibs:
+        print("+Libraries from local abundance store, server will not be queried:%s" % (",".join(str(x) for x in savedLibs)))
+    return savedLibs
+
+def storeAbundance(store,tags,finalLibs):
+    '''
+    Batch lookup of tags in local abundance store, returns dict with tag as key and (tag,abun_sum,lib_abun)
+    as value i.e. same as getAbundance
+    '''
+
+    libIdx      = dict((str(alib),x) for x,alib in enumerate(finalLibs))
+    tagL        = list(set(tags))
+    abunD       = {}
+    scur        = store.cursor()
+    for x in range(0,len(tagL),500):
+        batch   = tagL[x:x+500]
+        scur.execute("SELECT tag,lib,norm FROM abun WHERE tag IN (%s)" % (",".join("?"*len(batch))), batch)
+        for atag,alib,norm in scur.fetchall():
+            if alib in libIdx:
+                abunD.setdefault(atag,[0]*len(finalLibs))[libIdx[alib]] = norm
+
+    resD = {}
+    for atag in tagL:
+        lib_abun    = abunD.get(atag,[0]*len(finalLibs))
+        resD[atag]  = (atag,sum(lib_abun),lib_abun)
+
+    return resD
+
 def prepareQuery(excludeLibs,cur):
 
     ### Prepare query of libs #################
@@ -2511,9 +2943,10 @@ def main():
         isoformWriter(list_nor,isoPair,header,pairedSet)
         collapseNoIsoforms(isoDict,noIsoPair,header,summaryFile)
         
-        ## Prepare chart input
-        con                                     = ConnectToDB(server)
+        ## Prepare chart input - server is connected only if required
+        con                                     = None
         if fetchMap == 1:
+            con                                     = ConnectToDB(server)
             fetchedLibs                             = TagAbundanceFile(con,db,userLibs)
             mapLibs(fastaFile,fetchedLibs)
         else:
@@ -2525,6 +2958,7 @@ def main():
 
     elif runMode == 1:
         
+        con = None
         if fetchMap == 1:
             print("+Preparing map files - NEED TO BE DONE ONLY ONCE")
             ### Fetch Libs
@@ -2545,7 +2979,6 @@ def main():
         resFile     = "finalPairs.txt"      ## This must be prepared by validateIR function in ealier run
         clustFile   = "phased.clust"        ## This must be prepared by validateIR function in ealier run
         validList   = finalPairs(resFile)   ## List of results from old run of validateIR function
-        con         = ConnectToDB(server)
         chartInput,consensusInput  = prepareChartFiles(validList,clustFile,userLibs,fastaFile,con)
         mergedOut,mergedsizeOut = mergeIRs(consensusInput,consensusCands)
 
@@ -2557,6 +2990,10 @@ def main():
             consensusInput  = "%s.consensus.input.txt" % (lib)
             mergedOut,mergedsizeOut = mergeIRs(consensusInput,consensusCands)
 
+    elif runMode == 3:
+        ## Compare in-process IRfinder with einverted before switching IRmethod
+        IRbenchmark(fastaFile)
+
     else:
         print("Please input correct mode - Script will exit now")
         sys.exit()
@@ -2675,6 +3112,17 @@ if __name__ == '__main__':
 ## Fixed a bug in map2dict where phasiname was being addded to dict but it was not being assigned in the loop
 #### So name of last phasi from earlier loop ws being used for all noise sRNAs
 
+## v2.4 -> v2.41
+## Phased fasta is indexed (.fai, built once) and memory-mapped, transcripts are fetched by name in getIRcoords and mergeRNAs instead of scanning fastaList
+## einverted is run for all pairs upfront by PPIR across cores in batches, each run in its own temp directory and results parsed in memory
+## Added IRfinder, in-process banded Smith-Waterman against reverse complement as alternative to einverted (IRmethod), runMode 3 benchmarks it against einverted
+## map2Dict groups sRNAs by transcript in single pass over streamed map file, earlier every transcript scanned whole map list
+## Tag abundances for mergeRNAs looked up in batches from local SQLite store (abunStore), libraries downloaded once in bulk instead of one query per tag and library
+## Libraries selected by prepareQuery are saved in store (storeLibs) - later runs covered by store do not connect to server
+## Charts are rendered after library is processed, in parallel with one reused figure per process; chartMode to skip charts, write one multi-page PDF or just chart data as TSV
+## Clusters file is indexed once by transcript and start (clustIndex), getPhase looks up only overlapping clusters and computes match ratio arithmetically
+## inferIRs, validateIR, isoformsDict, isoformChecker and isoformWriter use sets and transcript-indexed BLAST/PHAS results instead of nested scans of lists
+
 ### TO DO
 ### 1. Fix bug where a few noIsoPair transcripts were not being written to "noIsoToPairedClusts.txt" file. Problem seems in evaluating length of clust (>1), if its one list or one entry, in
 ### 'collapseNoIsoforms' module. For now these misisng ones can be treated as unpaired with one isoforms.
\ No newline at end of file
@@ -11,7 +11,7 @@
 ### Contact: atulkakrana@gmail.com
 
 import os,glob,sys,difflib,time,shutil,argparse,math
-import operator,datetime,subprocess,multiprocessing,re
+import operator,datetime,subprocess,multiprocessing,re,hashlib,importlib.util,json
 from multiprocessing import Process, Queue, Pool
 from operator import itemgetter
 from itertools import groupby
@@ -20,9 +20,12 @@ from itertools import groupby
 
 setFile         = "phaser.set"
 memFile         = "collapser.mem"
+stateFile       = "collapser.state"                                                        ## Collapsed PHAS, provenance and lib info - used by '--add' mode
 res_folder      = "summary_%s"   % (datetime.datetime.now().strftime("%m_%d_%H_%M"))      ## Folder with all ther results
 cleanup         = 1
 cores           = 0
+matrixCache     = 1                 ## 1: Reuse tag count matrix (tagmatrix_*.npy) from earlier run if libraries are unchanged | 0: Always rebuild
+dumpTemp        = 0                 ## 1: Write lib-wise converted PHAS lists (*converted.list) to temp folder for debugging | 0: Kept in memory only
 
 ### COLLAPSER DEFAULTS #############
 fileType        = 'L'               ## 'L' = *cluster.boundary.without.PARE.validation.list file, N = *NO.by.PARE.file, Y = *YES.by.PARE.file, C: if formatted CSV for intercomparision
@@ -60,6 +63,9 @@ flags.add_argument('-dir',  default='None', type=str, help='directory from your'
     'phaser run which need to be summarized. Required parameter', required=True)
 parser.add_argument('-pval',  default='', type=str, help='pvalue cutoff to '\
     'filter the phased siRNAs loci or transcipts. Optional parameter', required=False)
+parser.add_argument('--add',  default='', type=str, help='directory from earlier '\
+    'collapser run. New libraries from -dir are merged into its collapsed PHAS set instead '\
+    'of collapsing all libraries again. Optional parameter', required=False)
 
 # args = parser.parse_args()
 args = parser.parse_args()
@@ -73,10 +79,35 @@ if args.dir == None:
 ## If user add "/" at end of path, this is removed
 if args.dir.endswith("/"):
     args.dir = args.dir[0:-1]
+if args.add.endswith("/"):
+    args.add = args.add[0:-1]
 
 #### COLLAPSER FUNCTIONS ########################
 #################################################
 
+def checkDependency():
+    '''Checks for required components on user system'''
+
+    print("\n#### Fn: checkDependency ###############")
+
+    goSignal    = True ### Signal to process is set to true
+
+    ### Check numpy - required for tag count matrix
+    isNumpy     = importlib.util.find_spec('numpy')
+    if isNumpy is None:
+        print("--numpy   : missing")
+        goSignal    = False
+    else:
+        print("--numpy   : found")
+        pass
+
+    if goSignal == False:
+        print("\n** Please install the missing libraries before running the analyses")
+        print("** collapser has unmet dependencies and will exit for now\n")
+        sys.exit()
+
+    return None
+
 def readSet(setFile):
     '''
     Read and parse external settings file
@@ -153,6 +184,103 @@ def readSet(setFile):
     # sys.exit()
     return libs
 
+def readState(afolder):
+    '''
+    Reads collapsed state from earlier run for '--add' mode - returns state dict with phase, pval,
+    runType, lib info, collapsed PHAS with lib of origin, and matched clusters of every PHAS
+    '''
+    print("\n#### Fn: State Reader #######################")
+
+    afile = "%s/%s" % (afolder,stateFile)
+    if not os.path.isfile(afile):
+        print("** Collapsed state file '%s' not found in specified directory:%s" % (stateFile,afolder))
+        print("** Please provide directory from an earlier 'collapser' run to '--add' switch")
+        print("** Script exiting...\n")
+        sys.exit()
+
+    fh_in   = open(afile,'r')
+    stateD  = json.load(fh_in)
+    fh_in.close()
+
+    ### Sanity check ######
+    if int(stateD['phase']) != int(phase) or stateD['runType'] != runType:
+        print("** Earlier collapsed set is for %s-nt PHAS and runType '%s'" % (stateD['phase'],stateD['runType']))
+        print("** 'phaser.set' has %s-nt PHAS and runType '%s' - these must be same to merge" % (phase,runType))
+        sys.exit()
+
+    for alib,ainfo in stateD['libs']:
+        if not os.path.isfile(alib):
+            print("** Library from earlier collapsed set not found:%s" % (alib))
+            print("** It is required to fetch lib-wise abundances, please copy it to current directory")
+            sys.exit()
+        elif os.path.getsize(alib) != ainfo['size']:
+            print("WARNING: Library %s has changed since earlier collapsed set was made" % (alib))
+
+    print("Earlier collapsed set:%s | Libs:%s | PHAS:%s | p-val:%s" % (afolder,len(stateD['libs']),len(stateD['loci']),stateD['pval']))
+
+    return stateD
+
+def writeState(libs,listL,collapsedL,provD,resList,resList2,pcutoff,stateD):
+    '''
+    Writes collapsed state i.e. collapsed PHAS with lib of origin, lib info and matched
+    clusters of every PHAS - read by '--add' mode to merge new libraries
+    '''
+    print("\n#### Fn: State Writer #######################")
+
+    ### Library info - earlier libs retain their info
+    libinfoD = {}
+    if stateD:
+        for alib,ainfo in stateD['libs']:
+            libinfoD[alib] = ainfo
+
+    libs_name = dict((x.rsplit(".",1)[0],x) for x in libs)
+    for afile in listL:
+        alib = libs_name.get(afile.rpartition('/')[-1].rsplit(".",7)[0])
+        if alib and alib not in libinfoD:
+            libinfoD[alib] = {'list':afile,'size':os.path.getsize(alib),'mtime':int(os.path.getmtime(alib))}
+
+    ### Collapsed PHAS with lib of origin
+    lociL = []
+    for achr in collapsedL:
+        for aphas in achr.values():
+            lociL.append(list(aphas[1])+[provD.get(tuple(aphas[1]),aphas[2])])
+
+    ### Matched clusters for PHAS, used for unchanged PHAS in next run
+    clustD = {}
+    for ent,ent2 in zip(resList,resList2):
+        clustD[ent[0]] = [ent[1],ent2[1]]
+
+    afile   = "./%s/%s" % (res_folder,stateFile)
+    fh_out  = open(afile,'w')
+    json.dump({'phase':phase,'pval':pcutoff,'runType':runType,'libs':[(x,libinfoD[x]) for x in libs if x in libinfoD],
+        'loci':lociL,'clusters':clustD},fh_out)
+    fh_out.close()
+    print("Collapsed state written:%s | Libs:%s | PHAS:%s" % (afile,len(libinfoD),len(lociL)))
+
+    return afile
+
+def stateToCollapsed(stateD):
+    '''
+    Converts PHAS from earlier collapsed state to collapsed list format i.e. chr/scaffold or trans
+    specific dicts, and a dict of lib of origin for these PHAS
+    '''
+    print("\n#### Fn: stateToCollapsed ###################")
+
+    chrD    = {} ## Key: chr/scaffold or trans and value: dict in collapsed format
+    provD   = {} ## Key: PHAS tuple and value: lib of origin
+    for ent in stateD['loci']:
+        aphas   = tuple(ent[:5])
+        alib    = ent[5]
+        achr,astart,aend = aphas[2],aphas[3],aphas[4]
+        akey    = "%s-%s-%s" % (achr,astart,aend)
+        chrD.setdefault(achr,{})[akey] = ((achr,astart,aend),aphas,alib,akey)
+        provD[aphas] = alib
+
+    collapsedL = list(chrD.values())
+    print("Groups in collapsed state:%s | PHAS:%s" % (len(collapsedL),len(provD)))
+
+    return collapsedL,provD
+
 def pvaluereader():
     '''
     Get the best matching p-value to user cutoff
@@ -248,7 +376,12 @@ def pvaluereader():
     # sys.exit()
     return pcutoff
 
-def prepare(pcutoff,libs,res_folder):
+def prepare(pcutoff,libs,res_folder,oldLibs=None):
+    '''
+    Selects list files of libs to be collapsed and combines cluster files of all libs, including
+    oldLibs from earlier collapsed set in '--add' mode - In that mode, cluster files of new libs are
+    also combined separately, to search these for PHAS cached from earlier set
+    '''
 
     print("\n#### Fn: prepare ############################")
     
@@ -257,6 +390,7 @@ def prepare(pcutoff,libs,res_folder):
     for i in libs:
         alib = i.rsplit(".",1)[0]
         libs_name.append(alib)
+    oldlibs_name = [x.rsplit(".",1)[0] for x in oldLibs] if oldLibs else []
 
     ### Make a new folder ##############################
     ####################################################
@@ -264,28 +398,33 @@ def prepare(pcutoff,libs,res_folder):
     print("WARNING: 'collapser' results exist from earlier run, these will be deleted")
     shutil.rmtree("%s" % (res_folder),ignore_errors=True)
     os.mkdir("%s" % (res_folder))
-    os.mkdir("%s" % (temp_folder))
+    if dumpTemp == 1:
+        os.mkdir("%s" % (temp_folder))
+    else:
+        temp_folder = None ## Lib-wise PHAS lists are handed over in memory
 
    ### Get files for collapser #########################
     listL      = [file for file in os.listdir("%s" % (args.dir)) if file.endswith ('.list')]
     # print(listL)
     print("%s list files found" % (len(listL)))
     
-    acount = 0 ### Count of library results copied to collapsed folder
+    acount = 0 ### Count of library results selected for collapsing
+    selectL = [] ### List files selected for collapsing, read directly from phaser folder
     for alistF in listL:
         alib    = alistF.rsplit(".",7)[0]
         # print("alib:",alib)
         if alib in libs_name:
-            print("copied for summarization:%s" % (alistF))
+            print("selected for summarization:%s" % (alistF))
             acount += 1
             afile   = "%s/%s" % (args.dir,alistF)
-            shutil.copy(afile,temp_folder)
+            selectL.append(afile)
     # sys.exit()
 
     ### Get files for summarizer ######################
     ###################################################
     clustL      = [file for file in os.listdir("%s" % (args.dir)) if file.endswith ('.cluster')]
     combL       = []    ## List of file to be combined
+    newcombL    = []    ## Cluster files of new libs, for '--add' mode
     bcount      = 0     ## Counter for cluster files
     # print(clustL)
     print("%s clust files found" % (len(clustL)))
@@ -301,7 +440,7 @@ def prepare(pcutoff,libs,res_folder):
             aphase  = info[3]
 
             # print("-%s,%s,%s" % (alib,pval,aphase))
-            if (alib in libs_name) and (float(pval) <= float(pcutoff)) and (str(aphase) == str(phase)): ## phase added to ensure that if user runs both 21 and 24-nt PHAS in same directory, the files from different analysis are not picked up. 
+            if (alib in libs_name or alib in oldlibs_name) and (float(pval) <= float(pcutoff)) and (str(aphase) == str(phase)): ## phase added to ensure that if user runs both 21 and 24-nt PHAS in same directory, the files from different analysis are not picked up. 
             ### V1.14 and above all cluster file for p-values less then the used are picked up, because collapser uses
             ### files from all diffrent confodence levels. Also the matchThres for cluster and PHAS is increased to 0.99
             ### because now files for all confidence are available so cluster should match at high cutoff, reducing number
@@ -310,7 +449,9 @@ def prepare(pcutoff,libs,res_folder):
                 # print("----Filename:%s | Lib:%s | pval = %s" % (aclust,libs,pval))
                 afile = "%s/%s" % (args.dir,aclust)
                 combL.append(afile)
-                bcount +=1
+                if alib in libs_name:
+                    newcombL.append(afile)
+                    bcount +=1
     # print("--%s cluster files captured for concatanation" % (len(combL)))
     # print("There are files:",( [x.rpartition('/')[-1] for x in combL]))
 
@@ -318,6 +459,11 @@ def prepare(pcutoff,libs,res_folder):
     ###################################################
     aname       = "%s/ALL.%sPHAS_p%s_srna.cluster" % (res_folder,aphase,pcutoff) ### Out file name
     clustfile   = FileCombine(combL,aname)
+    if oldLibs:
+        bname       = "%s/NEW.%sPHAS_p%s_srna.cluster" % (res_folder,aphase,pcutoff)
+        newclustfile = FileCombine(newcombL,bname)
+    else:
+        newclustfile = None
 
     ### Sanity Check ##################################
     ###################################################
@@ -333,7 +479,7 @@ def prepare(pcutoff,libs,res_folder):
     print("--Working folder:%s | Temporary Folder:%s\n" % (res_folder,temp_folder))
     # sys.exit()
 
-    return temp_folder,clustfile
+    return temp_folder,selectL,clustfile,newclustfile
 
 def removeRedundant(temp_folder,p_val,fileType,overlapCutoff,pcutoff):
     """
@@ -674,6 +820,7 @@ def mergePHAS(aninput):
     ####################################################################
     alib    = "nd" ## Not determined in latest version of collapser v1.13 onwards, kept for future addition
     blib    = "nd"
+    chrid   = blist[0][2] if blist else "nd" ## chr/scaffold or trans for log, updated from alist below
     
     acount  =1
     for anent in alist:
@@ -730,6 +877,11 @@ def mergePHAS(aninput):
         #### Decide if entry is different enough to be added
         ####################################################
         
+        if not ratiodict:
+            ## No PHAS on this chr/scaffold or trans in first list - new loci
+            tmp_dict[newKey]=newValue
+            continue
+
         existKey = max(ratiodict,key=ratiodict.get)          ## Key from main_dict with max comparable ratio for current entry
         maxratio = ratiodict[existKey]                       ## Max ratio with the earlier phased locus
         # print("\n\n#####################")
@@ -806,7 +958,7 @@ def mergePHAS(aninput):
 
     return main_dict
 
-def writer_collapse(collapsedL,pcutoff):
+def writer_collapse(collapsedL,pcutoff,provD):
     '''
     Writes collapsed results - updated with v1.13 to handle chr/scaffold or trascript wise grouped results
     '''
@@ -835,7 +987,7 @@ def writer_collapse(collapsedL,pcutoff):
                     astart      = aphas[1][3]
                     aend        = aphas[1][4]
                     astrand     = "NONE"
-                    alib        = aphas[2]    
+                    alib        = provD.get(tuple(aphas[1]),aphas[2]) ## Library of origin
                     finalphasL.append((apval,achr,astart,aend,astrand,alib))
                     acount+=1
 
@@ -877,15 +1029,22 @@ def writer_collapse(collapsedL,pcutoff):
     # fh_out3.close()
     return outfile1,outfile2
 
-def listConverter(afile,pcutoff):
+def listConverter(aninput):
     '''
-    Parses phaster-core results file
+    Parses phaster-core results file - returns library name and PHAS list, run in parallel for all libraries.
+    Converted list is written to temp folder only if it's provided i.e. dumpTemp is ON
     '''
 
     print("\n#### Fn: listConvertor ####################")
 
+    afile,pcutoff,temp_folder = aninput
+    aname   = afile.rpartition('/')[-1]
+    alib    = aname.rsplit(".",7)[0]
     fh_in   = open(afile,'r')
-    fh_out  = open('%s_converted.list' % (afile.rpartition('.')[0]),'w')
+    if temp_folder:
+        fh_out  = open('%s/%s_converted.list' % (temp_folder,aname.rpartition('.')[0]),'w')
+    else:
+        fh_out  = None
     entries = fh_in.readlines()
 
     #### Prepare PHAS list
@@ -898,19 +1057,20 @@ def listConverter(afile,pcutoff):
             chromo,sep,start = chromo_start.rpartition(':')
             if float(pval) <= float(pcutoff):
                 if runType      == 'G':
-                    fh_out.write('%s\t%s\t%s\t%s\t%s\tNONE\tNONE\n' % (phase,pval,chromo.strip(),start,end)) ##Chromosome has space before it which later gives error while key matching
-                    alist.append((phase,pval,chromo.strip(),start,end))
+                    alist.append((phase,pval,chromo.strip(),start,end)) ##Chromosome has space before it which later gives error while key matching
                 elif runType    == 'T' or runType == 'S': ## Header has lots of stuff
-                    fh_out.write('%s\t%s\t%s\t%s\t%s\tNONE\tNONE\n' % (phase,pval,chromo.strip(),start,end)) ##Chromosome has space before it which later gives error while key matching
-                    alist.append((phase,pval,chromo.strip(),start,end))
+                    alist.append((phase,pval,chromo.strip(),start,end)) ##Chromosome has space before it which later gives error while key matching
                 else:
                     pass
     print("%s elements in PHAS list from %s file" % (len(alist),afile))
     
     fh_in.close()
-    fh_out.close()
+    if fh_out:
+        for ent in alist:
+            fh_out.write('%s\t%s\t%s\t%s\t%s\tNONE\tNONE\n' % ent)
+        fh_out.close()
     
-    return alist
+    return alib,alist
 
 def groupPHAS(PHASlist):
     '''
@@ -945,6 +1105,31 @@ def groupPHAS(PHASlist):
 
     return groupL
 
+def libMerge(convertL):
+    '''
+    Groups PHAS from all converted libraries on chr/scaffold or transcript and makes them non-redundant
+    in one parallel pool. Returns [(lib,dict of chr/scaffold or trans: PHAS list)] in same order as libs
+    '''
+    print("\n#### Fn: libMerge ####################")
+
+    groupInputs = [] ### chr/scaffold or transcript specific PHAS lists from all libs
+    groupLibs   = [] ### Library for each group, results from PPResults are in same order
+    libD        = {} ### Key: lib and value: dict of merged PHAS lists
+    for alib,alist in convertL:
+        libD[alib] = {}
+        for agrp in groupPHAS(alist):
+            groupInputs.append(agrp)
+            groupLibs.append(alib)
+
+    mergeL      = PPResults(selfMerge,groupInputs) ## PHAS list made non-redundant from diff conf. levels
+    for alib,(akey,aval) in zip(groupLibs,mergeL):
+        libD[alib][akey] = aval
+
+    libmergeL   = [(alib,libD[alib]) for alib,alist in convertL]
+    print("Libraries merged:%s | Groups merged:%s" % (len(libmergeL),len(mergeL)))
+
+    return libmergeL
+
 def selfMerge(dictitems):
     '''
     For each library remove redudant loci either from dfferent p-values or lengths. Input is chr/scaffold and transcript specific list
@@ -1229,12 +1414,25 @@ def PHASreader(coordsfile):
 
     return phasList,phashead
 
-def getClust(clustfile,phasList):
+def getClust(clustfile,phasList,clustD=None,newclustfile=None):
+    '''
+    Finds clusters matching PHAS - For PHAS in clustD i.e. unchanged from earlier collapsed set,
+    only clusters from new libraries (newclustfile) are searched and compared to the cached best cluster
+    '''
 
     print ("\n#### Fn: Cluster Search #########################")
     
+    if clustD is None:
+        clustD      = {}
     fh_in           = open(clustfile,'r')
     clusters        = fh_in.read().split('>')
+    fh_in.close()
+    if newclustfile:
+        fh_in       = open(newclustfile,'r')
+        newclusters = fh_in.read().split('>')
+        fh_in.close()
+    else:
+        newclusters = ['']
     
     resList         = [] ## Store final results as (phas,[(phasiRNA),(PhasiRNA)],[extra info])
     resList2        = [] ## Store phasiRNAs from all clusters as (phas,[(phasiRNA),(PhasiRNA)],[extra info])
@@ -1251,11 +1449,26 @@ def getClust(clustfile,phasList):
         phasCount +=1 
         print("%s/%s phasID" % (phasCount,len(phasList)))
 
+        if phasID in clustD:
+            ### Unchanged PHAS from earlier collapsed set - start from clusters matched in that run,
+            ### and search clusters from new libs only
+            cachedMatchList,cachedAllList = clustD[phasID]
+            finalMatchList      = list(cachedMatchList)
+            tempAllList         = list(cachedAllList[:-1])
+            cachedInfo          = cachedAllList[-1]
+            searchClusters      = newclusters
+            if runType == 'G':
+                get_chr_id = int(get_chr_id)
+            print("Cluster cached from earlier collapsed set, searching clusters from new libraries")
+        else:
+            finalMatchList      = []       ## Holds best cluster, from multiple libraries
+            tempAllList         = [] ## Hold phasiRNAs from all matching clusters, of use for phased transcripts to capture allphasiRNAs, must be used with low matchThres
+            cachedInfo          = None
+            searchClusters      = clusters
+
         ### Find matching cluster
         matchCount          = 0        ## Total maching clusters for a phased loci - if same cluster in multiple libraries
-        finalMatchList      = []       ## Holds best cluster, from multiple libraries
-        tempAllList         = [] ## Hold phasiRNAs from all matching clusters, of use for phased transcripts to capture allphasiRNAs, must be used with low matchThres
-        for aclust in clusters[1:]:
+        for aclust in searchClusters[1:]:
             tempMatchList   = [] ## To hold results of current matching cluster
             aclust_splt     = aclust.split('\n')
             header          = aclust_splt[0].split()
@@ -1357,21 +1570,23 @@ def getClust(clustfile,phasList):
                 # print("No Match with this cluster")
                 pass
 
-        tempAllList.append((bestkval,phasiSig,phasID,clust_id,sizeRatio)) ## This list has phasiRNAs from all clusters but to keep the structure same as original resList, helpful while writing results, this info is added
+        if cachedInfo and matchCount == 0:
+            tempAllList.append(cachedInfo) ## No new cluster matched, info from earlier collapsed set
+        else:
+            tempAllList.append((bestkval,phasiSig,phasID,clust_id,sizeRatio)) ## This list has phasiRNAs from all clusters but to keep the structure same as original resList, helpful while writing results, this info is added
 
         phasinfo = [aname,apval,get_chr_id,get_start,get_end,alib]
         resList2.append((phasID,tempAllList,phasinfo))
         resList.append((phasID,finalMatchList,phasinfo)) ## Add best matched cluster entry to the final list, there has to be one best matched entry per PHAS
         
         allMatchCount += matchCount ## Add the matched cluster for each entry
-        if matchCount > 0 :
+        if matchCount > 0 or cachedInfo:
             uniqMatchCount+=1
         
     print("\nTotal phas loci: %s | Matched: %s" % (len(phasList),len(resList)))
     print ("SUMMARY: Phased loci in input file:%s | Loci match threshold: %s |Uniq matched cluster: %s | Total matched clusters found:%s" % (phasCount,matchThres,uniqMatchCount,allMatchCount))
     print("NOTE: If matched clusters more then phased loci that means same cluster was present in different libs\n")
     # print("NOTE: Don't forget to uniq the miRNAs")
-    fh_in.close()
 
     return resList,resList2
 
@@ -1431,7 +1646,7 @@ def allphasiWriter(clustfile,resList):
 
     return outfile
 
-def writer_summ(clustfile,resList,dictList,pcutoff):
+def writer_summ(clustfile,resList,tagIndex,tagMatrix,pcutoff):
     '''
     write the results
     '''
@@ -1448,7 +1663,7 @@ def writer_summ(clustfile,resList,dictList,pcutoff):
         fh_out2.write("Name\tP-val\tChr\tStart\tEnd\tIdentifier\tBest k-val\tPhasi ratio\t Max Tag Ratio\t%s\tTotal Phasi Abundance\tMost Abun Tag (MAT)\t MAT Abun\tMAT2\tMAT2 Abun\tBestLib\n" % ('\t'.join(x for x in libsHead)))
         # print(queryLibs) ## Libs whose abindance will be summed to give final abundance of tags
         abunList    = [] ### List to capture tags and abundance for each phased loci
-        libAbunList = [] ## Lib-wise abundances of tag
+        queryL      = [] ## Tags for which lib-wise abundances are fetched from tag count matrix
 
     print("Writing:")
     print("--PhasiRNAs extended CSV file")
@@ -1490,26 +1705,20 @@ def writer_summ(clustfile,resList,dictList,pcutoff):
                         pass
 
 
-                ## Get max abundance phasiRNA for specified phase
+                ## Queue tags for lib-wise abundances, fetched for whole loci at once below
                 if fetchMax == 1:
 
                     ## Get lib-wise abundaces mode
                     if fetchLibAbun == 0:
                         if len(tag) == int(phase):
-                            atag,abun_sum,lib_abun = getAbundanceLocal(tag,dictList)
-                            libAbunList.append((lib_abun))
+                            queryL.append(tag)
 
                     elif fetchLibAbun == 1: ## All the tags
-                        atag,abun_sum,lib_abun = getAbundanceLocal(tag,dictList)
-                        libAbunList.append((lib_abun))
+                        queryL.append(tag)
                     
                     else:
                         print("Libwise abundances won't be fetched")
                         pass
-
-                    ## Tag specific abundances for fetching most abundant tag
-                    if len(tag) == int(phase): ### Size specified in settings
-                            abunList.append((atag,abun_sum))
             else:
                 print("Tag recorded once already#####################################\n")
                 # sys.exit()
@@ -1523,6 +1732,13 @@ def writer_summ(clustfile,resList,dictList,pcutoff):
         ## Process Fetch max results for this phased loci
         #################
         if fetchMax == 1:
+
+            ## Lib-wise abundances for all queried tags of this loci in one lookup
+            abunSums,libAbunM = getAbundanceLocal(queryL,tagIndex,tagMatrix)
+            for atag,abun_sum in zip(queryL,abunSums.tolist()):
+                ## Tag specific abundances for fetching most abundant tag
+                if len(atag) == int(phase): ### Size specified in settings
+                    abunList.append((atag,abun_sum))
             
             abunList_sort = sorted(abunList, key=operator.itemgetter(1),reverse=True) ## Sort list on abundances to get max abundant phasiRNA
             # print("\nExample sorted values:%s" % (abunList_sort[0:10]))
@@ -1542,10 +1758,7 @@ def writer_summ(clustfile,resList,dictList,pcutoff):
 
 
             ## Sum Lib-wise abundances for all tags
-            libAbunSum = [0]*len(libAbunList[0]) ## This will hold sum of all tags, intialized for number of libraries
-            for tag in libAbunList:
-                # print(tag)
-                libAbunSum  = [sum(x) for x in zip(libAbunSum,tag)]
+            libAbunSum = libAbunM.sum(axis=0).tolist() ## Column sums i.e. sum of all tags for each library
             
             # print("Tag:%s | maxPhasTag:%s | totalPhasAbun:%s" % (maxTag,maxAbun,totalAbun))
             # print("Libwise Abundances",libAbunSum)
@@ -1553,7 +1766,7 @@ def writer_summ(clustfile,resList,dictList,pcutoff):
             ## Write - Loci, most abundant tag, most abundant tag abun,total phased abun, number of phased tags, and lib-wise abundances
             fh_out2.write("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % ('\t'.join(str(x) for x in phasinfo[:-1]),phasID,str(phasCycles),sizeRatio,maxTagRatio,'\t'.join(str(x) for x in libAbunSum),totalAbun,maxTag,maxAbun,maxTag2,maxAbun2,phasinfo[-1]))
             abunList    = [] ## Empty before next phased loci
-            libAbunList = [] ## Empty lib-iwse abundances of tag list before next entry
+            queryL      = [] ## Empty queried tags list before next entry
             # sys.exit()
 
     fh_out.close()
@@ -1561,40 +1774,38 @@ def writer_summ(clustfile,resList,dictList,pcutoff):
 
     return outfile,outfile2
 
-def getAbundanceLocal(tag,dictList):
-    """The core function for getting the abunance from a single tag
-    from a series of libraries provided in tag count format. Makes
-    the calls to create the data structures to get the abundance of
-    a tag across several libraries
+def getAbundanceLocal(tagL,tagIndex,tagMatrix):
+    """Gets the abundances of a set of tags, usually all phasiRNAs
+    of a loci, across all libraries from the tag count matrix. Lookup
+    is vectorized over tags i.e. a single binary search for the set
 
     Args:
-        tag: Sequence to search the libraries for
-        tagCountFilenamesList: The names of all libraries
+        tagL: Sequences to search the libraries for
+        tagIndex: Sorted array of all tags, row index for tagMatrix
+        tagMatrix: Abundance matrix (tags x libs) from abunMatrix
     Returns:
-        The input tag, abundance in all libraries, and the sum of 
-        abundance across all libraries. 
+        Sum of abundance across all libraries for each tag, and 
+        a matrix of individual library abundances (tags x libs) 
+        in the same order as input tags. Missing tags get 0
     
     """
-    # Initialize a list for the abundance results
-    tagAbunList = []
-    # Search for the tag in all libraries
-    for dict in dictList:
-        tagAbunList.append(getAbunFromDict(dict, tag))
-
-    # The dictionaries may not be sorted in the given order, so sort them
-    # according to the key (that being the index returned by getAbunFromDict)
-    # print("\nTag:",tag)
-    # print("Unsorted:",tagAbunList)
-    sortedTagAbunList = sorted(tagAbunList, key=operator.itemgetter(0),
-        reverse = False)
-    # print("Sorted:",sortedTagAbunList)
-
-    # Store just the abundances for return
-    abunList = []
-    for abun in sortedTagAbunList:
-        abunList.append(abun[1])
-
-    return(tag,sum(abunList),abunList)
+    import numpy as np
+    nlibs       = tagMatrix.shape[1]
+    libAbunM    = np.zeros((len(tagL),nlibs),dtype=np.int64)
+    if not tagL or len(tagIndex) == 0:
+        return libAbunM.sum(axis=1),libAbunM
+
+    ## Find rows - tags longer than index width can't be in index,
+    ## these are masked as these get truncated while converting to array
+    query       = np.array(tagL,dtype=tagIndex.dtype)
+    fits        = np.array([len(x) <= tagIndex.itemsize for x in tagL])
+    rows        = np.searchsorted(tagIndex,query)
+    rows        = np.minimum(rows,len(tagIndex)-1)
+    found       = (tagIndex[rows] == query) & fits
+
+    libAbunM[found] = tagMatrix[rows[found]]
+
+    return libAbunM.sum(axis=1),libAbunM
 
 def getAbundance(cur,tag,finalLibs):
     '''Input is tag for each loci and out put is tag with maximmum abumdance and sum of phasiRNAs - 
@@ -1721,71 +1932,116 @@ def cleaner():
 
     return None
 
-def readFileToDict(index):
-    """This function simply reads all tags in a tag count file
-       and stores them in a dictionary
+def tagReader(afile):
+    """Reads all tags in a tag count file to arrays
 
     Args:
-        filename: The name of an individual file to read
-        index: A numberical index for the order that the results should
-               eventually be provided
+        afile: The name of an individual file to read
     Returns:
-        Dictionary of the read file
+        Array of tags and array of their abundances
 
     """
-
-    filename = libs[index]
-    print("Caching %s to fetch phasiRNA abundances" % (filename))
-
-    # Initialize an empty dictionary for the results
-    # Use the index as a key to the dictionary so that the file
-    # can be associated with this dictionary later
-    fileDict = {index: {}}
-
-    # Read through the file and store the tag count file into 
-    # the dictionary
-    with open(filename) as f:
+    import numpy as np
+    tagL    = []
+    abunL   = []
+    with open(afile) as f:
         for line in f:
             # tag and abundance should be separated by a tab. Strip
             # the new line at the end of each line
             tag, abun = line.strip('\n').split('\t')
+            tagL.append(tag.strip())
+            abunL.append(int(abun.strip()))
+
+    tags    = np.array(tagL,dtype=bytes)
+    abuns   = np.array(abunL,dtype=np.int32)
 
-            # Remove any white space that is inadvertently left
-            tag = tag.strip()
-            abun = abun.strip()
+    return tags,abuns
 
-            # Store the 
-            fileDict[index][tag] = int(abun)
+def tagUniq(index):
+    """Unique sorted tags from a library - used to make shared tag index"""
+    import numpy as np
 
-    f.closed
+    filename = libs[index]
+    print("Caching %s to index phasiRNA abundances" % (filename))
+    tags,abuns = tagReader(filename)
 
-    return(fileDict)
+    return np.unique(tags)
 
-def getAbunFromDict(dict, tag):
-    """Get the abundance of the tag from a dictionary
+def tagColumn(aninput):
+    """Fills the column of a library in tag count matrix (memory-mapped)
 
     Args:
-        tag: The tag to be queried from the dictionary
-        dict: The dictionary of tags and their abundances in ech library
-        libList: The list of libraries as provided by the user
+        aninput: index of library, tag index file and matrix file
     Returns:
-        Three separate elements. The first is the tag, the second
-        is the summed abundance across all libraries, and the final
-        is a list of the individual library abundances
+        index of library
 
     """
+    import numpy as np
+    index,indexFile,matrixFile = aninput
+    filename    = libs[index]
+    tags,abuns  = tagReader(filename)
+
+    tagIndex    = np.load(indexFile,mmap_mode='r')
+    tagMatrix   = np.load(matrixFile,mmap_mode='r+')
+    rows        = np.searchsorted(tagIndex,tags) ## All tags are present in index
+    tagMatrix[rows,index] = abuns
+    tagMatrix.flush()
+    print("Abundances for %s added to tag count matrix" % (filename))
+
+    return index
 
-    # Pull the library index from the dictionary
-    index = list(dict.keys())[0]
+def abunMatrix(libs):
+    """Prepares a shared tag index and NumPy abundance matrix (tags x libs)
+    for all libraries. Both are saved as .npy files and memory-mapped, and
+    reused from earlier runs if libraries are unchanged (see matrixCache)
 
-    # Try to abundance of tag. If it doesn't exist in this library,
-    # return 0 for the abundance
-    try:
-        return([index, dict[index][tag]])
+    Args:
+        libs: The names of all libraries
+    Returns:
+        Sorted tag array (row index) and abundance matrix
 
-    # Tag doesn't exist in this dictionary so return 0
-    except KeyError:
-        return([index,0])
+    """
+    import numpy as np ## Imported here and not at top, so that checkDependency can report if numpy is missing
+    print("\n#### Fn: abunMatrix ##################")
+
+    ### Key for libraries - names, sizes and modification time
+    libinfo     = ",".join("%s:%s:%s" % (x,os.path.getsize(x),int(os.path.getmtime(x))) for x in libs)
+    libkey      = hashlib.md5(libinfo.encode()).hexdigest()[:10]
+    indexFile   = "tagindex_%s.npy"  % (libkey)
+    matrixFile  = "tagmatrix_%s.npy" % (libkey)
+
+    if matrixCache == 1 and os.path.isfile(indexFile) and os.path.isfile(matrixFile):
+        print("Tag count matrix from earlier run found and will be reused:%s" % (matrixFile))
+    
+    else:
+        ## Shared tag index from all libs
+        indexList   = list(range(len(libs)))
+        tagIndex    = np.array([],dtype=bytes)
+        npool       = Pool(int(nproc))
+        for atags in npool.imap(tagUniq,indexList):
+            tagIndex = np.union1d(tagIndex,atags)
+        npool.close()
+        print("Unique tags from %s libs:%s" % (len(libs),len(tagIndex)))
+
+        ## Index and matrix are made as temp files and renamed when complete, so that
+        ## a partly filled matrix from an interrupted run is never reused
+        tmpIndex    = "tagindex_%s.%s.npy"  % (libkey,os.getpid())
+        tmpMatrix   = "tagmatrix_%s.%s.npy" % (libkey,os.getpid())
+        np.save(tmpIndex,tagIndex)
+
+        ## Empty matrix on disk, filled lib-wise in parallel
+        tagMatrix   = np.lib.format.open_memmap(tmpMatrix,mode='w+',dtype=np.int32,shape=(len(tagIndex),len(libs)))
+        del tagMatrix
+        rawInputs   = [(x,tmpIndex,tmpMatrix) for x in indexList]
+        PPResults(tagColumn,rawInputs)
+        os.replace(tmpIndex,indexFile)
+        os.replace(tmpMatrix,matrixFile)    ### Only complete matrix is cached
+
+    tagIndex    = np.load(indexFile,mmap_mode='r')
+    tagMatrix   = np.load(matrixFile,mmap_mode='r')
+    print("Tag count matrix:%s | Tags:%s | Libs:%s" % (matrixFile,tagMatrix.shape[0],tagMatrix.shape[1]))
+
+    return tagIndex,tagMatrix
 
 def PPResults(module,alist):
     npool = Pool(int(nproc))
@@ -1804,9 +2060,35 @@ def percentile(data, percentile):
 def main():
 
     ### Collapser #########################################
+    checkDependency()
+    global libs
     libs    = readSet(setFile)
+
+    ### Earlier collapsed set for incremental mode, only new libs are collapsed
+    if args.add:
+        stateD      = readState(args.add)
+        stateLibs   = [x[0] for x in stateD['libs']]
+        newLibs     = [x for x in libs if x not in stateLibs]
+        if not newLibs:
+            print("** All libraries in 'phaser.set' are already in earlier collapsed set:%s" % (args.add))
+            print("** Nothing to add - script exiting...\n")
+            sys.exit()
+        if not args.pval:
+            args.pval = str(stateD['pval'])
+        print("New libraries to add:%s" % (", ".join(newLibs)))
+    else:
+        stateD      = None
+        stateLibs   = []
+        newLibs     = libs
+
     pcutoff = pvaluereader()
-    temp_folder,clustfile = prepare(pcutoff,libs,res_folder)
+    if stateD and float(pcutoff) != float(stateD['pval']):
+        print("** p-value cutoff %s is different from earlier collapsed set (%s)" % (pcutoff,stateD['pval']))
+        print("** Same cutoff is required to merge - Use '-pval %s' or collapse all libraries again" % (stateD['pval']))
+        sys.exit()
+
+    temp_folder,listL,clustfile,newclustfile = prepare(pcutoff,newLibs,res_folder,stateLibs)
+    libs    = stateLibs+newLibs ## All libs for lib-wise abundances
 
     #### Write to memeory
     fh_mem = open("%s/%s" % (res_folder,memFile),'w')
@@ -1819,41 +2101,45 @@ def main():
     else:
         overlapCutoff = 0.25 ## = 0.25 for genomic and 0.50 for ncRNAs
 
+    provD = {} ## Library of origin for PHAS
     if fileType == 'L':
         print('\nList files selected for analysis - Converting them to readable format')
-        fls     = glob.glob(r'%s/*.PARE.validation.list' % (temp_folder))
+        fls     = [x for x in listL if x.endswith('.PARE.validation.list')]
         print ('Here are the files that will be converted:',fls,'\n')
         print ('Total files to analyze: %s' % (len(fls)))
 
-        ### Prepare first file for comaprision
-        firstfile   = fls[0]
-        firstlist   = listConverter(firstfile,pcutoff)                          ## List of PHAS from file
-        firstgrps   = groupPHAS(firstlist)                              ## PHAS list grouped on chr/scaffold or transcripts
-
-        # #### Test - serial
-        # firstmergeL = []
-        # for i in firstgrps:
-        #     # print("## Group",i)
-        #     akey,aval = selfMerge(i) ### Provides a merged list of PHAS for chr/scaffold and Trans
-        #     firstmergeL.append((akey,aval))
-
-        ### Parallel mode
-        firstmergeL= PPResults(selfMerge,firstgrps)                     ## PHAS list made non-redundant from diff conf. levels
-        firstmergeD= dict((i[0], i[1]) for i in firstmergeL)            ## Dict. of PHAS list based on chr/scaffold and trans
-        collapsedL = listTocollapsed(firstmergeL)                             ## Collapsed list format incase there is just one library
+        ### Convert and self-merge all files in parallel, PHAS lists are passed in memory
+        rawInputs   = [(afile,pcutoff,temp_folder) for afile in fls]
+        convertL    = PPResults(listConverter,rawInputs)                ## List of PHAS from each file
+        libmergeL   = libMerge(convertL)                                ## PHAS list made non-redundant from diff conf. levels, grouped on chr/scaffold and trans
+
+        ### Library of origin for PHAS
+        for alib,amergeD in libmergeL:
+            for aphasL in amergeD.values():
+                for aphas in aphasL:
+                    provD.setdefault(tuple(aphas),alib)
+
+        if stateD:
+            ### Earlier collapsed set is the first list, all new files are compared to it
+            collapsedL,stateprovD = stateToCollapsed(stateD)
+            provD.update(stateprovD)
+            compareflag = True
+            addL        = libmergeL
+            flcount     = 1
+        else:
+            ### Prepare first file for comaprision
+            firstlib,firstmergeD = libmergeL[0]                         ## Dict. of PHAS list based on chr/scaffold and trans
+            collapsedL  = listTocollapsed(list(firstmergeD.items()))    ## Collapsed list format incase there is just one library
+            compareflag = False     ## Flag used to decide if it comaprision between first two files or afile and collapsed list
+            addL        = libmergeL[1:]
+            flcount     = 2         ## Two files are comapred in first loop so count starts from 2 
 
         ### Start the comparision
-        compareflag = False     ## Flag used to decide if it comaprision between first two files or afile and collapsed list
         totalfls    = len(fls)
-        flcount     = 2         ## Two files are comapred in first loop so count starts from 2 
-        for fl in fls[1:]:
+        for fllib,flmergeD in addL:
             ## Prepare chr/scaffold/transcrpt specific dict of PHAS
             print("\n#### Comparing %s/%s file" % (flcount,totalfls))
-            print("#### File being compared:%s" % (fl))
-            fllist          = listConverter(fl,pcutoff)                         ## List of PHAS from file
-            flgrps          = groupPHAS(fllist)                         ## PHAS list grouped on chr/scaffold or transcripts
-            flmergeL        = PPResults(selfMerge,firstgrps)            ## PHAS list made non-redundant from diff conf. levels
-            flmergeD        = dict((i[0], i[1]) for i in firstmergeL)   ## Dict. of PHAS list based on chr/scaffold and trans
+            print("#### Library being compared:%s" % (fllib))
 
             if compareflag == False:
                 ## No comparision made yet this is the first and uses list directly from files
@@ -1889,7 +2175,7 @@ def main():
         sys.exit()
         # main_dict = removeRedundant(temp_folder,pcutoff,fileType,overlapCutoff)
     
-    collapsedfile,collapsedLfile = writer_collapse(collapsedL,pcutoff)
+    collapsedfile,collapsedLfile = writer_collapse(collapsedL,pcutoff,provD)
     fh_mem.write("@collapsedfile:%s\n" % (collapsedfile))
     fh_mem.write("@collapsedlist:%s\n" % (collapsedLfile))
 
@@ -1900,23 +2186,28 @@ def main():
     phasList,phashead = PHASreader(collapsedfile)
     time.sleep(1)
 
-    ## Get the clusters
-    resList,resList2 = getClust(clustfile,phasList)
+    ## Get the clusters - for '--add' mode, PHAS from earlier set are searched only against clusters of new libs
+    if stateD:
+        resList,resList2 = getClust(clustfile,phasList,stateD['clusters'],newclustfile)
+    else:
+        resList,resList2 = getClust(clustfile,phasList)
     if runType == 'T' or runType == 'S':
         allphasiFile = allphasiWriter(clustfile,resList2)
     else:
         print("File with all PHAS will not be generated for this 'runType'")
         pass
 
-    ## Prepare dictionary of tag count files for abundance queries
-    dictList    = []
-    indexList   = list(range(len(libs)))
-    dictList    = PPResults(readFileToDict, indexList)
+    ## Prepare tag count matrix of libraries for abundance queries
+    tagIndex,tagMatrix = abunMatrix(libs)
 
     ## Write the summary
-    phasifile,summaryfile = writer_summ(clustfile,resList,dictList,pcutoff)
+    phasifile,summaryfile = writer_summ(clustfile,resList,tagIndex,tagMatrix,pcutoff)
     fh_mem.write("@summaryfile:%s\n"    % (summaryfile))
     fh_mem.write("@phasifile:%s\n"      % (phasifile))
+
+    ## Collapsed state for adding libraries later
+    statefile = writeState(libs,listL,collapsedL,provD,resList,resList2,pcutoff,stateD)
+    fh_mem.write("@statefile:%s\n"      % (statefile))
     fh_mem.close()
 
     ### Prepare for revFerno and cleanup unwanted files
@@ -2041,6 +2332,19 @@ if __name__ == '__main__':
 #### If this pcutoff is below recommneded confidence level then best available p-value is recommended
 ## MAde changes to accomodate pcutoff instead of default argument (1e-05) which is now empty 
 
+## v1.21 -> v1.22
+## Lib-wise abundances now fetched from a shared tag index and NumPy int32 abundance matrix (tags x libs) instead of
+#### one dict per library. Matrix is built once in parallel, memory-mapped from disk and reused if libs are unchanged
+## getAbundanceLocal is vectorized over all phasiRNAs of a loci
+## listConverter and self-merge of all libraries run concurrently in one pool and hand over PHAS lists in memory, list
+#### files are read directly from phaser folder; *converted.list files are written to temp folder only if dumpTemp is ON
+## Fixed later libraries being compared using PHAS from first library - flmergeD was built from firstmergeL
+#### and mergePHAS to handle chr/scaffold or trans with PHAS in only one of the two lists
+## Added '--add' mode to merge new libraries into collapsed set from an earlier run. Collapsed PHAS, lib of origin,
+#### lib info and matched clusters are saved to 'collapser.state'; new libs are merged to it with same redundancy
+#### rules. New or updated PHAS are searched against clusters of all libs, PHAS from earlier set only against clusters
+#### of new libs and compared to cached best cluster. 'Lib' column now reports lib of origin
+
 
 
 ## Script generates an error at final exit() in __main__
@@ -106,6 +106,17 @@ else
   rm phasclust.MUL.v2.pl
 fi
 
+if [ ! -f ./phasclust.py ]
+then
+  printf "phaster-core source not found in current directory\n"
+  printf "Please check that you downloaded complete archive\n"
+  printf "Download complete package and rerun script\n\n"
+  exit 1
+else
+  cp phasclust.py ~/phaster
+  rm phasclust.py
+fi
+
 if [ ! -f ./sPARTA.py ]
 then
   printf "sPARTA source not found in current directory\n"
@@ -145,4 +156,5 @@ exit 1
 ## V1.0 -> v1.01
 ## Edited names of phasTER-core scripts
 ## v1.01 -> v1.02
-## Added sPARTA script
\ No newline at end of file
+## Added sPARTA script
+## Added python engine for phaster-core (phasclust.py)
\ No newline at end of file
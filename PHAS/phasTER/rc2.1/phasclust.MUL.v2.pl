@@ -32,7 +32,7 @@ Ptime("start...");
 no 5.12;
 my %sum = ();
 GetOptions(my $options = {},
-              "-i=s","-f=s","-d=s","-v=i","-o=s","-rl=s","-s=s","-p=s","-cpu=i","-px=s","-n=i","-g=i","-t=i","-ht=i","-q=s","-k=i"#"-z=s",
+              "-i=s","-f=s","-d=s","-v=i","-o=s","-rl=s","-s=s","-p=s","-cpu=i","-px=s","-n=i","-g=i","-t=i","-ht=i","-q=s","-k=i","-b=s"#"-z=s",
 );
 ########### USAGE ##############
 my $USAGE = <<USAGE;
@@ -51,6 +51,7 @@ Usage and Arguments:
 
     optional:
         -k        bowtie alignment hits report, default = all
+        -b        bowtie alignment of the sRNA input, if given sRNAs are not aligned again
         -q        degradome or PARE data in ONLY tagcount format: seq   abundance
         -m        mismatches for both the sRNA and PARE/degradome alignment by bowtie, default = 0
         -p        p-value in decimal number, defult = 0.005;
@@ -99,7 +100,7 @@ my %miscandidate = ();
 push(@temp_files,$prefix.".".$bowtie_output);
 # -----------tag count processing if the input is tagcount---------------
 my $t_i = 0;
-if ($options->{f} =~ /t/i) {
+if ($options->{f} =~ /t/i and !defined $options->{b}) {
 	my $fasta_file = generate_rand_filename(11);
 	push(@temp_files,$fasta_file);
 	
@@ -123,12 +124,19 @@ Ptime("aligning...");
 Ptime("script version is $version..");
 my @parameters = join(" ", "-f",  "-a -v $mm","-m 45", "-p $cpu", "$options->{d}", "$input", " >$prefix.$bowtie_output");
 
-my @bowtie_out = system("bowtie @parameters");
-Ptime("aligning is done");
+my $align_file = "$prefix.$bowtie_output";
+if (defined $options->{b}) {
+	$align_file = $options->{b};
+	Ptime("using existing alignment $align_file");
+}
+else {
+	my @bowtie_out = system("bowtie @parameters");
+	Ptime("aligning is done");
+}
 
 #put all the signature and their information into the HASH %sh
 #--------bowtie out put pre processing, organized as the position, deposited into the HASH, MYSQL processing will be better with lowere RAM requirement-------------------
-open(DATA, "$prefix.$bowtie_output") || die "Cannot open the bowtie outputed DATA";
+open(DATA, $align_file) || die "Cannot open the bowtie outputed DATA";
 while(my $line=<DATA>) {# input small RNA mapping data
         chomp $line;
         my ($seqid, $strand, $target, $pos,  $seq, @other)=split(/\t/, $line);
@@ -34,7 +34,7 @@ no 5.12;
 my %sum = ();
 
 GetOptions(my $options = {},
-              "-i=s","-f=s","-d=s","-p=s","-cpu=i","-rl=s","-px=s","-n=i","-g=i","-t=i","-ht=i","-q=s","-k=i"#"-o=s","-s=s","-a=s",
+              "-i=s","-f=s","-d=s","-p=s","-cpu=i","-rl=s","-px=s","-n=i","-g=i","-t=i","-ht=i","-q=s","-k=i","-b=s"#"-o=s","-s=s","-a=s",
 );
 ########### USAGE ##############
 my $USAGE = <<USAGE;
@@ -53,6 +53,7 @@ Arguments:
 
     optional:
         -k        bowtie alignment hits report, default = all
+        -b        bowtie alignment of the sRNA input, if given sRNAs are not aligned again
         -q        degradome or PARE data in ONLY tagcount format
         -m        mismatches for both the sRNA and PARE/degradome alignment by bowtie, default = 0
         -p        p-value in decimal number, defult = 0.005;
@@ -106,7 +107,7 @@ my %candidate_vague = ();
 push(@temp_files,$prefix.".".$bowtie_output);
 # -----------tag count processing if the input is tagcount---------------
 my $t_i = 0;
-if ($options->{f} =~ /t/i) {
+if ($options->{f} =~ /t/i and !defined $options->{b}) {
 	my $fasta_file = generate_rand_filename(11);
 	push(@temp_files,$fasta_file);
 	
@@ -131,12 +132,19 @@ Ptime("script version is $version..");
 # my @parameters = join(" ", "-f",  "$k -n $mm", "-p $cpu", "$options->{d}", "$input", " >$prefix.$bowtie_output"); ### Old-mode increases in mapped reads by 4% as these are filtered by -m criteria in new mode below
 my @parameters = join(" ", "-f",  "-a -v $mm", "-m 12" ,"-p $cpu", "$options->{d}", "$input", " >$prefix.$bowtie_output"); ### Faster Mode and removes multimappers
 # print @parameters;
-my @bowtie_out = system("bowtie @parameters");
-Ptime("aligning is done");
+my $align_file = "$prefix.$bowtie_output";
+if (defined $options->{b}) {
+	$align_file = $options->{b};
+	Ptime("using existing alignment $align_file");
+}
+else {
+	my @bowtie_out = system("bowtie @parameters");
+	Ptime("aligning is done");
+}
 
 #put all the signature and their information into the HASH %sh
 #--------bowtie out put pre processing -------------------
-open(DATA, "$prefix.$bowtie_output") || die "Cannot open the bowtie outputed DATA";
+open(DATA, $align_file) || die "Cannot open the bowtie outputed DATA";
 while(my $line=<DATA>) {# input small RNA mapping data
 	chomp $line;
 	my ($seqid, $strand, $target, $pos,  $seq, @other)=split(/\t/, $line);
@@ -0,0 +1,483 @@
+#!/usr/local/bin/python3
+
+## phasclust: identifies phased siRNA clusters - python engine for phaster-core
+## Updated: version-v1.01
+## Property of Meyers Lab at University of Delaware
+## Scoring (n, k, hypergeometric p-value), clustering and outputs follow phasclust.genome.v2.pl and
+## phasclust.MUL.v2.pl, so that phaser results from either engine can be used by collapser
+
+#### FUNCTIONS ###########################################
+
+import os,sys,time,datetime,subprocess,argparse,random,string,re,collections
+import numpy as np
+
+#### SETTINGS ############################################
+
+cutArrange      = (5e-3,1e-3,5e-4,1e-4,5e-5,1e-5,5e-6,1e-6,5e-7,1e-7) ## p-value cutoffs for clusters
+phaseWin        = 11                                                    ## Number of phase positions in a window
+splitGap        = 400                                                   ## Gap (nt) to pre-split sRNA clusters before scoring
+minSplit        = {'G':9,'MUL':3}                                       ## Minimum sRNAs in a pre-split cluster to be scored - genome (G) and scaffolds/transcripts mode
+bowtieMul       = {'G':"12",'MUL':"45"}                                 ## Maximum hits for a read to be reported by bowtie
+version         = "1"                                                   ## Version in summary file name, as phaster-core
+
+#############################################################
+
+def phasArgs(argv=None):
+    '''
+    Arguments - same as phaster-core scripts
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i',   required=True,  help='sRNA input file name')
+    parser.add_argument('-f',   required=True,  help='[t] for tagcount, [f] for fasta')
+    parser.add_argument('-d',   required=True,  help='bowtie index of reference')
+    parser.add_argument('-rl',  required=True,  help='register length(s), comma separated like 21,24')
+    parser.add_argument('-px',  required=True,  help='prefix of all output files')
+    parser.add_argument('-runType', default='G', help='G: genome | S: scaffolds | T: transcripts')
+    parser.add_argument('-p',   type=float, default=0.005,  help='p-value cutoff for scored sRNAs')
+    parser.add_argument('-cpu', type=int,   default=2,      help='threads for bowtie')
+    parser.add_argument('-m',   type=int,   default=0,      help='mismatches for bowtie')
+    parser.add_argument('-n',   type=int,   default=1,      help='noise - sRNAs with abundance less or equal are not scored')
+    parser.add_argument('-g',   type=int,   default=300,    help='gap between two separate clusters')
+    parser.add_argument('-t',   type=float, default=85,     help='minimal proportion of register sized sRNA abundance in cluster')
+    parser.add_argument('-ht',  type=float, default=10,     help='maximal average hits of sRNAs in cluster')
+    parser.add_argument('-q',   default=None,   help='degradome - not used by this engine')
+    parser.add_argument('-b',   default=None,   help='bowtie alignment of the sRNA input, if given sRNAs are not aligned again')
+    parser.add_argument('-bench', default=None, help='phaster-core perl script - runs both engines and compares runtime and outputs')
+
+    return parser.parse_args(argv)
+
+def randName(alen):
+    '''
+    Random name for temporary files
+    '''
+    return ''.join(random.choice(string.ascii_letters+string.digits+'_') for x in range(alen))
+
+def tagToFASTA(lib,prefix):
+    '''
+    Converts tag count file to FASTA with abundance in header, as phaster-core
+    '''
+    fastaFile   = "%s.%s" % (prefix,randName(11))
+    fh_in       = open(lib,'r')
+    fh_out      = open(fastaFile,'w')
+    acount      = 0
+    for line in fh_in:
+        ent = line.split()
+        if not ent:
+            continue
+        acount += 1
+        fh_out.write(">seq_%s|%s\n%s\n" % (acount,ent[1],ent[0]))
+    fh_in.close()
+    fh_out.close()
+
+    return fastaFile
+
+def mapLib(lib,aformat,index,runType,cpu,mismat,prefix):
+    '''
+    Maps library to reference with bowtie, settings same as phaster-core
+    '''
+    print("\n#### Fn: mapLib ##########################")
+    tempL   = []
+    if aformat.lower() == 't':
+        lib = tagToFASTA(lib,prefix)
+        tempL.append(lib)
+
+    alignFile   = "%s.%s" % (prefix,randName(11))
+    acmd        = ["bowtie","-f","-a","-v",str(mismat),"-m",bowtieMul['G' if runType == 'G' else 'MUL'],"-p",str(cpu),index,lib]
+    print("Aligning:%s" % (lib))
+    fh_out      = open(alignFile,'w')
+    retcode     = subprocess.call(acmd,stdout=fh_out)
+    fh_out.close()
+    if retcode != 0:
+        print("** bowtie failed for %s - Return code not 0" % (lib))
+        sys.exit(1)
+
+    return alignFile,tempL
+
+def readAlign(alignFile,runType,noise):
+    '''
+    Reads bowtie alignments - total mapped abundance and hits for all reads, and sRNAs
+    above noise with position and sequence on the strand of sRNA
+    '''
+    print("\n#### Fn: readAlign #######################")
+    abunRe      = re.compile(r"\|(\d+)|abun_(\d+)")
+    chrRe       = re.compile(r"(\d+)")
+    revTable    = str.maketrans('ATCGN','TAGCN')
+
+    hitsD       = collections.Counter()     ## Hits for each read
+    total       = 0                         ## Total abundance of mapped reads, noise included
+    recL        = []                        ## (chr,pos,strand,seqid,seq,abun)
+    fh_in       = open(alignFile,'r')
+    for line in fh_in:
+        ent                         = line.rstrip('\n').split('\t')
+        seqid,strand,target,pos,seq = ent[:5]
+        amatch                      = abunRe.search(seqid)
+        if not amatch:
+            print("** Abundance could not be located in read name:%s" % (seqid))
+            sys.exit(1)
+        abun = int(amatch.group(1) or amatch.group(2))
+
+        if seqid not in hitsD:
+            total += abun
+        hitsD[seqid] += 1
+
+        if abun <= noise:
+            continue
+
+        pos = int(pos)
+        if strand == '+':
+            pos += 1
+        else:
+            pos += len(seq)
+            seq = seq[::-1].translate(revTable)
+
+        if runType == 'G':
+            amatch = chrRe.search(target)
+            if not amatch:
+                print("** Chromosome is not named as number:%s" % (target))
+                sys.exit(1)
+            chrid = int(amatch.group(1))
+        else:
+            chrid = target
+        recL.append((chrid,pos,strand,seqid,seq,abun))
+    fh_in.close()
+    print("Alignments read:%s | Reads above noise:%s | Total mapped abundance:%s" % (sum(hitsD.values()),len(recL),total))
+
+    return recL,hitsD,total
+
+def preSplit(recL,runType):
+    '''
+    Splits sRNAs into clusters on 'splitGap', sRNAs from clusters with atleast 'minSplit' sRNAs are scored
+    '''
+    print("\n#### Fn: preSplit ########################")
+    recL.sort(key=lambda x: (x[0],x[1]))    ## Stable - input order kept within position
+    chrD        = collections.OrderedDict() ## Scored sRNAs for each chromosome
+    aclust      = []
+    nclust      = 0
+    for arec in recL:
+        if aclust and (arec[0] != aclust[-1][0] or arec[1] - splitGap > aclust[-1][1]):
+            if len(aclust) >= minSplit['G' if runType == 'G' else 'MUL']:
+                chrD.setdefault(aclust[0][0],[]).extend(aclust)
+                nclust += 1
+            aclust = []
+        aclust.append(arec)
+    if len(aclust) >= minSplit['G' if runType == 'G' else 'MUL']:
+        chrD.setdefault(aclust[0][0],[]).extend(aclust)
+        nclust += 1
+    print("Pre-split sRNA clusters to score:%s" % (nclust))
+
+    return chrD
+
+def hmChen(n,k,rl):
+    '''
+    Hypergeometric p-value of 'k' phased of 'n' sRNAs in window, as phaster-core
+    '''
+    p = 0
+    for w in range(k,23):
+        c   = 1
+        rr  = 1
+        rw  = 1
+        for j in range(w):
+            c   = c*(n-j)/(j+1)
+        for x in range(w):
+            rr  = rr*(22-x)/(rl*11*2-x)
+        for y in range(n-w):
+            rw  = rw*(rl*22-22-y)/(rl*11*2-w-y)
+        p += c*rr*rw
+
+    return p
+
+def inSorted(sortedA,query):
+    '''
+    Vectorized membership of 'query' positions in sorted array
+    '''
+    if not len(sortedA):
+        return np.zeros(query.shape,dtype=bool)
+    idx = np.searchsorted(sortedA,query)
+    idx[idx == len(sortedA)] = 0
+
+    return sortedA[idx] == query
+
+def inRange(sortedA,start,end):
+    '''
+    Vectorized count of positions from sorted array in [start,end]
+    '''
+    return np.searchsorted(sortedA,end,side='right') - np.searchsorted(sortedA,start,side='left')
+
+def scoreChr(arecL,rl,pcache):
+    '''
+    Scores all sRNA positions of a chromosome. Each position (anchor) with sRNA on either strand opens a window
+    of 'phaseWin' phase positions, n (sRNAs in window) and k (phased sRNAs) are computed for all anchors at once
+    on sorted position arrays. Each sRNA gets best p-value from all windows where it is phased, ties go
+    to the first anchor on chromosome as in phaster-core
+    '''
+    plusA       = np.unique(np.array([x[1] for x in arecL if x[2] == '+'],dtype=np.int64))
+    minusA      = np.unique(np.array([x[1] for x in arecL if x[2] == '-'],dtype=np.int64))
+    W           = phaseWin*rl
+    steps       = np.arange(phaseWin,dtype=np.int64)*rl
+
+    ### n and k for anchors on plus strand
+    C           = plusA
+    plusN       = inRange(plusA,C,C+W-1) + inRange(minusA,C-2,C+W-3)
+    plusK       = inSorted(plusA,C[:,None]+steps).sum(axis=1) + inSorted(minusA,C[:,None]+rl-3+steps).sum(axis=1)
+
+    ### n and k for anchors on minus strand
+    C           = minusA
+    ss          = np.maximum(C-W+1,1)
+    minusN      = inRange(plusA,ss,C) + inRange(minusA,ss+2,C+2)
+    minusK      = inSorted(minusA,C[:,None]-steps).sum(axis=1) + inSorted(plusA,C[:,None]+3-rl-steps).sum(axis=1)
+
+    ### p-values, computed once for each (n,k)
+    def pvals(nA,kA):
+        pA = np.empty(len(nA))
+        for i,(n,k) in enumerate(zip(nA.tolist(),kA.tolist())):
+            if (n,k) not in pcache:
+                pcache[(n,k)] = hmChen(n,k,rl)
+            pA[i] = pcache[(n,k)]
+        return pA
+    plusP       = pvals(plusN,plusK)
+    minusP      = pvals(minusN,minusK)
+
+    ### Best window for sRNAs on each strand - candidate anchors are looked up on both strands
+    ## (target strand, anchor strand, anchor array, p, n, k, offset of anchor from target for each phase step)
+    anchorD     = {'+':(plusA,plusP,plusN,plusK,0),'-':(minusA,minusP,minusN,minusK,1)}
+    offsetD     = {('+','+'):-steps, ('+','-'):rl-3+steps, ('-','+'):3-rl-steps, ('-','-'):steps}
+    bestD       = {}
+    for tstrand,T in (('+',plusA),('-',minusA)):
+        bestP   = np.full(len(T),np.inf)
+        bestC   = np.full(len(T),np.iinfo(np.int64).max)
+        bestS   = np.full(len(T),2)
+        bestN   = np.zeros(len(T),dtype=np.int64)
+        bestK   = np.zeros(len(T),dtype=np.int64)
+        for astrand in ('+','-'):
+            A,P,N,K,sflag = anchorD[astrand]
+            if not len(A):
+                continue
+            for off in offsetD[(tstrand,astrand)].tolist():
+                cand    = T+off
+                valid   = inSorted(A,cand)
+                idx     = np.searchsorted(A,cand)
+                idx[~valid] = 0
+                cp      = np.where(valid,P[idx],np.inf)
+                better  = valid & ((cp < bestP) | ((cp == bestP) & ((cand < bestC) | ((cand == bestC) & (sflag < bestS)))))
+                bestP[better] = cp[better]
+                bestC[better] = cand[better]
+                bestS[better] = sflag
+                bestN[better] = N[idx][better]
+                bestK[better] = K[idx][better]
+        bestD[tstrand] = dict(zip(T.tolist(),zip(bestN.tolist(),bestK.tolist(),bestC.tolist(),bestP.tolist())))
+
+    ### Rows for all sRNAs - one per sequence at a position and strand
+    rowD = {}
+    for chrid,pos,strand,seqid,seq,abun in arecL:
+        akey = (pos,strand,seq)
+        if akey in rowD:
+            continue
+        n,k,bestpos,p   = bestD[strand][pos]
+        rowD[akey]      = (chrid,strand,pos,seqid,seq,len(seq),abun,n,k,bestpos,p)
+
+    return [rowD[x] for x in sorted(rowD)]
+
+def writeScores(chrD,rl,pcutoff,prefix):
+    '''
+    Scores all chromosomes, writes all and qualified sRNAs. Returns qualified rows with p-value as written
+    '''
+    print("\n#### Fn: writeScores ######################")
+    allFile     = "%s.output_all_sRNA_%s_out.txt" % (prefix,rl)
+    scoreFile   = "%s.score_p%s_sRNA_%s_out.txt" % (prefix,fmtNum(pcutoff),rl)
+    fh_all      = open(allFile,'w',buffering=1048576)
+    fh_score    = open(scoreFile,'w',buffering=1048576)
+    pcache      = {}
+    qualL       = []
+    for chrid in sorted(chrD):
+        for arow in scoreChr(chrD[chrid],rl,pcache):
+            pstr = fmtNum(arow[-1])
+            aline = "%s\n" % ('\t'.join(str(x) for x in arow[:-1]+(pstr,)))
+            fh_all.write(aline)
+            if arow[-1] < pcutoff:
+                fh_score.write(aline)
+                qualL.append(arow[:-1]+(pstr,))
+    fh_all.close()
+    fh_score.close()
+    print("Scored:%s | Qualified sRNAs:%s" % (allFile,len(qualL)))
+
+    return qualL
+
+def fmtNum(anum):
+    '''
+    Number formatted as perl prints it
+    '''
+    return "%.15g" % (anum)
+
+def clusterCheck(qualL,rl,cut,hitsD,total,gap,ratio,avgHits,sumD):
+    '''
+    Clusters sRNAs with p-value within cutoff, keeps clusters with enough register sized sRNAs and fewer hits
+    '''
+    clustL  = []
+    for arow in qualL:
+        if float(arow[-1]) > cut:
+            continue
+        chrid,strand,pos,seqid,seq,alen,abun,n,k,bestpos,pstr = arow
+        arec = (chrid,strand,pos,seqid,seq,alen,abun,"n=%s" % (n),"k=%s" % (k),"hts=%s" % (hitsD[seqid]),bestpos,pstr)
+        if clustL and clustL[-1][-1][0] == chrid and pos - gap <= clustL[-1][-1][2]:
+            clustL[-1].append(arec)
+        else:
+            clustL.append([arec])
+
+    qualClust   = []
+    phasedNumb  = 0
+    for aclust in clustL:
+        atotal      = sum(x[6] for x in aclust)
+        ainterest   = sum(x[6] for x in aclust if x[5] == rl)
+        ahits       = sum(hitsD[x[3]] for x in aclust)
+        ahna        = sum(x[6]/hitsD[x[3]] for x in aclust)
+        if 100*ainterest/atotal >= ratio and ahits/len(aclust) <= avgHits:
+            qualClust.append(aclust)
+            phasedNumb += ahna
+
+    sumD.setdefault(cut,{})[rl] = (len(qualClust),int(phasedNumb*10000000/total) if total else 0)
+
+    return qualClust
+
+def boundary(aclust,rl):
+    '''
+    Cluster start and end from 5' and 3' most sRNAs
+    '''
+    first,last  = aclust[0],aclust[-1]
+    start       = first[2] if first[1] == '+' else first[2]-(rl-3)
+    end         = last[2]+rl-3 if last[1] == '+' else last[2]
+
+    return start,end,first[0]
+
+def writeClusters(qualD,sumD,runType,prefix):
+    '''
+    Writes clusters for each cutoff and register, cluster boundary list and summary - same format as phaster-core
+    '''
+    print("\n#### Fn: writeClusters ####################")
+    alabel      = "chr" if runType == 'G' else "target"
+    fh_list     = open("%s.cluster.boundary.without.PARE.validation.list" % (prefix),'w')
+    for cut in sorted(qualD):
+        for rl in sorted(qualD[cut]):
+            fh_out = open("%s.score_p%s_sRNA_%s_out.cluster" % (prefix,fmtNum(cut),rl),'w')
+            for i,aclust in enumerate(qualD[cut][rl],start=1):
+                start,end,chrid = boundary(aclust,rl)
+                fh_out.write(">cluster = %s | %s = %s and pos between %s and %s\n" % (i,alabel,chrid,start,end))
+                fh_list.write("%s|%s|%s = %s:%s..%s\n" % (fmtNum(cut),rl,alabel,chrid,start,end))
+                for arec in aclust:
+                    fh_out.write("%s\n" % ('\t'.join(str(x) for x in ("o",)+arec)))
+            fh_list.write("\n")
+            fh_out.close()
+        fh_list.write("\n")
+    fh_list.close()
+
+    fh_sum = open("%s.summary.sRNA.v%s.txt" % (prefix,version),'w')
+    fh_sum.write("Note:the algorithm is baed on the -m\n")
+    for cut in sorted(sumD,reverse=True):
+        fh_sum.write("%s\t" % (fmtNum(cut)))
+        for rl in sorted(sumD[cut]):
+            nclust,nphased = sumD[cut][rl]
+            fh_sum.write("%s\t%s\t%s\t\t" % (rl,nclust,nphased))
+        fh_sum.write("\n")
+    fh_sum.close()
+
+    return None
+
+def phasAlign(alignFile,args):
+    '''
+    Phasing analysis from bowtie alignments of a library
+    '''
+    rlL                 = sorted(int(x) for x in args.rl.split(','))
+    recL,hitsD,total    = readAlign(alignFile,args.runType,args.n)
+    chrD                = preSplit(recL,args.runType)
+
+    qualD   = {}    ## cutoff: register: qualified clusters
+    sumD    = {}    ## cutoff: register: (clusters, phased abundance per 10M)
+    for rl in rlL:
+        print("\n#### Scoring for phase:%s #################" % (rl))
+        qualL = writeScores(chrD,rl,args.p,args.px)
+        for cut in sorted(cutArrange,reverse=True):
+            qualClust = clusterCheck(qualL,rl,cut,hitsD,total,args.g,args.t,args.ht,sumD)
+            if qualClust:
+                qualD.setdefault(cut,{})[rl] = qualClust
+    writeClusters(qualD,sumD,args.runType,args.px)
+
+    return None
+
+def benchmark(args):
+    '''
+    Runs perl phaster-core and python engine on same library, and compares runtime and outputs. Concordance of each
+    output file is the fraction of perl lines found in python output
+    '''
+    print("\n#### Fn: benchmark #######################")
+    perlPx      = "%s.perl" % (args.px)
+    acmd        = ["perl",args.bench,"-i",args.i,"-f",args.f,"-t",fmtNum(args.t),"-n",str(args.n),"-d",args.d,"-px",perlPx,"-rl",args.rl,"-cpu",str(args.cpu)]
+    astart      = time.time()
+    retcode     = subprocess.call(acmd)
+    perlTime    = time.time()-astart
+    if retcode != 0:
+        print("** Problem with phaster-core script - Return code not 0")
+        sys.exit(1)
+
+    astart      = time.time()
+    alignFile,tempL = mapLib(args.i,args.f,args.d,args.runType,args.cpu,args.m,args.px)
+    phasAlign(alignFile,args)
+    for afile in tempL+[alignFile]:
+        os.remove(afile)
+    pyTime      = time.time()-astart
+
+    ### Compare outputs
+    outdir      = os.path.dirname(perlPx) or '.'
+    perlL       = sorted(x for x in os.listdir(outdir) if x.startswith(os.path.basename(perlPx)+'.'))
+    benchFile   = "%s.benchmark.txt" % (args.px)
+    fh_out      = open(benchFile,'w')
+    fh_out.write("Perl runtime:%ss | Python runtime:%ss | Speedup:%sx\n" % (round(perlTime,2),round(pyTime,2),round(perlTime/pyTime,2) if pyTime else 'NA'))
+    fh_out.write("File\tPerlLines\tPythonLines\tShared\tConcordance\n")
+    for afile in perlL:
+        pyFile  = "%s/%s%s" % (outdir,os.path.basename(args.px),afile[len(os.path.basename(perlPx)):])
+        perlC   = collections.Counter(open("%s/%s" % (outdir,afile)).read().splitlines())
+        pyC     = collections.Counter(open(pyFile).read().splitlines()) if os.path.isfile(pyFile) else collections.Counter()
+        ashared = sum((perlC & pyC).values())
+        aperl   = sum(perlC.values())
+        fh_out.write("%s\t%s\t%s\t%s\t%s\n" % (afile[len(os.path.basename(perlPx))+1:],aperl,sum(pyC.values()),ashared,round(100*ashared/aperl,2) if aperl else 100))
+    fh_out.close()
+    print(open(benchFile).read())
+
+    return benchFile
+
+def main(argv=None):
+    args            = phasArgs(argv)
+    if args.bench:
+        benchmark(args)
+        return None
+
+    print("\n#### phasclust - python engine for phaster-core ####")
+    astart          = time.time()
+    if args.q:
+        print("** Degradome is not used by python engine, phasing analysis will run without it")
+
+    if args.b:
+        print("Using existing alignment:%s" % (args.b))
+        phasAlign(args.b,args)
+    else:
+        alignFile,tempL = mapLib(args.i,args.f,args.d,args.runType,args.cpu,args.m,args.px)
+        phasAlign(alignFile,args)
+        for afile in tempL+[alignFile]:
+            os.remove(afile)
+
+    print("\n#### Phasing done for %s in %ss" % (args.i,round(time.time()-astart,2)))
+
+    return None
+
+if __name__ == '__main__':
+    main()
+
+########### CHANGE LOG ########
+###############################
+
+## v1.0
+## Python engine for phaster-core - same arguments and output files as phasclust.genome.v2.pl and phasclust.MUL.v2.pl
+## n and k for all windows of a chromosome are computed on sorted position arrays of both strands, and best window for
+#### each sRNA is picked across all anchor offsets at once
+## '-bench' runs phaster-core perl script and python engine on same library, and reports runtime and output concordance
+
+## v1.0 -> v1.01
+## '-b' to use an existing bowtie alignment of library, as perl scripts - used by phaser to share alignments between runs
@@ -7,10 +7,12 @@
 
 #### FUNCTIONS ###########################################
 
-import os,sys,subprocess,multiprocessing,time,getpass,shutil,hashlib,datetime,collections,re,argparse
+import os,sys,subprocess,multiprocessing,time,getpass,shutil,hashlib,datetime,collections,re,argparse,heapq,gzip,importlib.util
 from importlib.machinery import SourceFileLoader
 from multiprocessing import Process, Queue, Pool
 from subprocess import check_output
+from itertools import groupby
+from operator import itemgetter
 import os.path
 from os.path import expanduser
 # from dedup import dedup_main,dedup_process,dedup_fastatolist,deduplicate,dedup_writer
@@ -24,6 +26,8 @@ memFile         = "phaser.mem"
 res_folder      = "phased_%s"   % (datetime.datetime.now().strftime("%m_%d_%H_%M"))
 home            = expanduser("~")
 phaster_path    = "%s/.phaster" % (home)
+registry        = "%s/.phaster/index.registry" % (home)    ## Indexes built in any directory, keyed on reference hash
+alignCache      = "alignments"                      ## Folder for library alignments, keyed on library and index hash and reused by runs for other phase
 
 ## Degradome - Optional ####################################
 deg             = 'N'                               ## Use Degradome validation, IF yes enter PARE db in line below
@@ -31,7 +35,7 @@ PARE            = 'GuturGu'                         ## If deg = 'Y' then File fo
 
 ## ADVANCED SETTINGS #######################################
 cores           = 0                                 ## 0: Most cores considered as processor pool | 1-INTEGER: Cores to be considered for pool
-nthread         = 3                               ## Threads perprocess
+nthread         = 3                                 ## Minimum threads per library, larger libraries get more from scheduler
 # server          = "tarkan.ddpsc.org"                ## Server to use to fetch library information and smallRNA libraries
 # perl            = "/usr/local/bin/perl_5.18"        ## Josh updated the perl on Tarkan and its not ready yet for PHAS script FORK is missing and somemore modules -Check with Pingchuan help
 perl            = "perl"
@@ -39,6 +43,8 @@ Local           = 3                                 ## [0]: Files in directory [
                                                     ## [3] Get library from srna db with reads filtered on number of hits
 noiseLimit      = 2
 hitsLimit       = 10
+engine          = "perl"                            ## phaster-core engine, 'perl': phasclust perl scripts | 'python': phasclust.py. Can be set by @engine in settings file
+dedupMem        = 2000                              ## Approx. memory (MB) to de-duplicate one FASTA library, sorted partial counts are spilled to disk beyond this
 #############################################################
 #############################################################
 
@@ -177,6 +183,14 @@ def checkDependency():
         goSignal    = False
         # print("See README for how to INSTALL")
 
+    ### Check numpy - required only for python engine
+    if importlib.util.find_spec("numpy"):
+        print("--numpy (python engine)          : found")
+        pass
+    else:
+        print("--numpy (python engine)          : missing")
+        # print("See README for how to INSTALL")
+
     if goSignal == False:
         print("\n** Please install the missing libraries before running the analyses")
         # print("See README for how to install these")
@@ -244,6 +258,12 @@ def readSet(setFile):
                     phase = int(value.strip())
                     print('User Input for phase length:     ',phase)
                 
+                elif param.strip() == '@engine':
+                    if value.strip():
+                        global engine
+                        engine = str(value.strip()).lower()
+                        print('User Input for phasing engine:   ',engine)
+
                 elif param.strip() == '@path_prepro_git':
                     global phaster_path
                     phaster_path = str(value.strip()).rstrip("/")+"/phaster"
@@ -254,6 +274,13 @@ def readSet(setFile):
                 #print("Missed line:",line)
                 pass
     
+    ### Degradome validation is done by perl scripts only
+    if deg == 'Y' and engine == 'python':
+        print("** Degradome validation (deg = 'Y') is not supported by python engine")
+        print("** Please use '@engine = perl' in settings file or turn off degradome validation")
+        print("** Script will exit now")
+        sys.exit()
+
     # sys.exit()
     return libs
 
@@ -331,14 +358,12 @@ def TagAbundanceFile(con,db,libs):
             print('tag abundance file exists for library: %s' % (alib))
             pass
 
-def PHASBatch2(aninput):
+def PHASCommand(aninput):
     '''
-    Phasing anlysis - New
+    Prepares phaster-core command for a library
     '''
 
-    print ("\n#### Fn: phaser #########################")
-    # print("\naninput\n",aninput)
-    lib,runType,index,deg,nthread,noiseLimit,hitsLimit = aninput
+    lib,runType,index,deg,nthread,noiseLimit,hitsLimit,alignFile = aninput
     
     ### Sanity check #####################
     if not os.path.isfile(lib):
@@ -362,43 +387,44 @@ def PHASBatch2(aninput):
     noiseLimit  = str(noiseLimit)
     print(pro_file)
 
-    if runType == 'G':### Uses Whole genome as input
+    if engine == 'python':### Python engine, same arguments as perl scripts for genome and genes
+        full_path = "%s/phasclust.py" % (phaster_path)
+    elif runType == 'G':### Uses Whole genome as input
         full_path = "%s/phasclust.genome.v2.pl" % (phaster_path)
-        # print(full_path)
-        if deg == 'Y':
-            retcode = subprocess.call([perl, "%s/phasclust.genome.v2.pl" % (phaster_path), "-i", pro_file, "-q", PARE, "-f", "-t", sRNAratio, "-d", index, "-px", out_file, "-rl", rl, "-cpu", nthread])
-        else:
-            if libFormat == "T":
-                aformat = "t"
-                retcode = subprocess.call([perl, "%s/phasclust.genome.v2.pl" % (phaster_path), "-i", pro_file,"-f", aformat, "-t", sRNAratio,"-n", noiseLimit, "-d", index, "-px", out_file, "-rl", rl, "-cpu", nthread])
-            elif libFormat == "F":
-                aformat = "f"
-                retcode = subprocess.call([perl, "%s/phasclust.genome.v2.pl" % (phaster_path), "-i", pro_file,"-f", aformat, "-t", sRNAratio,"-n", noiseLimit, "-d", index, "-px", out_file, "-rl", rl, "-cpu", nthread])
-            else:
-                print("** Invalid '@libFormat' parameter value")
-                print("** Please check the '@libFormat' parameter value in setting file")
-                print("** F for FASTA format | T for tag-count format are the only acceptable values")
-                print("** Script will exit now")
-                sys.exit()
-    
     else: ### Uses FASTA file of genes as input
         full_path = "%s/phasclust.MUL.v2.pl" % (phaster_path)
-        # print(full_path)        
-        if deg == 'Y':
-            retcode = subprocess.call([perl, "%s/phasclust.MUL.v2.pl" % (phaster_path), "-i", pro_file, "-q", PARE, "-f", "-t", sRNAratio, "-d", index, "-px", out_file, "-rl", rl, "-cpu", nthread])
-        else:   
-            if libFormat == "T":
-                aformat = "t"
-                retcode = subprocess.call([perl, "%s/phasclust.MUL.v2.pl" % (phaster_path), "-i", pro_file, "-f", aformat, "-t", sRNAratio,"-n", noiseLimit, "-d", index, "-px", out_file, "-rl", rl, "-cpu", nthread])
-            elif libFormat == "F":
-                aformat = "f"
-                retcode = subprocess.call([perl, "%s/phasclust.MUL.v2.pl" % (phaster_path), "-i", pro_file,"-f", aformat, "-t", sRNAratio,"-n", noiseLimit, "-d", index, "-px", out_file, "-rl", rl, "-cpu", nthread])
-            else:
-                print("** Invalid '@libFormat' parameter value")
-                print("** Please check the '@libFormat' parameter value in setting file")
-                print("** F for FASTA format | T for tag-count format are the only acceptable values")
-                print("** Script will exit now")
-                sys.exit()
+    # print(full_path)
+
+    if deg == 'Y':
+        acmd = [perl, full_path, "-i", pro_file, "-q", PARE, "-f", "-t", sRNAratio, "-d", index, "-px", out_file, "-rl", rl, "-cpu", nthread]
+    else:
+        if libFormat == "T":
+            aformat = "t"
+        elif libFormat == "F":
+            aformat = "f"
+        else:
+            print("** Invalid '@libFormat' parameter value")
+            print("** Please check the '@libFormat' parameter value in setting file")
+            print("** F for FASTA format | T for tag-count format are the only acceptable values")
+            print("** Script will exit now")
+            sys.exit()
+        acmd = [perl, full_path, "-i", pro_file,"-f", aformat, "-t", sRNAratio,"-n", noiseLimit, "-d", index, "-px", out_file, "-rl", rl, "-cpu", nthread]
+
+    acmd += ["-b", alignFile] ### Library mapped earlier by mapLibs
+    if engine == 'python':
+        acmd = [sys.executable]+acmd[1:]+["-runType", runType, "-ht", str(hitsLimit)]
+
+    return acmd
+
+def PHASBatch2(aninput):
+    '''
+    Phasing anlysis - New
+    '''
+
+    print ("\n#### Fn: phaser #########################")
+    # print("\naninput\n",aninput)
+    acmd    = PHASCommand(aninput)
+    retcode = subprocess.call(acmd)
 
     if retcode == 0:
         pass
@@ -428,55 +454,160 @@ def PPResults(module,alist):
     npool.close()
     return results
 
-def PPBalance(module,alist):
+def allocate(libs):
     '''
-    Balance process according to core pool
+    Threads for each library in proportion to its size, atleast 'nthread' and atmost all cores
     '''
-    #print('***********Parallel instance of %s is being executed*********' % (module))
-    start       = time.time()
-    ##PP is being used for Bowtie mappings - This will avoid overflooding of processes to server
-    nprocPP     = round((nproc/int(nthread))) 
-    if nprocPP  < 1:
-        nprocPP = 1 ## 1 here so as to avoid 0 processor being allocated in serial mode
-    else:
-        pass
 
-    print("nprocPP:%s" % (nprocPP))
-    npool = Pool(int(nprocPP))
-    npool.map(module, alist)
+    sizeD   = dict((alib,os.path.getsize(alib)) for alib in libs)
+    total   = sum(sizeD.values())
+    allocD  = {}
+    for alib,asize in sizeD.items():
+        if total:
+            athread = int(round(nproc*asize/total))
+        else:
+            athread = nthread
+        allocD[alib] = min(max(athread,nthread),nproc)
+
+    print("\n#### %s cores reserved for analysis #########" % (str(nproc)))
+    for alib in libs:
+        print("#### %s threads assigned to %s (%s MB)" % (allocD[alib],alib,round(sizeD[alib]/1e6,2)))
+
+    return sizeD,allocD
 
-def optimize(nproc):
+def scheduler(rawInputs,fh_run):
     '''
-    dirty optimization of threads per library
+    Runs phasing analysis for all libraries from a priority queue - largest library first with threads
+    in proportion to library size. Cores freed by finished libraries are handed to libraries started later
     '''
 
-    nlibs       = len(libs)
-    ninstances  = int(nproc/nlibs) ### Number of parallel instances to use
-    # print("Libs:%s | nproc:%s | ninstance:%s" % (nlibs,nproc,ninstances))
+    print("\n#### Fn: scheduler #######################")
+    
+    libs            = [x[0] for x in rawInputs]
+    sizeD,allocD    = allocate(libs)
+    queue           = [(-sizeD[x[0]],n,x) for n,x in enumerate(rawInputs)] ## Largest first, input order for ties
+    heapq.heapify(queue)
+
+    freecores       = nproc
+    running         = {}    ## Key: lib and value: (process,threads,start time)
+    coretime        = 0     ## Sum of threads x runtime for all libs
+    sched_start     = time.time()
+    while queue or running:
+
+        ### Launch libraries while cores are free
+        while queue:
+            asize,n,aninput = queue[0]
+            alib            = aninput[0]
+            athread         = min(max(allocD[alib],freecores//len(queue)),freecores) ## Spare cores are shared by waiting libraries
+            if athread < allocD[alib] and running:
+                ## Wait for running libs to free cores
+                break
+            heapq.heappop(queue)
+            acmd            = PHASCommand((alib,)+aninput[1:4]+(athread,)+aninput[5:])
+            aproc           = subprocess.Popen(acmd)
+            running[alib]   = (aproc,athread,time.time())
+            freecores       -= athread
+            print("Started:%s | Threads:%s | Free cores:%s | Waiting libs:%s" % (alib,athread,freecores,len(queue)))
+
+        ### Check for finished libraries
+        time.sleep(1)
+        for alib in list(running):
+            aproc,athread,astart = running[alib]
+            retcode = aproc.poll()
+            if retcode is None:
+                continue
+            elif retcode != 0:
+                print("** Problem with Phasing script for %s - Return code not 0" % (alib))
+                for bproc,bthread,bstart in running.values():
+                    if bproc.poll() is None:
+                        bproc.terminate()
+                sys.exit()
 
-    if ninstances > 3:
-        nthread = ninstances
-    else:
-        nthread = 3
-
-    print("\n#### %s cores reserved for analysis #########" % (str(nproc)))
-    print("#### %s threads assigned to one lib #########\n" % (str(nthread)))
-    # time.sleep(1)
+            aruntime        = time.time()-astart
+            coretime        += athread*aruntime
+            freecores       += athread
+            del running[alib]
+            print("Finished:%s | Runtime:%ss | Free cores:%s" % (alib,round(aruntime,2),freecores))
+            fh_run.write("Lib:%s | Size:%sMB | Threads:%s/%s | Runtime:%ss\n" % (alib,round(sizeD[alib]/1e6,2),athread,nproc,round(aruntime,2)))
 
+    walltime    = time.time()-sched_start
+    if walltime:
+        autil   = round(100*coretime/(nproc*walltime),2)
+    else:
+        autil   = 0
+    print("Phasing finished | Wall time:%ss | Core utilization:%s%%" % (round(walltime,2),autil))
+    fh_run.write("Phasing time:%ss | Core utilization:%s%%\n" % (round(walltime,2),autil))
 
-    return nthread 
+    return None
 
-def inputList(libs,runType,index,deg,nthread,noiseLimit,hitsLimit):
+def inputList(libs,runType,index,deg,nthread,noiseLimit,hitsLimit,alignD):
     '''generate raw inputs for parallel processing'''
 
     rawInputs = [] ## An empty list to store inputs for PP
     for alib in libs:
-        rawInputs.append((alib,runType,index,deg,nthread,noiseLimit,hitsLimit))
+        rawInputs.append((alib,runType,index,deg,nthread,noiseLimit,hitsLimit,alignD[alib]))
 
     # print("These are rawInputs:",rawInputs)
 
     return rawInputs
 
+def mapLibs(libs,genoIndex,fh_run):
+    '''
+    Maps libraries to index with bowtie, same settings as phaster-core. Alignments are cached in 'alignCache'
+    on library, index and mapping settings hash - runs for other phase or noise/hits limits reuse these
+    '''
+
+    print("\n#### Fn: mapLibs #########################")
+    os.makedirs(alignCache,exist_ok=True)
+    indexHash   = fileHash("%s.1.ebwt" % (genoIndex))
+    multi       = "12" if runType == 'G' else "45"  ### Max hits as phaster-core genome and MUL scripts
+
+    alignD      = {}
+    for alib in libs:
+        akey        = hashlib.md5(("%s|%s|%s|%s" % (fileHash(alib),indexHash,multi,libFormat)).encode()).hexdigest()
+        alignFile   = "%s/%s/%s.map" % (os.getcwd(),alignCache,akey)
+        alignD[alib]= alignFile
+        if os.path.isfile(alignFile):
+            print("Cached alignment found for %s:%s" % (alib,alignFile))
+            fh_run.write("Lib:%s | Mapping time: 0s (cached)\n" % (alib))
+            continue
+
+        print("Mapping %s to %s" % (alib,genoIndex))
+        tstart      = time.time()
+        infile      = alib
+        if libFormat == "T":
+            ### Tag count to FASTA with abundance in name, as phaster-core
+            infile  = "%s.fa.%s" % (alignFile,os.getpid())
+            fh_in   = open(alib,'r')
+            fh_out  = open(infile,'w')
+            acount  = 0
+            for line in fh_in:
+                ent = line.split()
+                if not ent:
+                    continue
+                acount += 1
+                fh_out.write(">seq_%s|%s\n%s\n" % (acount,ent[1],ent[0]))
+            fh_in.close()
+            fh_out.close()
+
+        tmpFile     = "%s.%s" % (alignFile,os.getpid())
+        fh_out      = open(tmpFile,'w')
+        retcode     = subprocess.call(["bowtie","-f","-a","-v","0","-m",multi,"-p",str(nproc),genoIndex,infile],stdout=fh_out)
+        fh_out.close()
+        if infile != alib:
+            os.remove(infile)
+        if retcode != 0:
+            print("** There is some problem mapping %s to index '%s'" % (alib,genoIndex))
+            print("** Script will exit now")
+            os.remove(tmpFile)
+            sys.exit()
+        os.replace(tmpFile,alignFile)   ### Only complete alignments are cached
+
+        tend        = time.time()
+        fh_run.write("Lib:%s | Mapping time:%ss\n" % (alib,round(tend-tstart,2)))
+
+    return alignD
+
 def indexBuilder_bak(reference):
     
     
@@ -541,8 +672,10 @@ def indexBuilder_bak(reference):
 
     # sys.exit()
 
-def indexBuilder(reference):
-    
+def indexBuilder(reference,refHash):
+    '''
+    Cleans reference and builds bowtie index, index is recorded in memory file and registry with 'refHash'
+    '''
     
     print ("\n#### Fn: indexBuilder #########################")
     ### Sanity check #####################
@@ -589,14 +722,10 @@ def indexBuilder(reference):
     #####################################
 
     ### Make a memory ###################
-    fh_out      = open(memFile,'w')
-    refHash     = (hashlib.md5(open('%s' % (reference),'rb').read()).hexdigest()) ### reference hash used instead of cleaned FASTA because while comparing only the user input reference is available
-    indexHash   = (hashlib.md5(open('%s.1.ebwt' % (genoIndex),'rb').read()).hexdigest())
+    indexHash   = fileHash('%s.1.ebwt' % (genoIndex))
     print("\n@genomehash:%s | @indexhash:%s" % (refHash, indexHash) )
-    fh_out.write("@timestamp:%s\n" % (datetime.datetime.now().strftime("%m_%d_%H_%M")))
-    fh_out.write("@genomehash:%s\n" % (refHash))
-    fh_out.write("@index:%s\n" % (genoIndex))
-    fh_out.write("@indexhash:%s\n" % (indexHash))
+    writeMem(refHash,genoIndex,indexHash)
+    writeRegistry(refHash,genoIndex,indexHash)
 
     print("Index prepared:%s\n" % (genoIndex))
 
@@ -604,12 +733,127 @@ def indexBuilder(reference):
     
     return genoIndex
 
+def fileHash(afile,chunk=8388608):
+    '''
+    MD5 of file read in chunks - reference and index are never read in memory at once
+    '''
+    ahash = hashlib.md5()
+    with open(afile,'rb') as fh_in:
+        for block in iter(lambda: fh_in.read(chunk), b''):
+            ahash.update(block)
+
+    return ahash.hexdigest()
+
+def writeMem(refHash,genoIndex,indexHash):
+    '''
+    Writes memory file for index in current directory
+    '''
+    fh_out      = open(memFile,'w')
+    fh_out.write("@timestamp:%s\n" % (datetime.datetime.now().strftime("%m_%d_%H_%M")))
+    fh_out.write("@genomehash:%s\n" % (refHash))    ### reference hash used instead of cleaned FASTA because while comparing only the user input reference is available
+    fh_out.write("@index:%s\n" % (genoIndex))
+    fh_out.write("@indexhash:%s\n" % (indexHash))
+    fh_out.close()
+
+    return None
+
+def readRegistry():
+    '''
+    Reads registry of indexes built so far - reference hash: (index,index hash)
+    '''
+    registryD = {}
+    if not os.path.isfile(registry):
+        return registryD
+
+    fh_in = open(registry,'r')
+    for line in fh_in:
+        ent = line.strip('\n').split('\t')
+        if len(ent) < 3:
+            continue
+        refHash,genoIndex,indexHash = ent[:3]
+        registryD[refHash] = (genoIndex,indexHash)
+    fh_in.close()
+
+    return registryD
+
+def writeRegistry(refHash,genoIndex,indexHash):
+    '''
+    Adds index to registry, an older index for same reference is replaced
+    '''
+    registryD           = readRegistry()
+    registryD[refHash]  = (genoIndex,indexHash)
+
+    os.makedirs(registry.rpartition('/')[0],exist_ok=True)
+    tmpFile = "%s.%s" % (registry,os.getpid())
+    fh_out  = open(tmpFile,'w')
+    for akey,(aindex,ahash) in registryD.items():
+        fh_out.write("%s\t%s\t%s\n" % (akey,aindex,ahash))
+    fh_out.close()
+    os.replace(tmpFile,registry)    ### Other runs reading registry see either old or new file
+
+    return None
+
+def indexLookup(refHash):
+    '''
+    Finds an index built earlier for reference - first from memory file in current directory and then from
+    the registry of indexes built in other directories. Registry index is used only if its hash matches
+    '''
+    print ("\n#### Fn: indexLookup #########################")
+
+    ### Memory file in current directory
+    if os.path.isfile(memFile):
+        readMem(memFile)
+        if refHash == existRefHash:
+            print("Existing index matches the specified reference")
+            if os.path.isdir(index.rpartition('/')[0]):
+                print("Index for matching reference found and will be used")
+                return index
+            else:
+                print("Matching index could not be found in current directory")
+        else:
+            print("Existing index does not matches specified genome")
+
+    ### Registry
+    registryD = readRegistry()
+    if refHash in registryD:
+        genoIndex,indexHash = registryD[refHash]
+        if os.path.isfile("%s.1.ebwt" % (genoIndex)) and fileHash("%s.1.ebwt" % (genoIndex)) == indexHash:
+            print("Index for matching reference found in registry and will be used:%s" % (genoIndex))
+            writeMem(refHash,genoIndex,indexHash)
+            return genoIndex
+        else:
+            print("Registered index for reference is missing or modified:%s" % (genoIndex))
+
+    return None
+
+def fastaStream(fh_in):
+    '''
+    Reads FASTA line by line, yields header and sequence of one entry at a time
+    '''
+    header  = None
+    seqL    = []    ## Sequence in multiple lines
+    for line in fh_in:
+        if line.startswith('>'):
+            if header is not None:
+                yield header,''.join(seqL)
+            header  = line[1:].strip()
+            seqL    = []
+        elif header is not None:
+            seqL.append(line.strip())
+
+    if header is not None:
+        yield header,''.join(seqL)
+
 def FASTAClean(filename,mode):
     
     '''Cleans FASTA file - multi-line fasta to single line, header clean, empty lines removal'''
 
-    ## Read seqeunce file
-    fh_in       = open(filename, 'r')
+    ## Read seqeunce file - gzipped file is read as-is
+    if filename.endswith('.gz'):
+        fh_in       = gzip.open(filename, 'rt')
+        filename    = filename[:-3]
+    else:
+        fh_in       = open(filename, 'r')
     print ("PHASER uses FASTA header as key for identifying the phased loci")
     print ("Cleaning header '%s' reference FASTA file" % (filename))
     
@@ -622,29 +866,24 @@ def FASTAClean(filename,mode):
         sys.exit()
 
     ### Outfiles
-    fh_out1     = open(fastaclean, 'w')
+    fh_out1     = open(fastaclean, 'w', buffering=8388608)
     fastasumm   = ('%s.summ.txt' % (filename.split('.')[0]))
     fh_out2     = open(fastasumm, 'w')
     fh_out2.write("Name\tLen\n")
     
     ### Read files
-    fasta       = fh_in.read()
-    fasta_splt  = fasta.split('>')
-
-    fastaD      = {}    ## Store FASTA as dict
+    nonDigit    = re.compile("[^0-9]")
     acount      = 0     ## count the number of entries
     empty_count = 0
-    for i in fasta_splt[1:]:
-        ent     = i.split('\n')
-        aname   = ent[0].split()[0].strip()
+    for header,seq in fastaStream(fh_in):
+        aname   = header.split()[0]
         
         if runType == 'G':
             ## To match with phasing-core script for genome version which removed non-numeric and preceding 0s
-            name = re.sub("[^0-9]", "", aname).lstrip('0')
+            name = nonDigit.sub("", aname).lstrip('0')
         else:
             name = aname
         
-        seq     = ''.join(x.strip() for x in ent[1:]) ## Sequence in multiple lines
         alen    = len(seq)
         if alen > 200:
             fh_out1.write('>%s\n%s\n' % (name,seq))
@@ -730,15 +969,15 @@ def dedup_process(alib):
     '''
     print("\n#### Fn: De-duplicater ###############")
 
-    afastaL     = dedup_fastatolist(alib)         ## Read
-    acounter    = deduplicate(afastaL )            ## De-duplicate
-    countFile   = dedup_writer(acounter,alib)   ## Write
+    acounter,spillL = dedup_count(alib)                 ## Read and de-duplicate
+    countFile       = dedup_writer(acounter,spillL,alib) ## Merge and write
 
     return countFile
 
-def dedup_fastatolist(alib):
+def dedup_count(alib):
     '''
-    New FASTA reader
+    Streaming FASTA reader and de-duplicator - tags are counted while reading, and if counts exceed 
+    'dedupMem' these are spilled to disk as sorted partial counts to be merged by writer
     '''
 
     ### Sanity check
@@ -746,59 +985,83 @@ def dedup_fastatolist(alib):
         f = open(alib,'r')
     except IOError:                    
         print ("The file, %s, does not exist" % (alib))
-        return None
-
-
-    ## Output 
-    fastaL      = [] ## List that holds FASTA tags
+        return collections.Counter(),[]                 ## Empty counts file is written for missing library
 
     print("Reading FASTA file:%s" % (alib))
     read_start  = time.time()
     
+    acounter    = collections.Counter()
+    spillL      = []    ## Files with sorted partial counts
+    memLimit    = dedupMem*1000000
+    amem        = 0     ## Approx. memory used by counts - tag length and ~120 bytes of dict, string and int overhead
     acount      = 0
     empty_count = 0
     for line in f:
         if line.startswith('>'):
-            seq = ''
-            pass
-        else:
-          seq = line.rstrip('\n')
-          fastaL.append(seq)
-          acount += 1
+            continue
+        seq = line.rstrip('\n')
+        if not seq:
+            empty_count += 1
+            continue
+        if seq not in acounter:
+            amem    += len(seq)+120
+        acounter[seq] += 1
+        acount      += 1
+
+        if amem > memLimit:
+            spillL.append(dedup_spill(acounter,alib,len(spillL)))
+            acounter    = collections.Counter()
+            amem        = 0
+    f.close()
 
     read_end    = time.time()
     # print("-- Read time: %ss" % (str(round(read_end-read_start,2))))
-    print("Cached file: %s | Tags: %s | Empty headers: %ss" % (alib,acount,empty_count)) 
+    print("Counted file: %s | Tags: %s | Empty lines: %s | Spilled parts: %s" % (alib,acount,empty_count,len(spillL))) 
 
-    return fastaL
-                   
-def deduplicate(afastaL):
+    return acounter,spillL
+
+def dedup_spill(acounter,alib,part):
     '''
-    De-duplicates tags using multiple threads and libraries using multiple cores
+    writes sorted partial counts to disk
     '''
-    dedup_start  = time.time()
 
-    # deList = [] ## Hold deduplicated tags and their abudnaces in a tuple
+    spillFile   = "%s.part%s.counts" % (alib.rpartition('.')[0],part)
+    fh_out      = open(spillFile,'w')
+    for seq in sorted(acounter):
+        fh_out.write("%s\t%s\n" % (seq,acounter[seq]))
+    fh_out.close()
+    print("Spilled %s unique tags to %s" % (len(acounter),spillFile))
+
+    return spillFile
 
-    acounter    = collections.Counter(afastaL)
+def dedup_merge(acounter,spillL):
+    '''
+    merges in-memory and spilled partial counts, yields tags and their total counts in sorted order
+    '''
 
-    dedup_end  = time.time()
-    # print("-- dedup time: %ss" % (str(round(dedup_end-dedup_start,2))))
+    def spillReader(spillFile):
+        with open(spillFile,'r') as fh_in:
+            for line in fh_in:
+                seq,count = line.rstrip('\n').split('\t')
+                yield seq,int(count)
 
-    return acounter 
+    streams = [spillReader(x) for x in spillL]
+    streams.append((seq,acounter[seq]) for seq in sorted(acounter))
+    for seq,agroup in groupby(heapq.merge(*streams),key=itemgetter(0)):
+        yield seq,sum(x[1] for x in agroup)
 
-def dedup_writer(acounter,alib):
+def dedup_writer(acounter,spillL,alib):
     '''
-    writes rtag count to a file
+    writes tag count to a file, sorted on tag
     '''
 
     print("Writing counts file for %s" % (alib))
     countFile   = "%s.fas" % alib.rpartition('.')[0]  ### Writing in de-duplicated FASTA format as required for phaster-core
-    fh_out       = open(countFile,'w')
+    fh_out      = open(countFile,'w',buffering=1048576)
 
     acount      = 0
     seqcount    = 1 ## TO name seqeunces
-    for i,j in acounter.items():
+    for i,j in dedup_merge(acounter,spillL):
         # fh_out.write("%s\t%s\n" % (i,j))
         fh_out.write(">seq_%s|%s\n%s\n" % (seqcount,j,i))
         acount      += 1
@@ -807,6 +1070,8 @@ def dedup_writer(acounter,alib):
     print("Total unique entries written for %s: %s" % (alib,acount))
 
     fh_out.close()
+    for spillFile in spillL:
+        os.remove(spillFile)
 
     return countFile
 
@@ -826,46 +1091,24 @@ def main(libs):
     ## Did user provided its index? If Yes Skip making memory files
     if not index:
         ### Check genome file and index
-        if not os.path.isfile(memFile):
-            print("This is first run - create index")
+        if not os.path.isfile(reference):
+            print("'%s' reference file not found" % (reference))
+            print("Please check the genomeFile - Is it in specified directory? Did you input wrong name?")
+            print("Script will exit for now\n")
+            sys.exit()
+
+        currentRefHash = fileHash(reference)
+        print('Current reference hash:               ',currentRefHash)
+        genoIndex      = indexLookup(currentRefHash)
+
+        if genoIndex:
+            fh_run.write("Indexing Time: 0s\n")
+        else:
+            print("No index found for specified reference - It will be created")
             tstart      = time.time()
-            genoIndex   = indexBuilder(reference)
+            genoIndex   = indexBuilder(reference,currentRefHash)
             tend        = time.time()
             fh_run.write("Indexing Time:%ss\n" % (round(tend-tstart,2)))
-        
-        else:
-            currentRefHash = hashlib.md5(open('%s' % (reference),'rb').read()).hexdigest()
-            readMem(memFile)
-            print('Current reference hash:               ',currentRefHash)
-            
-            #### Test #######
-            # if os.path.isdir(index.rpartition('/')[0]):
-            #     print("There is a folder names 'index'")
-            #     pass
-            
-            # if currentRefHash == existRefHash:
-            #     print("current ref. hash is same as exiting ref hash")
-            #     pass
-            # sys.exit()
-
-            if currentRefHash == existRefHash:
-                print("Existing index matches the specified reference")
-                if os.path.isdir(index.rpartition('/')[0]):
-                    print("Index for matching reference found and will be used")
-                    genoIndex = index
-                    fh_run.write("Indexing Time: 0s\n")
-                else:
-                    print("Matching index could not be found and will be remade")
-                    tstart      = time.time()
-                    genoIndex   = indexBuilder(reference)
-                    tend        = time.time()
-                    fh_run.write("Indexing Time:%ss\n" % (round(tend-tstart,2)))
-            else:
-                print("Existing index does not matches specified genome - It will be recreated")
-                tstart      = time.time()
-                genoIndex   = indexBuilder(reference)
-                tend        = time.time()
-                fh_run.write("Indexing Time:%ss\n" % (round(tend-tstart,2)))
     else:        
         genoIndex = index
         if not os.path.isfile("%s.1.ebwt" % (genoIndex)):
@@ -880,6 +1123,14 @@ def main(libs):
             pass
 
 
+    if engine not in ('perl','python'):
+        print("** Invalid '@engine' parameter value:%s" % (engine))
+        print("** 'perl' for phaster-core perl scripts | 'python' for python engine are the only acceptable values")
+        sys.exit()
+    elif engine == 'python' and not importlib.util.find_spec("numpy"):
+        print("** python engine requires numpy - please install it or use '@engine = perl'")
+        sys.exit()
+
     ### 1. Make Folders ###########################
     ###############################################
     shutil.rmtree("%s" % (res_folder),ignore_errors=True)
@@ -931,18 +1182,23 @@ def main(libs):
         sys.exit()
 
 
-    #### 3. Run Phaser ############################
+    #### 3. Map libraries ########################
+    ###############################################
+
+    alignD    = mapLibs(libs,genoIndex,fh_run)
+
+    #### 4. Run Phaser ############################
     ###############################################
 
     print('These are the libs: %s' % (libs))
-    rawInputs = inputList(libs,runType,genoIndex,deg,nthread,noiseLimit,hitsLimit)
+    rawInputs = inputList(libs,runType,genoIndex,deg,nthread,noiseLimit,hitsLimit,alignD)
 
     # ### Test - Serial Mode
     # for aninput in rawInputs:
     #     PHASBatch2(aninput)
 
-    #### Original - Parallel mode
-    PPBalance(PHASBatch2,rawInputs)
+    #### Parallel mode - Libraries scheduled on size
+    scheduler(rawInputs,fh_run)
 
     #### close runLog
     phaser_end = time.time()
@@ -963,7 +1219,6 @@ if __name__ == '__main__':
     # checkHost(allowedHost)
     global reference
     libs        = readSet(setFile)
-    nthread     = optimize(nproc)
     main(libs)    
     print('\n\n#### Phasing Analysis finished successfully')
     print("#### Results are in folder: %s" % (res_folder))
@@ -1035,6 +1290,18 @@ if __name__ == '__main__':
 ## v1.0 - v1.01
 ## Remade changes to indexBuilder module by copying the working version from v0.99. Not sure what went wrong in the v1.0
 
+## v1.01 -> v1.02
+## optimize() and PPBalance replaced by a scheduler - libraries are run largest first from a priority queue with threads in
+#### proportion to library size (atleast 'nthread'), cores freed by finished libraries are handed to libraries started later
+## Per-library runtime, threads and overall core utilization recorded in runlog
+## De-duplication of FASTA libraries is streaming - tags are counted while reading, sorted partial counts are spilled to
+#### disk beyond 'dedupMem' and merged. Tag count (.fas) file is written sorted on tag
+## Reference and index hashed in chunks. Indexes are recorded in a registry (~/.phaster/index.registry) on reference hash,
+#### and an index built in any other directory is reused if its hash still matches
+## FASTAClean streams reference line by line (gzipped reference supported) and writes clean FASTA and summary in one pass
+## Added python engine (phasclust.py) for phasing analysis selected by '@engine = python' in settings - same outputs as perl scripts
+#### Degradome validation (deg = 'Y') requires perl engine, python engine with it is rejected while reading settings
+## Libraries are mapped once by phaser (mapLibs) and alignments cached in 'alignments' folder on library and index hash,
+#### runs for 21- and 24-nt phase or different noise/hits limits reuse these via '-b' of phaster-core scripts
+
 ## TO-DO
-## Add automatic index resolution
-## Add functionality to share library folder, for 21-,24- and 22nt analysis
@@ -6,7 +6,7 @@
 ## Author: kakrana@udel.edu
 
 
-import sys,os,re,time,timeit,datetime,csv,glob,string,shutil,operator,argparse,re,importlib,collections
+import sys,os,re,time,timeit,datetime,csv,glob,string,shutil,operator,argparse,re,importlib,collections,gzip,mmap
 import subprocess, multiprocessing
 from multiprocessing import Process, Queue, Pool
 from operator import itemgetter
@@ -24,12 +24,14 @@ phaster_path    = "%s/.phaster" % (home)
 ##### DEVELOPER OPTIONS ##########
 nthread         = 6                                         ## Need automatic calculation like nProc
 nproc           = "Y"                                       ## Used by parallel processing
+validChunks     = 4                                         ## Chunks of interactions per process for trigger validation, more chunks balance load better
 
 #### validatePAREby PHAS settings
 PAREpval        = 0.25                                      ## Only if PAREresType == 'S' - Cutoff of corrected p-value to
                                                             ## use to filter out non-relevant predictions
 
 offset          = 1                                         ## 0: No +1/-1 phases scanned 1: In addition to phase +1/-1 sites also checked for trigger
+dumpTemp        = 0                                         ## 1: Write temporary files from in-process sPARTA run (cleaned miRNA file) for debugging | 0: Kept in memory only
 
 
 ### ARGUMENTS ###########################################################
@@ -71,6 +73,9 @@ autoflags.add_argument('-mir',  default='', type=str, help='miRNA file (name) in
 autoflags.add_argument('-libs',  nargs='*', default=[], help='PARE or degradome libraries in FASTA or flat file format '\
     'that will be used to validate PHAS triggers. Multiple libraries names can be seprated by a empty space. Flat file should have unique PARE seqeunces and their counts in tab seprated format')
 
+parser.add_argument('--verbose', action='store_true', default=False, help='print every reverse '\
+    'mapped target entry. Optional parameter')
+
 args = parser.parse_args()
 
 #### SANITY CHECKS ##########################################
@@ -179,6 +184,15 @@ def checkDependency():
         goSignal    = False
         # print("See README for how to INSTALL")
 
+    ### Check numpy - required for reverse mapping
+    isNumpy     = importlib.find_loader('numpy')
+    if isNumpy is None:
+        print("--numpy   : missing")
+        goSignal    = False
+    else:
+        print("--numpy   : found")
+        pass
+
     if args.mode == 'auto':
         ## Check scipy
         isScipy     = importlib.find_loader('scipy')
@@ -189,13 +203,6 @@ def checkDependency():
             print("--scipy   : found")
             pass
 
-        isNumpy     = importlib.find_loader('numpy')
-        if isNumpy is None:
-            print("--numpy   : missing")
-            goSignal    = False
-        else:
-            print("--numpy   : found")
-            pass
 
 
     if goSignal == False:
@@ -335,15 +342,16 @@ def extractSeq(reference,PHASList,phasbuff):
     if not os.path.isfile(fastaclean) and indexflag == True:
         print("\n#### %s - Reference fasta with clean headers not found" % (fastaclean))
         print("\n#### Reference fasta with clean headers will be generated")
-        ### Clean and cache reference
+        ### Clean reference
         mode = "0"
-        fastaclean,fastasumm,fastaD,fastalenD = FASTAClean(reference,mode)
+        fastaclean,fastasumm = FASTAClean(reference,mode)
+        fastaM,faiD = cacheGenome(fastaclean)
     
     elif os.path.isfile(fastaclean) and indexflag == False:
         print("\n#### Reference fasta with clean headers located:%s" %  (fastaclean))
-        print("Caching reference FASTA")
-        ### Cache reference
-        fastaD,fastalenD = cacheGenome(fastaclean)
+        print("Indexing reference FASTA")
+        ### Index reference
+        fastaM,faiD = cacheGenome(fastaclean)
     
     elif os.path.isfile(fastaclean):
         print("** Strange, as you shouldn't have reached to this end of logic")
@@ -351,7 +359,7 @@ def extractSeq(reference,PHASList,phasbuff):
         print("** Reference file with clean headers located in %s will be used" % (fastaclean))
         print("** You might face some issues in revFerno run - Keep this message in mind")
         sleep(2)
-        fastaD,fastalenD = cacheGenome(fastaclean)
+        fastaM,faiD = cacheGenome(fastaclean)
     
     else:
         print("** Strange, as you shouldn't have reached to this end of logic")
@@ -361,11 +369,11 @@ def extractSeq(reference,PHASList,phasbuff):
     #### Get seqeunces for sPARTA analysis
     if runType == 'G' or runType == 'S':
         ### Get PHAS coords file for revampping and seqeunces for sPARTA
-        coordfile,seqfile = fetchSequences(fastaD,fastalenD,PHASList,phasbuff)
+        coordfile,seqfile,seqL = fetchSequences(fastaM,faiD,PHASList,phasbuff)
 
     elif runType == "T":
         ### Get PHAS transcripts (unique ones)
-        coordfile,seqfile = fetchTrans(fastaD,PHASList) ### Coords file is None, as no reverse mapping will be done
+        coordfile,seqfile,seqL = fetchTrans(fastaM,faiD,PHASList) ### Coords file is None, as no reverse mapping will be done
 
     else:
         print("** Invalid @runType value encoutered")
@@ -373,11 +381,12 @@ def extractSeq(reference,PHASList,phasbuff):
         print("** provide correct @runType value and re-run, script will exit now")
         sys.exit()
 
-    return coordfile,seqfile
+    return coordfile,seqfile,seqL
 
-def sPARTA(seqfile,mirnafile,parelibs):
+def sPARTA(seqfile,mirnafile,parelibs,seqL):
     '''
-    [--auto mode] Runs sPARTA on extracted coords (runType = 'G' or 'S') and on extracted transcripts (runType = 'T')
+    [--auto mode] Runs sPARTA on extracted coords (runType = 'G' or 'S') and on extracted transcripts (runType = 'T');
+    sPARTA is imported and run in this process, extracted seqeunces are handed over in memory
     '''
 
     print("\n#### Fn: sPARTA #####################")
@@ -385,13 +394,15 @@ def sPARTA(seqfile,mirnafile,parelibs):
     #### PREPARE ####
     #################
 
-    ### Put files to sparta analysis folder
-    shutil.copy("%s/sPARTA.py" % (phaster_path), "%s/sparta/" % (res_folder)) ### sPARTA script
-    shutil.copy("%s" % (mirnafile), "%s/sparta" % (res_folder)) ### miRNA file
+    ### Import sPARTA from phaster installation
+    if phaster_path not in sys.path:
+        sys.path.insert(0,phaster_path)
+    spartamod     = importlib.import_module("sPARTA")
 
     ### Record path and change to sparta analysis folder for analysis
     analysis_path = os.getcwd()                                     ### Record to change later
     sparta_path   = "%s/%s/sparta/" % (os.getcwd(),res_folder)      ### We need to jump to this path temporarily
+    mirnafile2    = os.path.abspath(mirnafile)                      ### miRNA file is read from analysis folder, not copied
     os.chdir(sparta_path)
     
     ### Now jump to sparta analysis folder
@@ -399,21 +410,16 @@ def sPARTA(seqfile,mirnafile,parelibs):
     print("%s" % (os.getcwd()))
 
     ### 
-    mirnafile2  = mirnafile                             ### Just file name for sparta analysis (and not full path)
     seqfile2    = "%s" % seqfile.rpartition("/")[-1]    ### Just file name for sparta analysis (and not full path), seqeunce file is already in sparta folder
-    # sparta      = "%s/sparta/sPARTA.py" % (res_folder)
 
     ### Run sPARTA, core settings ####
     ##################################
+    spartaargs  = ["-featureFile", seqfile2, "-genomeFeature", "0","-miRNAFile", mirnafile2,"-tarPred", "E", "-tarScore", "-accel", str(nproc)]
+    if dumpTemp == 1:
+        spartaargs.append("--dumpTemp")
 
-    ### Just predict targets
-    if args.predtype == "P":
-        print("Command:")
-        print("python3","sPARTA.py", "-featureFile", seqfile2, "-genomeFeature", "0", "-miRNAFile", mirnafile2,"-tarPred", "-tarScore")
-        retcode = subprocess.call(["python3","sPARTA.py", "-featureFile", seqfile2, "-genomeFeature", "0","-miRNAFile", mirnafile2,"-tarPred", "E", "-tarScore" ])
-
-    ### Validate targets
-    else: 
+    ### Validate targets, to just predict targets core settings are used
+    if args.predtype != "P":
         ### 1. create soft links of file
         libnameL = [] ### List of PARE libnames
         for alib in parelibs:
@@ -422,24 +428,12 @@ def sPARTA(seqfile,mirnafile,parelibs):
             os.symlink(alib,"%s/%s" % (sparta_path,aname))       ### dst is current folder which is sPARTA analysis folder
             libnameL.append(aname)
 
-        pareinput = " ".join(libnameL) ### String input for sPARTA
-        print("Command:")
-
-        ### Approach-1 - Problem with the parelibs input as sPARTA expects a list from command line, providing list too didn;t worked
-        # print("python3","sPARTA.py", "-featureFile", seqfile2, "-genomeFeature", "0", "-miRNAFile", mirnafile2,"-libs", pareinput, "-tarPred", "E", "-tarScore","--tag2FASTA","--map2DD", "--validate")
-        # retcode = subprocess.call(["python3","sPARTA.py", "-featureFile", seqfile2, "-genomeFeature", "0","-miRNAFile", mirnafile2, "-libs", pareinput, "-tarPred", "E", "-tarScore","--tag2FASTA","--map2DD", "--validate"])
-
-        #### Approach-2 - Provide command as through shell
-        acommand = "python3 sPARTA.py -featureFile %s -genomeFeature 0 -miRNAFile %s -libs %s -tarPred E -tarScore --tag2FASTA --map2DD --validate" % (seqfile2,mirnafile2,pareinput)
-        print(acommand)
-        retcode = subprocess.call("%s" % (acommand),shell = True )
-
-    if retcode == 0:
-        pass
-    else:
-        print("Problem with Phasing script - Return code not 0")
-        sys.exit()
+        spartaargs  = spartaargs+["-libs"]+libnameL+["--tag2FASTA","--map2DD", "--validate"]
 
+    print("sPARTA arguments:")
+    print(" ".join(spartaargs))
+    resfile     = spartamod.run(spartaargs,seqL)
+    print("sPARTA results:%s" % (resfile))
 
     ### Back to original PATH
     print("## Leaving sPARTA analysis folder:%s" % (sparta_path))
@@ -458,66 +452,72 @@ def sPARTA(seqfile,mirnafile,parelibs):
 
     return None
 
-def revMapper(ent):
+def revMapper(predTarL):
 
     '''
     Reverse maps coordinates for predicted targets. This is required only in case of predicted targets as validated targets are automatically reverse mapped by sPARTA. The genomic coords for the later are directly read from sPARTA output file
-    by the PARE reader.  
+    by the PARE reader. Target table is loaded as columns and joined with coords on gene name, and coordinates for both strands are computed in bulk
     '''
     ## Gene_coords structure: 1, 'c','AT1G01020', 5928, 8737, protein_coding   
+    import numpy as np
+
+    if not predTarL:
+        return []
+
+    ### Coords table - gene on 'w' strand is used if gene is in both dictionaries
+    coordD      = dict(coord_dict_crick)
+    coordD.update(coord_dict_wat)
+    coordgenes  = np.array(sorted(coordD))
+    coordchr    = np.array([coordD[agene][0] for agene in coordgenes])
+    coordstrand = np.array(['w' if agene in coord_dict_wat else 'c' for agene in coordgenes])
+    coordstart  = np.array([coordD[agene][1] for agene in coordgenes],dtype=np.int64)
+    coordend    = np.array([coordD[agene][2] for agene in coordgenes],dtype=np.int64)
+
+    ### Targets table
+    genes       = np.array([ent[1] for ent in predTarL])
+    bindsites   = np.array([ent[2].split('-') for ent in predTarL],dtype=np.int64).reshape(-1,2)
     
-    # print (ent)
-    mir_name  = ent[0]
-    gene_name = ent[1]
-    bind_site = ent[2].split('-')
+    ### Join on gene name
+    coordidx    = np.searchsorted(coordgenes,genes)
+    coordidx[coordidx == len(coordgenes)] = 0
+    found       = coordgenes[coordidx] == genes if len(coordgenes) else np.zeros(len(genes),dtype=bool)
+    if not found.all():
+        print("%s entries with gene not found in 'w' or 'c' strand are skipped - please check if correct value to -coords parameter supplied" % (np.count_nonzero(~found)))
+        print("First gene not found:%s" % (genes[~found][0]))
+    
+    rowidx      = np.flatnonzero(found)
+    coordidx    = coordidx[found]
+    bindsites   = bindsites[found]
+    chrids      = coordchr[coordidx]
+    strands     = coordstrand[coordidx]
+    watson      = strands == 'w'
 
     ## Reverse map co-ordinates ##########################################################
-    if gene_name in coord_dict_wat:
-        # print ('Entry: %s in positive strand: %s' % (ent[0:4],coord_dict_wat[gene_name]))
-        geno_start  = coord_dict_wat[gene_name][1]  ## Use for reverse mapping of postive genes
-        chr_id      = coord_dict_wat[gene_name][0]
-        strand      = 'w'                           ## Available in dictionary also coord_dict_crick[gene_name][1]
-        gtype       =  coord_dict_wat[gene_name][2] ## Gene type
-        # print("##Info",geno_start,chr_id)
-        
-        new_bind_site_start = (int(geno_start)-1)+int(bind_site[0]) ### reverified in revFerno - OK
-        new_bind_site_end   = (int(geno_start)-1)+int(bind_site[1]) ### reverified in revFerno - OK
-        new_bind_site       = '%s-%s' % (new_bind_site_start,new_bind_site_end)
-
-        if args.predtype == "D":
-            cleave_site = int(ent[8])
-            new_cleave_site     = (int(geno_start)-1)+int(cleave_site)###1 is reduced to give correct positions
-
-    elif gene_name in coord_dict_crick:
-        # print ('Entry: %s in reverse strand: %s' % (ent[0:4],coord_dict_crick[gene_name]))
-        geno_end    = coord_dict_crick[gene_name][2] ## Use for reverse mapping of negative genes
-        chr_id      = coord_dict_crick[gene_name][0]
-        strand      = 'c'                            ## Available in dictionary also coord_dict_crick[gene_name][1]
-        gtype       =  coord_dict_crick[gene_name][2]## Gene type
-        # print("##Info",geno_end,chr_id)
-
-        new_bind_site_end   = (int(geno_end)+1)-int(bind_site[0]) ## As the sequence was reversed before TF and CL, their binding start and end direction has also changed - Verified-OK - reverified in revFerno - OK
-        new_bind_site_start = (int(geno_end)+1)-int(bind_site[1]) ### reverified in revFerno - OK
-        new_bind_site       = '%s-%s' % (new_bind_site_start,new_bind_site_end)
-
-        if args.predtype == "D":
-            cleave_site = int(ent[8])
-            new_cleave_site     = (int(geno_end)+1)-int(cleave_site)###1 is added to give correct positions
-    
-    else:
-        print("Gene could not be found in 'w' or 'c' strand - please check if correct value to -coords parameter supplied")
-        pass
+    ## 'w': (geno_start-1)+site - reverified in revFerno - OK
+    ## 'c': (geno_end+1)-site, as the sequence was reversed before TF and CL, their binding start and end direction has also changed - Verified-OK - reverified in revFerno - OK
+    genostart   = coordstart[coordidx]-1
+    genoend     = coordend[coordidx]+1
+    bindstart   = np.where(watson,genostart+bindsites[:,0],genoend-bindsites[:,1])
+    bindend     = np.where(watson,genostart+bindsites[:,1],genoend-bindsites[:,0])
 
     if args.predtype == "P":
-        print(" Ent: %s %s %s %s | RevMapped: %s %s %s %s" % (mir_name,gene_name,bind_site[0],bind_site[1],str(chr_id),strand,new_bind_site_start,new_bind_site_end))
-        rev_mapped_entry = ("%s,%s,%s,%s,%s" % (','.join(ent),str(chr_id),strand,new_bind_site_start,new_bind_site_end))
+        revmapL = ["%s,%s,%s,%s,%s" % (predTarL[x][0],achr,astrand,astart,aend) for x,achr,astrand,astart,aend in zip(rowidx.tolist(),chrids.tolist(),strands.tolist(),bindstart.tolist(),bindend.tolist())]
+        if args.verbose:
+            for x,achr,astrand,astart,aend in zip(rowidx.tolist(),chrids.tolist(),strands.tolist(),bindstart.tolist(),bindend.tolist()):
+                ent = predTarL[x]
+                print(" Ent: %s %s %s | RevMapped: %s %s %s %s" % (ent[0].split(',',1)[0],ent[1],ent[2].replace('-',' '),achr,astrand,astart,aend))
     else:
-        print(" Ent: %s %s %s %s %s | RevMapped: %s %s %s %s %s" % (mir_name,gene_name,cleave_site,bind_site[0],bind_site[1],str(chr_id),strand,new_cleave_site,new_bind_site_start,new_bind_site_end))
-        rev_mapped_entry = ("%s,%s,%s,%s,%s,%s" % (','.join(ent),str(chr_id),strand,new_cleave_site,new_bind_site_start,new_bind_site_end))
+        cleavesites = np.array([predTarL[x][3] for x in rowidx.tolist()],dtype=np.int64)
+        cleave      = np.where(watson,genostart+cleavesites,genoend-cleavesites)
+        revmapL = ["%s,%s,%s,%s,%s,%s" % (predTarL[x][0],achr,astrand,acleave,astart,aend) for x,achr,astrand,acleave,astart,aend in zip(rowidx.tolist(),chrids.tolist(),strands.tolist(),cleave.tolist(),bindstart.tolist(),bindend.tolist())]
+        if args.verbose:
+            for x,achr,astrand,acleave,astart,aend in zip(rowidx.tolist(),chrids.tolist(),strands.tolist(),cleave.tolist(),bindstart.tolist(),bindend.tolist()):
+                ent = predTarL[x]
+                print(" Ent: %s %s %s %s | RevMapped: %s %s %s %s %s" % (ent[0].split(',',1)[0],ent[1],ent[3],ent[2].replace('-',' '),achr,astrand,acleave,astart,aend))
 
+    print("Entries reverse mapped:%s" % (len(revmapL)))
 
-    
-    return rev_mapped_entry
+    return revmapL
 
 def validatePHAS(ent):
     '''
@@ -553,19 +553,19 @@ def validatePHAS(ent):
     #########################################
     if revmapflag      == True and tarStrand == 'c':                ## Select dict for head or tail scan
         PHASdict        = PHASdict_t    ## Tail scan will be performed
-        strandOffVal    = -2            ## Value used for strandOffset list computations i.e. PHAS coordinates correspond to 'w' strand
+        PHASindex       = PHASindex_t
         # print("-miRNA interaction on 'c' strand - tail scan underway")
         # print("-This is the tail coordinates",PHASdict_t)
 
     elif revmapflag    == True and tarStrand == 'w':              ## Do nothing to cleave site and switch to PHAS dict for tail scan
         PHASdict        = PHASdict_h    ## Head scan will be performed
-        strandOffVal    = +2            ## Value used for strandOffset list computations i.e. PHAS coordinates correspond to 'c' strand
+        PHASindex       = PHASindex_h
         # print("-miRNA interaction on 'w' strand - head scan underway")
         # print("-This is the head coordinates",PHASdict_h)
     
     elif revmapflag    == False:
         PHASdict        = PHASdict_h    ## Only head scan will be performed, in -auto mode since both orientations of transcripts are scanned, head and tail ends are checked already
-        strandOffVal    = +2            ## Value used for strandOffset list computations i.e. PHAS coordinates correspond to 'c' strand
+        PHASindex       = PHASindex_h
         # print("-miRNA interaction on 'w' strand - head scan underway")
 
     else:
@@ -575,112 +575,33 @@ def validatePHAS(ent):
 
     ## Perform validation
     ############################################
+    ## Cleave sites and offset classes in order of preference within a PHAS - exact phase site, dicer offsets (+1, -1)
+    ## and strand offset. If cleave site matches many PHAS, the one read last from PHAS file is reported
     if args.predtype == 'D':
-        ## PHAS LOCI MATCH -  Was not checking for cleave site in exact chromosome - Thats why you got shit load of results where these are scaffolds
-        for akey in PHASdict.keys():
-            aval = PHASdict[akey]
-            # print ('This is the key:', akey, aval)
-            if cleaveSite in aval:
-                    if akey.split('-')[0] == chrid: ## i.e. clevage site is on same chromosme
-                        print('-Match - miRNA:%s | Target:%s |CleaveSite:%s | Strand:%s @ PHAS:%s - %s phase: %d' % (mirName,tarName,cleaveSite,tarStrand,akey,aval,(aval.index(cleaveSite)+1-6))) ## 1 added to correct the index in human format and 6 added because start is at 6th postion
-                        matEnt = ('%s,%s,%s,na' % (ent[5],akey,(aval.index(cleaveSite)+1-6)))
-                        # fh_out.write('%s,%s,%s\n' % (ent[4],akey,(aval.index(cleaveSite)+1-6))) ## +1 to convert to human readable and -6 to get in reference to phase site in phase file
-                    else:
-                        # print ('Cleave site matched phase index but chromosome was different')
-                        pass           
-
-            else:
-                ## Cleave site doesn't matches as is with phase site, try after factoring dicer- and strand- offsets
-                if offset == 1:
-                    aval1 = [x+1 for x in aval] ## Dicer Offset - OK
-                    aval2 = [x-1 for x in aval] ## Dicer Offset - OK
-                    aval3 = [x+strandOffVal for x in aval] ## Strand Offset
-
-                    if cleaveSite in aval1:
-                        if akey.split('-')[0] == chrid: ## i.e. clevage site is on same chromosme
-                            print('\n- Match - miRNA:%s | Target:%s |CleaveSite:%s | Strand:%s @ PHAS:%s - %s phase: %d' % (mirName,tarName,cleaveSite,tarStrand,akey,aval,(aval1.index(cleaveSite)+1-6))) ## 1 added to correct the index in human format and 6 added because start is at 6th postion
-                            matEnt = ('%s,%s,%s,do' % (ent[5],akey,(aval1.index(cleaveSite)+1-6)))
-                            # fh_out.write('%s,%s,%s\n' % (ent[4],akey,(aval1.index(cleaveSite)+1-6))) ## +1 to convert to human readable and -6 to get in reference to phase site in phase file
-                    elif cleaveSite in aval2:
-                        if akey.split('-')[0] == chrid: ## i.e. clevage site is on same chromosme
-                            print('\n-Match - miRNA:%s | Target:%s |CleaveSite:%s | Strand:%s @ PHAS:%s - %s phase: %d' % (mirName,tarName,cleaveSite,tarStrand,akey,aval,(aval2.index(cleaveSite)+1-6))) ## 1 added to correct the index in human format and 6 added because start is at 6th postion
-                            matEnt  = ('%s,%s,%s,do' % (ent[5],akey,(aval2.index(cleaveSite)+1-6)))
-                            # fh_out.write('%s,%s,%s\n' % (ent[4],akey,(aval2.index(cleaveSite)+1-6))) ## +1 to convert to human readable and -6 to get in reference to phase site in phase file
-
-                    elif cleaveSite in aval3:
-                        if akey.split('-')[0] == chrid: ## i.e. clevage site is on same chromosme
-                            print('\n-Match - miRNA:%s | Target:%s |CleaveSite:%s | Strand:%s @ PHAS:%s - %s phase: %d' % (mirName,tarName,cleaveSite,tarStrand,akey,aval,(aval3.index(cleaveSite)+1-6))) ## 1 added to correct the index in human format and 6 added because start is at 6th postion
-                            matEnt  = ('%s,%s,%s,so' % (ent[5],akey,(aval3.index(cleaveSite)+1-6)))
-                    else:
-                        # print ('Cleave site matched phase index but chromosme was different')  
-                        pass
-
-                else:
-                    print("-Offset checking is OFF")
-                    pass
-
+        cleaveL = [cleaveSite]
     elif args.predtype == 'P': ## miRFerno results with two possible cleave sites both needs to be checked
-        
-        for akey in PHASdict.keys():
-            aval = PHASdict[akey]
-            # print ('This is the key:', akey, aval)
-            if cleaveSite1 in aval:
-                if akey.split('-')[0] == chrid: ## i.e. clevage site is on same chromosme
-                    print('-Match: miRNA:%s | Target:%s |CleaveSite:%s | Strand:%s @ PHAS:%s - %s phase: %d' % (mirName,tarName,cleaveSite1,tarStrand,akey,aval,(aval.index(cleaveSite1)+1-6))) ## 1 added to correct the index in human format and 6 added because start is at 6th postion
-                    matEnt = ('%s,%s,%s,na' % (ent[5],akey,(aval.index(cleaveSite1)+1-6)))
-
-            elif cleaveSite2 in aval:
-                if akey.split('-')[0] == chrid: ## i.e. clevage site is on same chromosme
-                    print('-Match: miRNA:%s | Target:%s |CleaveSite:%s | Strand:%s @ PHAS:%s - %s phase: %d' % (mirName,tarName,cleaveSite2,tarStrand,akey,aval,(aval.index(cleaveSite2)+1-6))) ## 1 added to correct the index in human format and 6 added because start is at 6th postion
-                    matEnt = ('%s,%s,%s,na' % (ent[5],akey,(aval.index(cleaveSite2)+1-6)))
-
-            
-            else: ## Cleave site doesnt matches with phase site, try (dicer cut) offsets maybe
-                if offset == 1:
-                    aval1 = [x+1 for x in aval] ## Dicer Offset
-                    aval2 = [x-1 for x in aval] ## Dicer Offset
-                    aval3 = [x+strandOffVal for x in aval] ## Strand Offset
-                    
-                    ### THIS LOOP CAN BE REDUCED by using a list of cleave sites rather than adding loop everytime - It's a joke
-                    if cleaveSite1 in aval1:
-                        if akey.split('-')[0] == chrid: ## i.e. clevage site is on same chromosme
-                            print('-Match: miRNA:%s | Target:%s |CleaveSite:%s | Strand:%s @ PHAS:%s - %s phase: %d' % (mirName,tarName,cleaveSite1,tarStrand,akey,aval,(aval1.index(cleaveSite1)+1-6))) ## 1 added to correct the index in human format and 6 added because start is at 6th postion
-                            matEnt  = ('%s,%s,%s,do' % (ent[5],akey,(aval1.index(cleaveSite1)+1-6)))
-
-                    elif cleaveSite2 in aval1:
-                        if akey.split('-')[0] == chrid: ## i.e. clevage site is on same chromosme
-                            print('-Match: miRNA:%s | Target:%s |CleaveSite:%s | Strand:%s @ PHAS:%s - %s phase: %d' % (mirName,tarName,cleaveSite2,tarStrand,akey,aval,(aval1.index(cleaveSite2)+1-6))) ## 1 added to correct the index in human format and 6 added because start is at 6th postion
-                            matEnt = ('%s,%s,%s,do' % (ent[5],akey,(aval1.index(cleaveSite2)+1-6)))
-                    
-                    elif cleaveSite1 in aval2:
-                        if akey.split('-')[0] == chrid: ## i.e. clevage site is on same chromosme
-                            print('-Match: miRNA:%s | Target:%s |CleaveSite:%s | Strand:%s @ PHAS:%s - %s phase: %d' % (mirName,tarName,cleaveSite1,tarStrand,akey,aval,(aval2.index(cleaveSite1)+1-6))) ## 1 added to correct the index in human format and 6 added because start is at 6th postion
-                            matEnt = ('%s,%s,%s,do' % (ent[5],akey,(aval2.index(cleaveSite1)+1-6)))
-
-                    elif cleaveSite2 in aval2:
-                        if akey.split('-')[0] == chrid: ## i.e. clevage site is on same chromosme
-                            print('-Match: miRNA:%s | Target:%s |CleaveSite:%s | Strand:%s @ PHAS:%s - %s phase: %d' % (mirName,tarName,cleaveSite2,tarStrand,akey,aval,(aval2.index(cleaveSite2)+1-6))) ## 1 added to correct the index in human format and 6 added because start is at 6th postion
-                            matEnt = ('%s,%s,%s,do' % (ent[5],akey,(aval2.index(cleaveSite2)+1-6)))
-
-                   
-                    elif cleaveSite1 in aval3:
-                        if akey.split('-')[0] == chrid: ## i.e. clevage site is on same chromosme
-                            print('-Match: miRNA:%s | Target:%s |CleaveSite:%s | Strand:%s @ PHAS:%s - %s phase: %d' % (mirName,tarName,cleaveSite1,tarStrand,akey,aval,(aval3.index(cleaveSite1)+1-6))) ## 1 added to correct the index in human format and 6 added because start is at 6th postion
-                            matEnt = ('%s,%s,%s,so' % (ent[5],akey,(aval3.index(cleaveSite1)+1-6)))
-
-                    elif cleaveSite2 in aval3:
-                        if akey.split('-')[0] == chrid: ## i.e. clevage site is on same chromosme
-                            print('-Match: miRNA:%s | Target:%s |CleaveSite:%s | Strand:%s @ PHAS:%s - %s phase: %d' % (mirName,tarName,cleaveSite2,tarStrand,akey,aval,(aval3.index(cleaveSite2)+1-6))) ## 1 added to correct the index in human format and 6 added because start is at 6th postion
-                            matEnt = ('%s,%s,%s,so' % (ent[5],akey,(aval3.index(cleaveSite2)+1-6)))
-
-                    else:
-                        # print ('Cleave site matched phase index but chromosme was different')  
-                        pass
-    
+        cleaveL = [cleaveSite1,cleaveSite2]
     else:
         print("Input correct PARE result type in user settings - Script will exit now")
         sys.exit()
 
+    if offset == 1:
+        classL  = ['na','d1','d2','so']
+    else:
+        classL  = ['na']
+
+    matchD      = {} ## PHAS order in file: (PHAS key, phase index, offset class, cleave site) of best match
+    for aclass in classL:
+        for acleave in cleaveL:
+            for n,akey,aphase in PHASindex.get((chrid,acleave,aclass),()):
+                if n not in matchD:
+                    matchD[n] = (akey,aphase,aclass,acleave)
+
+    if matchD:
+        akey,aphase,aclass,acleave = matchD[max(matchD)]
+        matFlag = {'na':'na','d1':'do','d2':'do','so':'so'}[aclass]
+        print('-Match - miRNA:%s | Target:%s |CleaveSite:%s | Strand:%s @ PHAS:%s - %s phase: %d' % (mirName,tarName,acleave,tarStrand,akey,PHASdict[akey],aphase))
+        matEnt = ('%s,%s,%s,%s' % (ent[5],akey,aphase,matFlag))
 
     # ##### LOCAL MODE ###########################################
     # ############################################################
@@ -844,6 +765,44 @@ def PHASreader(PHASfile,collapsephase):
 
     return PHASdict_h,PHASdict_t,phase,PHASList
 
+def PHASindexer(PHASdict,strandOffVal):
+    '''
+    Indexes phase positions of PHAS by chromosome - (chr,position,offset class):[(PHAS order,PHAS key,phase index),..]
+    offset classes are 'na' for phase site, 'd1' and 'd2' for dicer offsets (+1,-1) and 'so' for strand offset
+    '''
+
+    PHASindex   = {}
+    for n,akey in enumerate(PHASdict.keys()):
+        achr    = akey.split('-')[0]
+        aval    = PHASdict[akey]
+        for i,apos in enumerate(aval):
+            aphase = i+1-6 ## 1 added to correct the index in human format and 6 added because start is at 6th postion
+            PHASindex.setdefault((achr,apos,'na'),[]).append((n,akey,aphase))
+            if offset == 1:
+                PHASindex.setdefault((achr,apos+1,'d1'),[]).append((n,akey,aphase))
+                PHASindex.setdefault((achr,apos-1,'d2'),[]).append((n,akey,aphase))
+                PHASindex.setdefault((achr,apos+strandOffVal,'so'),[]).append((n,akey,aphase))
+
+    return PHASindex
+
+def fastaStream(fh_in):
+    '''
+    Reads FASTA line by line, yields header and sequence of one entry at a time
+    '''
+    header  = None
+    seqL    = []    ## Sequence in multiple lines
+    for line in fh_in:
+        if line.startswith('>'):
+            if header is not None:
+                yield header,''.join(seqL)
+            header  = line[1:].strip()
+            seqL    = []
+        elif header is not None:
+            seqL.append(line.strip())
+
+    if header is not None:
+        yield header,''.join(seqL)
+
 def FASTAClean(filename,mode):
     
     '''
@@ -853,8 +812,12 @@ def FASTAClean(filename,mode):
     phaser coords
     '''
     print("\n#### Fn: FASTAClean ######################")
-    ## Read seqeunce file
-    fh_in       = open(filename, 'r')
+    ## Read seqeunce file - gzipped file is read as-is
+    if filename.endswith('.gz'):
+        fh_in       = gzip.open(filename, 'rt')
+        filename    = filename[:-3]
+    else:
+        fh_in       = open(filename, 'r')
     # print ("PHASER uses FASTA header as key for identifying the phased loci")
     print ("++ Cleaning header '%s' reference FASTA file" % (filename))
     
@@ -873,31 +836,23 @@ def FASTAClean(filename,mode):
     fh_out2.write("Name\tLen\n")
     
     ### Read files
-    fasta       = fh_in.read()
-    fasta_splt  = fasta.split('>')
-
-    fastaD      = {}    ## Store FASTA as dict
-    fastalenD   = {}    ## Stores chr/scaffold/trans len
+    nonDigit    = re.compile("[^0-9]")
     acount      = 0     ## count the number of entries
     empty_count = 0
-    for i in fasta_splt[1:]:
-        ent     = i.split('\n')
-        aname   = ent[0].split()[0].strip() ### Clean 
+    for header,seq in fastaStream(fh_in):
+        aname   = header.split()[0] ### Clean 
         
         if runType == 'G':
             ## To match with phasing-core script for genome version which removed non-numeric and preceding 0s
-            name = re.sub("[^0-9]", "", aname).lstrip('0') ### Clean and process
+            name = nonDigit.sub("", aname).lstrip('0') ### Clean and process
         else:
             ## Leave as-is, as phaser-core does not process in runType "S" and "T"
             name = aname
         
-        seq     = ''.join(x.strip() for x in ent[1:]) ## Sequence in multiple lines
         alen    = len(seq)
         if alen > 200:
-            # fh_out1.write('>%s\n%s\n' % (name,seq)) ### No need to write the file
-            # fh_out2.write('%s\t%s\n' % (name,alen)) ### No need to write the file
-            fastaD[name]    = seq
-            fastalenD[name] = alen 
+            fh_out1.write('>%s\n%s\n' % (name,seq)) ### Written for indexed access by cacheGenome, instead of keeping in memory
+            fh_out2.write('%s\t%s\n' % (name,alen))
             acount+=1
         else:
             empty_count+=1
@@ -910,61 +865,108 @@ def FASTAClean(filename,mode):
     print("Fasta file with reduced header: '%s' with total entries %s is prepared" % (fastaclean, acount))
     print("There were %s entries found with empty sequences and were removed\n" % (empty_count))
     
-    return fastaclean,fastasumm,fastaD,fastalenD
+    return fastaclean,fastasumm
 
-def cacheGenome(fastafile):
+def faiIndex(fastafile):
     '''
-    [mode auto, indexFlag = false]. Reference genome was cleaned and accordinagly processed before phaser run. No processing of chr/trascript names required just cache and run - This module could be merged with FASTA clean as repeated procssing wont affect the analysis.
+    Reads index (.fai) of reference FASTA, index is built once (samtools faidx format) and rebuilt only if FASTA is newer
+    than index. Returns dict of chr/scaffold/trans name: (length, offset of seqeunce, bases per line, bytes per line)
     '''
-    print("\n#### Fn: cacheGenome #####################")
+    print("\n#### Fn: faiIndex #########################")
+
+    faifile     = "%s.fai" % (fastafile)
+    faiD        = {}
+
+    if os.path.isfile(faifile) and os.path.getmtime(faifile) >= os.path.getmtime(fastafile):
+        print("Reading index:%s" % (faifile))
+        fh_in   = open(faifile,'r')
+        for line in fh_in:
+            aname,alen,aoffset,linebases,linebytes = line.strip('\n').split('\t')[:5]
+            faiD[aname] = (int(alen),int(aoffset),int(linebases),int(linebytes))
+        fh_in.close()
+        return faiD
+
+    print("Building index:%s" % (faifile))
+    fh_in       = open(fastafile,'rb')
+    aname       = None
+    aoffset     = 0     ## Byte offset of current line
+    for line in fh_in:
+        if line.startswith(b'>'):
+            if aname is not None:
+                faiD[aname] = (alen,seqoffset,linebases,linebytes)
+            aname       = line[1:].split()[0].decode()
+            seqoffset   = aoffset+len(line)
+            alen        = 0
+            linebases   = 0
+            linebytes   = 0
+            lastline    = False ## Shorter line seen, which must be last line of seqeunce
+        
+        elif aname is not None:
+            bases       = len(line.rstrip(b'\r\n'))
+            if bases and lastline:
+                print("** Different line lengths in seqeunce of '%s' - FASTA can't be indexed" % (aname))
+                print("** Please use FASTA with same number of bases per line - Script will exit now")
+                sys.exit()
+            if linebases == 0:
+                linebases   = bases
+                linebytes   = len(line)
+            elif bases != linebases:
+                lastline    = True
+            alen       += bases
+        
+        aoffset += len(line)
 
-    ### Approach-1 Faster when reading Genome files
-    fastaD          = {} ### Dictionary that holds FASTA sequences
-    fastalenD       = {}    ## Stores chr/scaffold/trans len
+    if aname is not None:
+        faiD[aname] = (alen,seqoffset,linebases,linebytes)
+    fh_in.close()
 
-    fh_in           = open(fastafile,'r')
-    fasta           = fh_in.read()
-    fasta_splt      = fasta.split('>')
+    try:
+        fh_out  = open(faifile,'w')
+        for aname,(alen,seqoffset,linebases,linebytes) in faiD.items():
+            fh_out.write("%s\t%s\t%s\t%s\t%s\n" % (aname,alen,seqoffset,linebases,linebytes))
+        fh_out.close()
+    except OSError:
+        print("Index couldn't be written to %s - it will be built again in next run" % (faifile))
 
-    acount          = 0 ## count the number of entries
-    empty_count     = 0
-    for i in fasta_splt[1:]:
-        ent         = i.split('\n')
-        name        = ent[0].split()[0].strip()
-        # print("++ Caching seqeunce: %s" % (name))
+    return faiD
 
-        seq         = ''.join(x.strip() for x in ent[1:]) ## Sequence in multiple lines
-        alen        = len(seq)
-        if alen > 200:
-            acount          +=1
-            fastaD[name]    = seq
-            fastalenD[name] = alen
-        else:
-            empty_count+=1
-            pass
+def cacheGenome(fastafile):
+    '''
+    [mode auto, indexFlag = false]. Reference genome was cleaned and accordinagly processed before phaser run. No processing of chr/trascript names required 
+    just index and memory-map the FASTA, seqeunces are sliced on demand by fetchWindow without reading whole genome in memory
+    '''
+    print("\n#### Fn: cacheGenome #####################")
 
-    # ### Approach-2 - Faster when reading FASTA files fro sRNAs
-    # fastaD              = {} ### Dictionary that holds FASTA sequences
-    # acount              = 0
-    # for line in fh_in:
-    #     if line.startswith('>'):
-    #       name          = line[1:].rstrip('\n').split()[0]
-    #       fastaD[name]  = ''
-    #       print("++ Caching seqeunce: %s" % (name))
-    #       acount        +=1
-    #     else:
-    #       fastaD[name]  += line.rstrip('\n').rstrip('*')
-    
-    # for name,seq in fastaD.items():
-    #     print("sequence %s of length %s cached" % (name,alen))
+    faiD            = faiIndex(fastafile)
+    fh_in           = open(fastafile,'rb')
+    fastaM          = mmap.mmap(fh_in.fileno(),0,access=mmap.ACCESS_READ)
+    fh_in.close()   ## mmap holds its own reference to file
 
-    
-    fh_in.close()
-    print("Total genome chr/scaffolds cached:%s" % (acount))
+    print("Total genome chr/scaffolds indexed:%s" % (len(faiD)))
 
-    return fastaD,fastalenD
+    return fastaM,faiD
 
-def fetchSequences(fastaD,fastalenD,coordsL,abuff):
+def fetchWindow(fastaM,faiD,aname,astart,aend):
+    '''
+    Fetches seqeunce from start to end (1-based and inclusive) of a chr/scaffold/trans from memory-mapped FASTA,
+    window is clamped to the ends of seqeunce i.e. flanks that run over the ends are trimmed
+    '''
+    alen,aoffset,linebases,linebytes = faiD[aname]
+    astart  = max(astart,1)
+    aend    = min(aend,alen)
+    if aend < astart:
+        return ''
+
+    bstart  = aoffset + ((astart-1)//linebases)*linebytes + (astart-1)%linebases
+    bend    = aoffset + ((aend-1)//linebases)*linebytes + (aend-1)%linebases + 1
+    aseq    = fastaM[bstart:bend]
+    if linebases < alen:
+        ## Seqeunce spans multiple lines
+        aseq = aseq.replace(b'\n',b'').replace(b'\r',b'')
+
+    return aseq.decode()
+
+def fetchSequences(fastaM,faiD,coordsL,abuff):
     '''
     Fetches and writes seqeunces, and writes a coords file for revferno
     '''
@@ -974,11 +976,11 @@ def fetchSequences(fastaD,fastalenD,coordsL,abuff):
     seqfile     = "%s/sparta/coords.fas" % (res_folder)
     fh_out1     = open(coordfile,'w')
     fh_out2     = open(seqfile,'w')
+    seqL        = []                                    ## Seqeunces written to seqfile, handed over to sPARTA in memory
 
-    coordsL_s   = sorted(coordsL, key=itemgetter(2))    ## Sorts coords on chr to speed up
-    cachedchrid = 0                                     ## No chromosome loaded
+    coordsL_s   = sorted(coordsL, key=itemgetter(2))    ## Sorts coords on chr, to read genome in order
     
-    ####  Load chromosome, extract seqeunce wih flank for 'w' and 'c' strands
+    ####  Extract seqeunce wih flank for 'w' and 'c' strands from indexed genome
     acount  = 0  
     for i in coordsL_s:
         # print("-- Fetching PHAS:",(i))
@@ -988,44 +990,16 @@ def fetchSequences(fastaD,fastalenD,coordsL,abuff):
         bstart  = astart-abuff  ## Added buffer to seqeunces to identify phasIndex -4 to -1 for 'w' strand, extra buffer on tail below will not be scanned for triggers by revFerno - do not worry
         bend    = aend+abuff    ## Added buffer at tail i.e. head of 'c' strand for phasIndex -4 to -1, extra buffer on tail will not be scanned for trigger by revFerno - do not worry
 
-        if cachedchrid == 0 or cachedchrid != achr:
-            ## Load first chromosome, or if chromos0me encoutered is different from the loaded one then load new one
-            chrseq          = fastaD[achr]
-            cachedchrlen    = fastalenD[achr]
-            cachedchrid     = achr              ## Update the chromosome loaded
-            print("Loaded Chr:%s    |  Length:%s to memory for slicing" % (achr,len(chrseq)))
-            
-
-            ### Coords check
-            if bstart   < 1:
-                bstart  = 1
-                # print("caught")
-                # sys.exit()
-            if bend     > cachedchrlen:
-                bend    = cachedchrlen
-
-            wseq        = chrseq[bstart-1:aend] ## -1 to account for python index which starts from 0 and not 1, no -1 required for end coordinate because slicing will only return end-1, which is precisly your end in python format, 5' flank and no flank on 3'-side
-            cseq        = chrseq[astart-1:bend] ## 3' flank and no flank on 5'-side
-            # print("++ Sequence fetched for %s length: %s for 'w' and %s for 'c' strand" % (aphas,len(wseq), len(cseq)))
-            acount         +=1
-            
-        elif cachedchrid    == achr:
-            ### Uses the loaded chromosome, directly fetch seqeunce
-
-
-            ### Coords check
-            if bstart   < 1:
-                bstart  = 1
-                # print("caught")
-                # sys.exit()
-            if bend     > cachedchrlen:
-                bend    = cachedchrlen
-
-            wseq        = chrseq[bstart-1:aend] ## 5' ## -1 to account for python index which starts from 0 and not 1, no -1 required for end coordinate because slicing will only return end-1, which is precisly your end in python format, 5' flank and no flank on 3'-side
-            cseq        = chrseq[astart-1:bend] ## 3' flank and no flank on 5'-side
-            # print("++ Sequence fetched for %s length: %s for 'w' and %s for 'c' strand" % (aphas,len(wseq), len(cseq)))
-            acount         +=1
+        ### Coords check
+        if bstart   < 1:
+            bstart  = 1
+        if bend     > faiD[achr][0]:
+            bend    = faiD[achr][0]
 
+        wseq        = fetchWindow(fastaM,faiD,achr,bstart,aend) ## 5' flank and no flank on 3'-side
+        cseq        = fetchWindow(fastaM,faiD,achr,astart,bend) ## 3' flank and no flank on 5'-side
+        # print("++ Sequence fetched for %s length: %s for 'w' and %s for 'c' strand" % (aphas,len(wseq), len(cseq)))
+        acount         +=1
 
         #### Write seqeunces and coords #######
         ####
@@ -1033,11 +1007,14 @@ def fetchSequences(fastaD,fastalenD,coordsL,abuff):
             wname = "%s_%s_%s_%s_w" % (aphas,achr,bstart,aend) ## Name for coords file
             fh_out1.write("%s,w,%s,%s,%s,gene\n" % (achr,wname,bstart,aend))
             fh_out2.write(">%s\n%s\n" % (wname,wseq))
+            seqL.append((wname,wseq))
 
         elif astrand    == "c":
             cname = "%s_%s_%s_%s_c" % (aphas,achr,astart,bend) ## Name for coords file
+            crseq = cseq[::-1].translate(str.maketrans("tagcTAGC","atcgATCG"))
             fh_out1.write("%s,c,%s,%s,%s,gene\n" % (achr,cname,astart,bend))
-            fh_out2.write(">%s\n%s\n" % (cname,cseq[::-1].translate(str.maketrans("tagcTAGC","atcgATCG"))))
+            fh_out2.write(">%s\n%s\n" % (cname,crseq))
+            seqL.append((cname,crseq))
 
         elif astrand    == "NONE":
             ### phaser results have NONE for strand, write both strands
@@ -1047,8 +1024,11 @@ def fetchSequences(fastaD,fastalenD,coordsL,abuff):
             fh_out1.write("%s,w,%s,%s,%s,gene\n" % (achr,wname,bstart,aend))
             fh_out1.write("%s,c,%s,%s,%s,gene\n" % (achr,cname,astart,bend))
             
+            crseq = cseq[::-1].translate(str.maketrans("tagcTAGC","atcgATCG"))
             fh_out2.write(">%s\n%s\n" % (wname,wseq))
-            fh_out2.write(">%s\n%s\n" % (cname,cseq[::-1].translate(str.maketrans("tagcTAGC","atcgATCG"))))
+            fh_out2.write(">%s\n%s\n" % (cname,crseq))
+            seqL.append((wname,wseq))
+            seqL.append((cname,crseq))
         
         else:
             print("** Unexpected strand encountered:%s" % (astrand))
@@ -1061,9 +1041,9 @@ def fetchSequences(fastaD,fastalenD,coordsL,abuff):
 
     print("PHAS entries:%s | Seqeunces extracted:%s" % (len(coordsL),acount))
 
-    return coordfile,seqfile
+    return coordfile,seqfile,seqL
 
-def fetchTrans(fastaD,coordsL):
+def fetchTrans(fastaM,faiD,coordsL):
     '''
     Fetches transcripts from transcriptome FASTA, sice it's the real trnscript, no revrse mapping will be done so not coords file generated like the getchSeqeunces function
     '''
@@ -1073,6 +1053,7 @@ def fetchTrans(fastaD,coordsL):
     coordsfile  = None
     seqfile     = "%s/sparta/trans.fas" % (res_folder)
     fh_out      = open(seqfile,'w')
+    seqL        = []                                    ## Seqeunces written to seqfile, handed over to sPARTA in memory
 
     transset    = set()
     acount      = 0
@@ -1083,8 +1064,9 @@ def fetchTrans(fastaD,coordsL):
         if achr not in transset:
             ### This will avoid writing the same transcript twice if it had two PHAS
             # print(achr)
-            aseq = fastaD[achr] ### chromosome is transcripts ID
+            aseq = fetchWindow(fastaM,faiD,achr,1,faiD[achr][0]) ### chromosome is transcripts ID
             fh_out.write(">%s\n%s\n" % (achr,aseq))
+            seqL.append((achr,aseq))
             transset.add(achr)
             acount += 1
 
@@ -1092,7 +1074,7 @@ def fetchTrans(fastaD,coordsL):
 
     fh_out.close()
 
-    return coordsfile,seqfile
+    return coordsfile,seqfile,seqL
 
 def formatguess(alib):
     '''
@@ -1125,7 +1107,8 @@ def formatguess(alib):
 def parsePredicted(predTarF):
     '''
     parses mirferno results for reverse mapping,module is PATH resistant i.e. if filename has lonh PATH it wont affect 
-    analysis
+    analysis. File is streamed and score cutoff applied while parsing; only the entry and columns required by revMapper
+    are kept i.e. (entry,target,bindsite,cleavesite)
     '''
 
     print("\n#### Fn: miRferno Parser ##################")
@@ -1137,19 +1120,18 @@ def parsePredicted(predTarF):
 
     fh_in       = open("%s" % predTarF, 'r')    ## PARE VALIDATED results
     predheader  = fh_in.readline()              ## waste header
-    aread       = fh_in.readlines()
     
-    acount      = 0
-
-    for res in aread:
-        ent    = res.strip('\n').split(',')
+    for res in fh_in:
+        res     = res.strip('\n')
+        ent     = res.split(',',9)              ## Columns upto cleave site (validated) are required
         if ent[0] == "miRname":
             # print("Header left in concatanated file")
             pass
         else:
             acount      +=1
             if float(ent[5]) <= args.score:
-                predTarL.append(ent)
+                cleavesite = ent[8] if len(ent) > 8 else None
+                predTarL.append((res,ent[1],ent[2],cleavesite))
                 bcount+= 1
             else:
                 # print("Below user provides score threshold")
@@ -1166,7 +1148,8 @@ def tarReader(PAREres,PAREpval):
     featureFile). As, in later local coordinates will be read while in earlier revmapped coordinates in sPARTA output
     will be read. On other hand, in case of predicted same thing is checked if predicted results are from genomic analysis
     in which reverse mapping will be performed by reverFerno while in case of predicted results from being transcriptome
-    analysis reverse mapping is skipped and local coords read.   
+    analysis reverse mapping is skipped and local coords read. File is streamed, p-val/score cutoff applied while parsing
+    and entries split only upto the last column required
     '''
 
 
@@ -1176,54 +1159,45 @@ def tarReader(PAREres,PAREpval):
     
     fh_in   = open(PAREres, 'r')
     header  = fh_in.readline() ## Header
-    entries = fh_in.readlines()
     acount  = 0  ## Total entries
     bcount  = 0  ## Filtered entries on targetScore (predicted) or p-value (validated)
     resList = [] ## miRNA,Target,cleavesite,whole entry
     # print ("\n\n\nCreating list of cleave sites\n")
 
     if args.predtype == 'D' and revmapflag == False: ## Degradome validation done but using transcripts i.e. feature file option. No reverse mapping performed and columns in validated output would be different
-        for i in entries:
-            # print ("\nEnt:",i.strip('\n'))
+        for i in fh_in:
             acount      += 1  ## Total entries
-            ent_splt    = i.split(',')
-            #print("\nThis is target entry",ent_splt[13])
+            ent_splt    = i.split(',',15)
             if float(ent_splt[14])  <= PAREpval:
                 cleaveSite          = int(ent_splt[8])
-                #print(cleaveSite)
                 tarName = ent_splt[1]
                 mirName = ent_splt[0]
                 chrid   = ent_splt[1] ## In local mode (When feature file used) there is no chr_id, only transcripts
                 strand  = 'None'
                 resList.append((mirName,tarName,cleaveSite,chrid,strand,i.strip('\n')))
-                # print(mirName,tarName,cleaveSite)
-                bcount += 0
+                bcount += 1
     
 
     elif args.predtype == 'D' and revmapflag == True: ## Degradome validation done using genome, validated file will have revmapped targets 
-        for i in entries:
-            # print ("\nEnt:",i.strip('\n'))
+        for i in fh_in:
             acount      += 1  ## Total entries
-            ent_splt    = i.split(',')
-            # print("\nThis is target entry p-val:",ent_splt[13])
+            ent_splt    = i.split(',',18)
             if float(ent_splt[13])  <= PAREpval:
                 cleaveSite          = int(ent_splt[17])
-                #print(cleaveSite)
                 mirName = ent_splt[0]
                 tarName = ent_splt[1]
                 chrid   = ent_splt[15]
                 strand  = ent_splt[16]
                 resList.append((mirName,tarName,cleaveSite,chrid,strand,i.strip('\n')))
-                # print("\nList values for this entry",mirName,tarName,cleaveSite,chrid,strand,i.strip('\n'))
                 bcount += 1
 
 
     elif args.predtype == 'P' and revmapflag == False: ## miRferno was run using feature file option i.e. directly on transcriptome, so no reversmapping done or needs to be done in revFerno or sPARTA
-        for i in entries:
-            print ("\nEnt:",i.strip('\n'))
+        for i in fh_in:
+            if args.verbose:
+                print ("\nEnt:",i.strip('\n'))
             acount += 1  ## Total entries
-            ent_splt = i.strip('\n').split(',')
-            # print("\nThis is target entry",ent_splt)
+            ent_splt = i.split(',',6)
             if float(ent_splt[5])   <= args.score:
                 bindStart,bindEnd   = ent_splt[2].split("-")
                 cleaveSite1         = int(bindEnd)-10+1 ## 10th pos +1  - tested and corrected - Draw a miRNA-target interaction and try computing - This is correct
@@ -1231,28 +1205,22 @@ def tarReader(PAREres,PAREpval):
                 # cleaveSite3 = int(bindEnd)-12+1 ## 12th pos +1  - tested and corrected - Draw a miRNA-target interaction and try computing - This is correct ## Added after observing that 2275 cleaves a major portion at 13th pos
                 # cleaveSite4 = int(bindEnd)-13+1 ## 13th pos +1 - tested and corrected - Draw a miRNA-target interaction and try computing - This is correct
                 cleaveSite          = (cleaveSite1,cleaveSite2)
-                # print(cleaveSite)
                 mirName             = ent_splt[0]
                 tarName             = ent_splt[1]
                 chrid               = ent_splt[1] ## In local mode there is no chr_id, only transcripts
                 strand              = 'None'
                 resList.append((mirName,tarName,cleaveSite,chrid,strand,i.strip('\n')))
-                # print("List values for this entry",mirName,tarName,cleaveSite,chrid,i.strip('\n'))
                 bcount += 1
 
 
 
     elif args.predtype == 'P' and revmapflag == True: ## miRferno predicted targets using the genome and revmapping was done in revFerno above
-        for i in entries:
-            # print ("\nEnt:",i.strip('\n'))
+        for i in fh_in:
             acount += 1  ## Total entries
-            ent_splt    = i.strip('\n').split(',')
-            chrid       = ent_splt[8] ## In local mode there is no chr_id, only transcripts
-            strand      = ent_splt[9]
-            # print("\nThis is target entry",ent_splt)
+            ent_splt    = i.split(',',12)
             if float(ent_splt[5]) <= args.score:
-                # print("pass")
-                bindStart   = ent_splt[10]
+                chrid       = ent_splt[8] ## In local mode there is no chr_id, only transcripts
+                strand      = ent_splt[9]
                 bindEnd     = ent_splt[11]
                 if strand == "c":
                     ## This is to accomodate 13th position validation observed for 'c' strand
@@ -1264,16 +1232,15 @@ def tarReader(PAREres,PAREpval):
                     cleaveSite1 = int(bindEnd)-10+1 ## 10th pos +1  - tested and corrected - Draw a miRNA-target interaction and try computing - This is correct
                     cleaveSite2 = int(bindEnd)-11+1 ## 11th pos +1 - tested and corrected - Draw a miRNA-target interaction and try computing - This is correct
                     cleaveSite  = (cleaveSite1,cleaveSite2)
-                # print(cleaveSite)
                 mirName     = ent_splt[0]
                 tarName     = ent_splt[1]
                 resList.append((mirName,tarName,cleaveSite,chrid,strand,i.strip('\n')))
-                # print("List values for this entry:",mirName,tarName,cleaveSite,chrid)
                 bcount += 1
         
     else:
         pass
 
+    fh_in.close()
     print("Input file:%s" % (PAREres))
     print("File entries:%s | Passed p-val/score:%s | List length:%s" % (acount,bcount,len(resList)))
     
@@ -1377,19 +1344,14 @@ def revmapWriter(revmapL,predheader,afile):
     else:
         revmapF     = './%s/%s_revmapped.csv' % (res_folder,afile)
     
-    fh_out      = open(revmapF, 'w')
+    fh_out      = open(revmapF, 'w', buffering=8388608)
     if args.predtype == "D":
         fh_out.write('%s,Chr,Strand,GenomicCleaveSite,GenomicBindStart,GenomicBindEnd\n' % (predheader.strip('\n')))
     else:
         fh_out.write('%s,Chr,Strand,GenomicBindStart,GenomicBindEnd\n' % (predheader.strip('\n')))
 
-    for i in revmapL: ## Write Results from list to file
-        if i != 'E13-3-13':##Filter for error 13-13-13 that is small window abundance = 0 and ratio calculation error
-            fh_out.write('%s\n' % (i))
-        else:
-            print (i)
-            pass
-
+    ## Write Results from list to file in one pass - Filter for error 13-13-13 that is small window abundance = 0 and ratio calculation error
+    fh_out.write(''.join(['%s\n' % (i) for i in revmapL if i != 'E13-3-13']))
     fh_out.close()
 
     return revmapF
@@ -1442,6 +1404,46 @@ def PPResults(module,alist):
     npool.close()           ### Added by Reza to close hanging 
     return results
 
+def validateInit(atriggerL,aindex_h,aindex_t,adict_h,adict_t):
+    '''
+    Pool initializer for validateChunk - interactions, PHAS index and dictionaries are handed to workers once at fork
+    and shared read-only, instead of being pickled with every task
+    '''
+    global triggerL,PHASindex_h,PHASindex_t,PHASdict_h,PHASdict_t
+    triggerL    = atriggerL
+    PHASindex_h = aindex_h
+    PHASindex_t = aindex_t
+    PHASdict_h  = adict_h
+    PHASdict_t  = adict_t
+
+    return None
+
+def validateChunk(arange):
+    '''
+    Validates a chunk (start,end) of interactions from triggerL set by validateInit
+    '''
+    astart,aend = arange
+    return [validatePHAS(ent) for ent in triggerL[astart:aend]]
+
+def PPValidate(resList):
+    '''
+    Dispatches validatePHAS in large chunks of interactions - only chunk coordinates are sent to workers, results are
+    returned in order of chunks and so same order as resList
+    '''
+    nchunks     = int(nproc)*validChunks
+    achunk      = max(1,-(-len(resList)//nchunks)) ## Ceil
+    rangeL      = [(x,x+achunk) for x in range(0,len(resList),achunk)]
+    print("Interactions:%s | Chunks:%s of %s interactions" % (len(resList),len(rangeL),achunk))
+
+    npool       = Pool(int(nproc),initializer=validateInit,initargs=(resList,PHASindex_h,PHASindex_t,PHASdict_h,PHASdict_t))
+    chunkL      = npool.map(validateChunk,rangeL,chunksize=1)
+    npool.close()
+    npool.join()
+
+    validPHAS   = [matEnt for achunk in chunkL for matEnt in achunk]
+
+    return validPHAS
+
 #### DE-DUPLICATOR MODULES ####
 def dedup_process(alib):
     '''
@@ -1550,6 +1552,8 @@ def main():
     global indexflag
     global PHASdict_h
     global PHASdict_t
+    global PHASindex_h
+    global PHASindex_t
     global PHASdict_b
     global header
     
@@ -1590,14 +1594,14 @@ def main():
 
         ### Extract genome coords and PHAS transcripts or transcripts from transcriptome
         phasbuff                = int(phase)*5 ## Flaking buffer to add to the extracted PHAS transcript for runType = 'G' and 'S'
-        coordsfile,extractseq   = extractSeq(reference,PHASList,phasbuff) ## runType aware
+        coordsfile,extractseq,extractL = extractSeq(reference,PHASList,phasbuff) ## runType aware
         
         ### Run sPARTA 
         if args.predtype        == "P":
             # print("#### Trigger validation will be done based on predicted targets")
             ## No PARE libraries, so just predict targets
             parelibs            = None                 ### No PARE libraries
-            sPARTA(extractseq,args.mir,parelibs)
+            sPARTA(extractseq,args.mir,parelibs,extractL)
         else:
             ## Prepare PARE libraries and copy to sPARTA
             # print("#### Trigger validation will be done based on validated targets")
@@ -1605,10 +1609,10 @@ def main():
             formatflag          = formatguess(args.libs[0])                ### Guess format for PARE files that user provides
             if formatflag       == "fas":               
                 parelibs        = PPResults(dedup_process,args.libs)       ### Converted to tag-count
-                sPARTA(extractseq,args.mir,parelibs)                    ### Run sPARTA on converted files
+                sPARTA(extractseq,args.mir,parelibs,extractL)           ### Run sPARTA on converted files
             elif formatflag     == "count":
                 parelibs        = ["%s/%s" % (os.getcwd(),alib) for alib in args.libs] ## Matches with dedup results
-                sPARTA(extractseq,args.mir,parelibs)                    ### Run sPARTA on tag count files directly
+                sPARTA(extractseq,args.mir,parelibs,extractL)           ### Run sPARTA on tag count files directly
                 
         
         predTarL,predheader     = parsePredicted(args.predfile) ### args.predfile path is filled in arguments section
@@ -1618,14 +1622,7 @@ def main():
             prepareCoordsDict(coordsfile) ### Prepare coords dict
             
             print("\n#### Fn: revMapper ########################")
-            # ### TEST - Serial Mode #######
-            # print('\n***Entering RevMapCoord- Serial***\n')
-            # revmapL = []
-            # for i in predTarL:
-            #     # print("\nEntry for reverse mapping:%s" % (i))
-            #     z = revMapper(i)
-            #     revmapL.append(z)
-            revmapL         = PPResults(revMapper, predTarL) ## Results are in form of list
+            revmapL         = revMapper(predTarL) ## Results are in form of list
             # print('Reverse mapping complete for:%s' % (args.predfile))
             # time.sleep(1)
 
@@ -1663,19 +1660,8 @@ def main():
             ### REVERSE MAP ####
             print("\n#### Fn: Reverse Mapper ####################") 
             
-            #### TEST - Serial Mode #######
-            # print('\n***Entering RevMapCoord- Serial***\n')
-            # revmapL = []
-            # for i in predTarL:
-            #     # print("\nEntry for reverse mapping:%s" % (i))
-            #     z = RevMapCoord(i)
-            #     revmapL.append(z)
-            
-            ### Default - parallelized mode - uncomment serial mode above after testing
-            print('***Entering RevMapCoord- parallel***')
-            revmapL = PPResults(revMapper, predTarL) ## Results are in form of list
+            revmapL = revMapper(predTarL) ## Results are in form of list
             print('Reverse mapping complete for:%s' % (args.predfile))
-            time.sleep(1)
 
             revmapF         = revmapWriter(revmapL,predheader,args.predfile)
             resList,header  = tarReader(revmapF,PAREpval)      ### Reads reverse mapped file - Are columns same as PARE file?
@@ -1690,6 +1676,12 @@ def main():
     if args.dir is not "":
         
         print("\n#### Fn: Trigger Predictor #################")
+        if offset != 1:
+            print("-Offset checking is OFF")
+        PHASindex_h = PHASindexer(PHASdict_h,+2)   ## Head scan - strand offset for PHAS coordinates on 'c' strand
+        PHASindex_t = PHASindexer(PHASdict_t,-2)   ## Tail scan - strand offset for PHAS coordinates on 'w' strand
+        print("Phase sites indexed:%s" % (len(PHASindex_h)))
+
         #### TEST - Serial Mode #######
         # validPHAS = [] ## Store results
         # for i in resList:
@@ -1697,7 +1689,7 @@ def main():
         #     validPHAS.append(matEnt)
 
         ### DEFAULT - parallelized mode - uncomment serial mode above after testing ##
-        validPHAS   = PPResults(validatePHAS,resList) ## Results are in form of list
+        validPHAS   = PPValidate(resList) ## Results are in form of list, in order of resList
         validphasF  = revfernoWriter(validPHAS,resList,PHASdict_h,args.predfile)
 
     else:
@@ -1744,6 +1736,15 @@ if __name__ == '__main__':
 ## v099 -> v1.0 [major]
 ## Fixed issues related with runType mode "T"
 
+## v1.0 -> v1.01
+## FASTAClean streams reference line by line (gzipped reference supported) instead of reading and splitting whole file
+## validatePHAS looks up cleave sites in chromosome-bucketed index of phase and offset sites instead of scanning all PHAS
+## sPARTA is imported and run in-process with extracted seqeunces handed over in memory, instead of copying and calling sPARTA.py as subprocess
+## Reference is indexed (.fai, built once) and memory-mapped, fetchSequences and fetchTrans slice windows on demand instead of caching genome in memory
+## revMapper joins target table with coords on gene name and maps both strands in bulk with numpy, no process pool; per-entry prints with --verbose
+## validatePHAS is dispatched in large chunks by PPValidate, interactions and PHAS index are handed to workers once by pool initializer
+## parsePredicted and tarReader stream the targets file and apply score/p-val cutoff while parsing, entries split only upto columns required
+
 #### POTENTIAL ISSUES
 ## 1. If a user uses his own index which is made from un-clean FASTA file. In that case.
 #### no clean fasta file will be located and will be made by revferno. This cleaned up file
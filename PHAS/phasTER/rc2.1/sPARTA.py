@@ -74,93 +74,106 @@ parser.add_argument('-splitCutoff', default=20, help=argparse.SUPPRESS)
 parser.add_argument('-maxHits', default=30, help=argparse.SUPPRESS)
 parser.add_argument('--cat4Show', action='store_false', default=True,
     help=argparse.SUPPRESS)
+parser.add_argument('--dumpTemp', action='store_true', default=False,
+    help=argparse.SUPPRESS)
+
+args = None ## Set by sPARTAArgs, from command line or from argument list of a calling script
 
-args = parser.parse_args()
-
-### Various checks for dependencies within command line arguments
-
-# If either annotation or genome file is given without the other and
-# featureFile is not given, exit.
-if(((args.annoFile and not args.genomeFile) or (args.genomeFile and not
-        args.annoFile)) and (not args.featureFile)):
-    print("annoFile and genomeFile both must be provided to extract seqeunces")
-    exit()
-
-# If annoType is provided and not GFF or GTF, report the error and exit
-if(args.annoType and args.annoType != 'GFF' and args.annoType != 'GTF'):
-    print("annoType must be either GFF3 or GTF")
-    exit()
-
-# If either the annotation file or annotation type is given without the other,
-# exit.
-if((args.annoType and not args.annoFile) or (args.annoFile and not
-        args.annoType)):
-    print("annoType and annoFile must both be give to parse either the GFF "\
-    "or GTF file.")
-    exit()
-
-# If the user input both a genome and feature file, exit as both cannot be
-# supplied for proper execution
-if(args.genomeFile and args.featureFile):
-    print("genomeFile and featureFile cannot both be supplied for execution")
-    exit()
-
-# If annoFile and genomeFile are given turn on extraction, frag and index steps
-# must be set on
-if(args.annoFile and args.genomeFile):
-    args.generateFasta = True
-    args.fileFrag = True
-    args.indexStep = True
-
-# If featureFile is given, frag and index steps must be set on
-if(args.featureFile):
-    # If featureFile is given and annoFile is given, give a warning letting
-    # user know the annoFile will be ignored and the input fasta file may
-    # have been intended as a genomeFile
-    if(args.annoFile):
-        print("Warning: You have input a annoFile but input a FASTA file as "\
-        "the featureFile. If you intended for this to be used in conjunction "\
-        "with the annotation file to create a feature file, please press "\
-        "'ctrl+c' to cancel the execution and rerun with the FASTA file "\
-        "under the argument 'genomeFile'. If this is in fact the feature "\
-        "file, allow sPARTA to continue its execution.")
-        time.sleep(10)
-    args.fileFrag = True
-    args.indexStep = True
-
-# If indexStep is on and tarPred is off, turn tarPred and tarScore on
-if(args.indexStep):
-    if(not args.tarPred):
-        args.tarPred = 'H'
-    if(not args.tarScore):
+def sPARTAArgs(argList=None):
+    '''
+    Parses sPARTA arguments from command line or from argList when sPARTA is run
+    in-process by another script, and checks dependencies between them
+    '''
+
+    global args
+    args = parser.parse_args(argList)
+
+    ### Various checks for dependencies within command line arguments
+
+    # If either annotation or genome file is given without the other and
+    # featureFile is not given, exit.
+    if(((args.annoFile and not args.genomeFile) or (args.genomeFile and not
+            args.annoFile)) and (not args.featureFile)):
+        print("annoFile and genomeFile both must be provided to extract seqeunces")
+        exit()
+
+    # If annoType is provided and not GFF or GTF, report the error and exit
+    if(args.annoType and args.annoType != 'GFF' and args.annoType != 'GTF'):
+        print("annoType must be either GFF3 or GTF")
+        exit()
+
+    # If either the annotation file or annotation type is given without the other,
+    # exit.
+    if((args.annoType and not args.annoFile) or (args.annoFile and not
+            args.annoType)):
+        print("annoType and annoFile must both be give to parse either the GFF "\
+        "or GTF file.")
+        exit()
+
+    # If the user input both a genome and feature file, exit as both cannot be
+    # supplied for proper execution
+    if(args.genomeFile and args.featureFile):
+        print("genomeFile and featureFile cannot both be supplied for execution")
+        exit()
+
+    # If annoFile and genomeFile are given turn on extraction, frag and index steps
+    # must be set on
+    if(args.annoFile and args.genomeFile):
+        args.generateFasta = True
+        args.fileFrag = True
+        args.indexStep = True
+
+    # If featureFile is given, frag and index steps must be set on
+    if(args.featureFile):
+        # If featureFile is given and annoFile is given, give a warning letting
+        # user know the annoFile will be ignored and the input fasta file may
+        # have been intended as a genomeFile
+        if(args.annoFile):
+            print("Warning: You have input a annoFile but input a FASTA file as "\
+            "the featureFile. If you intended for this to be used in conjunction "\
+            "with the annotation file to create a feature file, please press "\
+            "'ctrl+c' to cancel the execution and rerun with the FASTA file "\
+            "under the argument 'genomeFile'. If this is in fact the feature "\
+            "file, allow sPARTA to continue its execution.")
+            time.sleep(10)
+        args.fileFrag = True
+        args.indexStep = True
+
+    # If indexStep is on and tarPred is off, turn tarPred and tarScore on
+    if(args.indexStep):
+        if(not args.tarPred):
+            args.tarPred = 'H'
+        if(not args.tarScore):
+            args.tarScore = 'S'
+
+    # If tarPred is on, then tarScore will default to S
+    if(args.tarPred and not args.tarScore):
         args.tarScore = 'S'
 
-# If tarPred is on, then tarScore will default to S
-if(args.tarPred and not args.tarScore):
-    args.tarScore = 'S'
+    # If tarPred is on, then miRNAFile must be provided
+    if(args.tarPred and not args.miRNAFile):
+        print("miRNA file must be given to perform target prediction")
+        exit()
 
-# If tarPred is on, then miRNAFile must be provided
-if(args.tarPred and not args.miRNAFile):
-    print("miRNA file must be given to perform target prediction")
-    exit()
+    # If tag2FASTA is on, turn map2DD on
+    if(args.tag2FASTA and not args.map2DD):
+        args.map2DD = True
 
-# If tag2FASTA is on, turn map2DD on
-if(args.tag2FASTA and not args.map2DD):
-    args.map2DD = True
+    # If tag2FASTA is on, then libraries must be defined
+    if(args.tag2FASTA and not args.libs):
+        print("libs must be assigned to perform tag2FASTA")
+        exit()
 
-# If tag2FASTA is on, then libraries must be defined
-if(args.tag2FASTA and not args.libs):
-    print("libs must be assigned to perform tag2FASTA")
-    exit()
+    # If validate is on, then libraries must be input
+    if(args.validate and not args.libs):
+        print("At least one library must be given to perfor the validate")
+        exit()
 
-# If validate is on, then libraries must be input
-if(args.validate and not args.libs):
-    print("At least one library must be given to perfor the validate")
-    exit()
 
+    # genomeFeature must be an integer
+    args.genomeFeature = int(args.genomeFeature)
 
-# genomeFeature must be an integer
-args.genomeFeature = int(args.genomeFeature)
+    return args
 
 ####################################################################
 #### sPARTA FUNCTIONS ##############################################
@@ -816,9 +829,10 @@ def miRinput():
         pass    
 
     mirL                = [] ## List to store miRNAs
-    outfile             = ('%s_clean_revcomp.fa' % (args.miRNAFile))
-    miRNA_file_clean    = cleanHeader(args.miRNAFile,outfile)#
-    fh_miRNA            = open(miRNA_file_clean, 'r')
+    if args.dumpTemp:
+        outfile         = ('%s_clean_revcomp.fa' % (args.miRNAFile))
+        cleanHeader(args.miRNAFile,outfile) ## Headers are cleaned in memory below, file is for debugging only
+    fh_miRNA            = open(args.miRNAFile, 'r')
     fh_out2             = open('miRinput_RevComp.fa', 'w')
     mir_base            = fh_miRNA.read()
     mir_blocks          = mir_base.split('>')
@@ -826,7 +840,7 @@ def miRinput():
         #print (i)
         block       = i.strip('\n')
         ent         = block.split('\n')
-        miRname     = ent[0]
+        miRname     = ent[0].split()[0].split('|')[0] ## Clean header
         miRseq_rc   = ent[1].translate(str.maketrans("AUTGC","TAACG"))[::-1]
 
         mirL.append((miRname,'None','None',miRseq_rc))## 
@@ -1475,6 +1489,8 @@ def PP(module,alist):
     print('\nnprocPP:%s\n' % (nprocPP))
     npool = Pool(int(nprocPP))
     npool.map(module, alist)
+    npool.close() ## Workers are released when sPARTA is run in-process
+    npool.join()
     
 def PPmultiple(module,alist1,alist2):
     start = time.time()
@@ -1831,7 +1847,7 @@ def createPAGeIndex(bowtieFilename):
 
     return(PAGeDict, allHits)
 
-def unambiguousBaseCounter(transcriptomeFilename, minTagLen):
+def unambiguousBaseCounter(transcriptomeFilename, minTagLen, fastaList=None):
     """Get the counts of ambiguous bases in the transcriptome file as well
        as counts of ambiguous bases that are within the ends of the
        transcriptome - the minTagLen.
@@ -1840,6 +1856,8 @@ def unambiguousBaseCounter(transcriptomeFilename, minTagLen):
         transcriptomeFilename: Name of the trnascritome fasta file
         minTagLen: Number of bases that an N is allowed to be away from the ends
             of the gene in order to be counted
+        fastaList: List of (name,seq) of the transcriptome file if already in
+            memory, file is not read again
 
     Returns:
         Total number of ambiguous bases and ambiguous bases minTagLen-bp away from
@@ -1848,9 +1866,13 @@ def unambiguousBaseCounter(transcriptomeFilename, minTagLen):
     """
     baseCounts, baseCountsOffTagLen = 0, 0
 
-    transcriptomeFile = readFile(transcriptomeFilename)
-    for i in range(1,len(transcriptomeFile),2):
-        currentLine = transcriptomeFile[i]
+    if fastaList is not None:
+        seqList = [aseq for aname,aseq in fastaList]
+    else:
+        transcriptomeFile = readFile(transcriptomeFilename)
+        seqList = [transcriptomeFile[i] for i in range(1,len(transcriptomeFile),2)]
+
+    for currentLine in seqList:
         baseCounts += len(currentLine) - currentLine.count('N')
         baseCountsOffTagLen += (len(currentLine) - 2 * minTagLen) - currentLine[
             minTagLen:len(currentLine)-minTagLen].count('N')
@@ -2343,7 +2365,7 @@ def ReverseMapping():
 
 ##############################################################################################
 #### MAIN FUNCTION ###########################################################################
-def main():
+def main(fastaList=None):
 
     ## Pre-run check and imports ######################
     checkLibs()
@@ -2373,8 +2395,12 @@ def main():
     elif args.featureFile:
         print("\nThe input FASTA file is considered 'as is' for analysis\n")
         fastaOut    = args.featureFile ### Make it better
-        fastaList   = fastaReader(fastaOut)
-        unambiguousBaseCounter(fastaOut, args.minTagLen)
+        if fastaList is None:
+            fastaList   = fastaReader(fastaOut)
+            unambiguousBaseCounter(fastaOut, args.minTagLen)
+        else:
+            print("Sequences of feature file provided by calling script will be used")
+            unambiguousBaseCounter(fastaOut, args.minTagLen, fastaList)
     else:
         print("Please provide input to '--featureFile' or '--genomeFile'")
         print("See sPARTA example commands: https://github.com/atulkakrana/sPARTA.github/tree/master/sparta")
@@ -2617,9 +2643,36 @@ def main():
     fh_run.write('Script run time is : %s\n' % (round(PredEnd-FragStart,2)))
     fh_run.close()
 
+    if args.validate:
+        resFile = uniqRevmapped
+    else:
+        resFile = predTargets
+
+    return resFile
+
+def run(argList,fastaList=None):
+    '''
+    Runs sPARTA in-process for a calling script (like revFerno) - argList has same
+    flags as command line, and fastaList of feature file (name,seq) is used instead
+    of reading it again. Returns path of predicted or validated targets file
+    '''
+
+    global nspread
+    sPARTAArgs(argList)
+    nspread = 6
+    if args.accel == 'Y':
+        args.accel = int(multiprocessing.cpu_count()*0.85)
+    else:
+        args.accel = int(args.accel)
+
+    resFile = main(fastaList)
+
+    return resFile
+
 #### RUN ##########################################
 
 if __name__ == '__main__':
+    sPARTAArgs()
     nspread = 6
     if args.accel == 'Y':
         args.accel = int(multiprocessing.cpu_count()*0.85)
@@ -2717,6 +2770,10 @@ if __name__ == '__main__':
 #### new coordinates - Fixed by replacing geno_end    = coord_dict_crick[gene_name][1] with
 #### geno_end    = coord_dict_crick[gene_name][2] -  see the difference in coordinates
 
+## v1.22 -> v1.22b
+## Argument parsing moved to sPARTAArgs and run() added so that sPARTA can be imported and run in-process (by revFerno)
+## with feature sequences handed over in memory; miRNA headers are cleaned in memory, cleaned file is written with --dumpTemp only
+
 ## v1.22 - v1.23[planned]
 ## Optimization in Reza's part to improve speed
 ## Add chart function
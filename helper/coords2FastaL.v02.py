@@ -3,7 +3,7 @@
 
 ### This script extracts seqeunce from local genome file, given a ta-sperated or csv file with co-ordinates
 
-import os,sys,time,sqlite3,operator
+import os,sys,time,sqlite3,operator,mmap
 from operator import itemgetter
 
 genomeFasta     = "/home/kakrana/99.genomes/maize.agp.v2/Zea_mays.AGPv2.17.dna.allchromosome"
@@ -13,36 +13,109 @@ delim           = "\t"                                                      ## D
 head            = 'Y'                                                       ## Header is summary file: 'Y' else: 'N'
 namepos         = 1
 chrpos          = 3
-strandpos       = 
+strandpos       = None                                                      ## Column with strand ('w'/'c'); None: no strand column, all entries taken as 'w'
 startpos        = 4
 endpos          = 5
 
 
+def faiIndex(genomeFasta):
+    '''
+    Reads index (.fai) of genome, index is built once (samtools faidx format) and rebuilt only if genome is newer
+    than index. Returns dict of chr: (length, offset of seqeunce, bases per line, bytes per line)
+    '''
+    print("\nFunction: faiIndex")
+
+    faiFile     = "%s.fai" % (genomeFasta)
+    faiD        = {}
+
+    if os.path.isfile(faiFile) and os.path.getmtime(faiFile) >= os.path.getmtime(genomeFasta):
+        print("Reading index:%s" % (faiFile))
+        fh_in   = open(faiFile,'r')
+        for line in fh_in:
+            aname,alen,aoffset,linebases,linebytes = line.strip('\n').split('\t')[:5]
+            faiD[aname] = (int(alen),int(aoffset),int(linebases),int(linebytes))
+        fh_in.close()
+        return faiD
+
+    print("Building index:%s" % (faiFile))
+    fh_in       = open(genomeFasta,'rb')
+    aname       = None
+    aoffset     = 0     ## Byte offset of current line
+    for line in fh_in:
+        if line.startswith(b'>'):
+            if aname is not None:
+                faiD[aname] = (alen,seqoffset,linebases,linebytes)
+            aname       = line[1:].split()[0].decode()
+            seqoffset   = aoffset+len(line)
+            alen        = 0
+            linebases   = 0
+            linebytes   = 0
+            lastline    = False ## Shorter line seen, which must be last line of seqeunce
+        
+        elif aname is not None:
+            bases       = len(line.rstrip(b'\r\n'))
+            if bases and lastline:
+                print("Different line lengths in seqeunce of '%s' - genome can't be indexed" % (aname))
+                sys.exit()
+            if linebases == 0:
+                linebases   = bases
+                linebytes   = len(line)
+            elif bases != linebases:
+                lastline    = True
+            alen       += bases
+        
+        aoffset += len(line)
+
+    if aname is not None:
+        faiD[aname] = (alen,seqoffset,linebases,linebytes)
+    fh_in.close()
+
+    try:
+        fh_out  = open(faiFile,'w')
+        for aname,(alen,seqoffset,linebases,linebytes) in faiD.items():
+            fh_out.write("%s\t%s\t%s\t%s\t%s\n" % (aname,alen,seqoffset,linebases,linebytes))
+        fh_out.close()
+    except OSError:
+        print("Index couldn't be written to %s - it will be built again in next run" % (faiFile))
+
+    return faiD
+
 def cacheGenome(genomeFasta):
     '''
-    Read genome file and retruns a dict
+    Indexes and memory-maps genome file, seqeunces are fetched on demand by fetchWindow
     '''
     print("\nFunction: cacheGenome")
 
-    genomeD     = {} ## A dictionary to store fasta files
-    fh_in       = open(genomeFasta)
-    fasta       = fh_in.read()
-    fasta_splt  = fasta.split('>')
-    acount      = 0 ## count the number of entries
-    for i in fasta_splt[1:]:
-        ent     = i.split('\n')
-        name    = ent[0].split()[0].strip()
-        seq     = ''.join(x.strip() for x in ent[1:]) ## Sequence in multiple lines
-        alen    = len(seq)
-        genomeD[name] = seq
-        acount+=1
-        print("seqeunce %s of length %s cached" % (name,alen))
-
-    print("Sequences cached:%s" % (acount))
+    faiD        = faiIndex(genomeFasta)
+    fh_in       = open(genomeFasta,'rb')
+    genomeM     = mmap.mmap(fh_in.fileno(),0,access=mmap.ACCESS_READ)
+    fh_in.close()   ## mmap holds its own reference to file
+
+    print("Sequences indexed:%s" % (len(faiD)))
 
     print ("Exiting function - cacheGenome\n")
 
-    return genomeD
+    return genomeM,faiD
+
+def fetchWindow(genomeM,faiD,aname,astart,aend):
+    '''
+    Fetches seqeunce from start to end (1-based and inclusive) of a chr from memory-mapped genome,
+    window is clamped to the ends of chromosome
+    '''
+    alen,aoffset,linebases,linebytes = faiD[aname]
+    astart  = max(astart,1)
+    aend    = min(aend,alen)
+    if aend < astart:
+        return ''
+
+    bstart  = aoffset + ((astart-1)//linebases)*linebytes + (astart-1)%linebases
+    bend    = aoffset + ((aend-1)//linebases)*linebytes + (aend-1)%linebases + 1
+    aseq    = genomeM[bstart:bend]
+    if linebases < alen:
+        ## Seqeunce spans multiple lines
+        aseq = aseq.replace(b'\n',b'').replace(b'\r',b'')
+
+    return aseq.decode()
 
 def parseCoords(coordsFile):
     '''
@@ -63,7 +136,7 @@ def parseCoords(coordsFile):
         achr    = int(ent[chrpos-1].replace("chr",""))
         astart  = int(ent[startpos-1])
         aend    = int(ent[endpos-1])
-        astrand = ent[strandpos-1]
+        astrand = ent[strandpos-1].strip() if strandpos else 'w'
 
         print("Phas Name %s | chr:%s | start:%s | end:%s | astrand:%s" % (aname,achr,astart,aend,astrand))
         coordsL.append((aname,achr,astart,aend,astrand))
@@ -73,7 +146,7 @@ def parseCoords(coordsFile):
     
     return coordsL
 
-def fetchSequences(genomeD,coordsL):
+def fetchSequences(genomeM,faiD,coordsL):
     '''
     Fetches and writes seqeunces
     '''
@@ -87,9 +160,7 @@ def fetchSequences(genomeD,coordsL):
     for i in coordsL_sorted:
         aname,achr,astart,aend,astrand = i
         print(aname,achr,astart,aend,astrand)
-        chrseq = genomeD[str(achr)]
-
-        aseq = chrseq[astart:aend+1]
+        aseq = fetchWindow(genomeM,faiD,str(achr),astart+1,aend+1) ## Same window as earlier slice chrseq[astart:aend+1]
         if astrand == "w":
             fh_out.write(">%s\n%s\n" % (aname,aseq))
         elif astrand == "c":
@@ -103,9 +174,9 @@ def fetchSequences(genomeD,coordsL):
     return fastaFile
 
 def main():
-    genomeD     = cacheGenome(genomeFasta)
+    genomeM,faiD = cacheGenome(genomeFasta)
     coordsL     = parseCoords(coordsFile)
-    fastaFile   = fetchSequences(genomeD,coordsL)
+    fastaFile   = fetchSequences(genomeM,faiD,coordsL)
 
 
 if __name__ == "__main__":
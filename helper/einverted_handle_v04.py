@@ -2,7 +2,7 @@
 #### Script to get sequences from genome DB - written by kakrana@udel.com
 
 ######## IMPORT ################
-import sys,os,subprocess,multiprocessing,datetime,time
+import sys,os,subprocess,multiprocessing,datetime,time,math,tempfile
 from multiprocessing import Process, Queue, Pool
 
 
@@ -17,12 +17,11 @@ mismatch = -4       ## Default:-4
 threshold = 500     ## Default:50
 maxRepLen = 3000    ## Default: 2000
 parallel = 1 		## Default: 1 (Yes)
+IRchunks = 4        ## Batches of sequences per core in parallel mode
 
 ### Steps #####
 fastaList_step = 1
 einverted_step = 1
-resParse_step  = 1
-combClean_step = 1
 
 ############ FUNCTIONS ###########
 
@@ -63,59 +62,45 @@ def batcheinverted(fastaList):
     directly through einverted gives wrong results.So, this script runs einverted one by one on each sequence in FASTA file. 
     '''
 
+    resL = []
     for anent in fastaList:
-        name = anent[0].replace(":","_")
-        seq = anent[1]
-        
-        tempInput = "tempSeq.fa"
-        fh_out = open(tempInput,'w')
-        fh_out.write('>%s\n%s\n' % (name,seq))
-        fh_out.close()
-
-        outseq = "%s.fa.temp" % name
-        outinv = "%s.inv.temp" % name
+        resL.append(einverted(anent))
 
-        retcode = subprocess.call(["einverted", "-sequence", tempInput, "-gap", str(gap), "-threshold", str(threshold), "-match",str(match),"-mismatch", str(mismatch), "-maxrepeat",str(maxRepLen), "-outfile",outinv, "-outseq",outseq ])
-
-        if retcode == 0:## The bowtie mapping exit with status 0, all is well
-            print('\n****einverted for %s complete****\n' % (name) )
-        else:
-            print('Something wrong happened while running einverted for sequence: %s - - Debug for reason' % (name))
-            sys.exit()
-
-        ## Cleanup entry specifc FASTA file
-        if os.path.exists(tempInput):
-            os.remove(tempInput)
-
-    pass
+    return resL
 
 def einverted(atup):
+    ''' Runs einverted on one sequence in its own temp directory, so that parallel runs do not collide.
+    Returns name, alignments and sequences as text '''
 
     name = atup[0].replace(":","_")
     seq = atup[1].strip()
     
     print("Seqeunce being analyzed for inverted repeats: %s\n" % (name))
-    tempInput = ("%s_tempSeq.fa" % (name))
-    fh_out = open(tempInput,'w')
-    fh_out.write('>%s\n%s' % (name,seq))
-    fh_out.close()
+    with tempfile.TemporaryDirectory(prefix="einverted_") as tempdir:
+        tempInput = os.path.join(tempdir,"tempSeq.fa")
+        fh_out = open(tempInput,'w')
+        fh_out.write('>%s\n%s' % (name,seq))
+        fh_out.close()
 
-    outseq = "%s.fa.temp" % name
-    outinv = "%s.inv.temp" % name
+        outseq = os.path.join(tempdir,"tempSeq.fa.temp")
+        outinv = os.path.join(tempdir,"tempSeq.inv.temp")
 
-    retcode = subprocess.call(["einverted", "-sequence", tempInput, "-gap", str(gap), "-threshold", str(threshold), "-match",str(match),"-mismatch", str(mismatch),"-maxrepeat",str(maxRepLen), "-outfile",outinv, "-outseq",outseq ])
+        retcode = subprocess.call(["einverted", "-sequence", tempInput, "-gap", str(gap), "-threshold", str(threshold), "-match",str(match),"-mismatch", str(mismatch),"-maxrepeat",str(maxRepLen), "-outfile",outinv, "-outseq",outseq ])
 
-    if retcode == 0:## The bowtie mapping exit with status 0, all is well
-        print('\n****einverted for %s complete****\n' % (name) )
-    else:
-        print('Something wrong happened while running einverted for sequence: %s - - Debug for reason' % (name))
-        sys.exit()
+        if retcode == 0:## The einverted exit with status 0, all is well
+            print('\n****einverted for %s complete****\n' % (name) )
+        else:
+            print('Something wrong happened while running einverted for sequence: %s - - Debug for reason' % (name))
+            return name,None,None
 
-    ## Cleanup entry specifc FASTA file
-    if os.path.exists(tempInput):
-        os.remove(tempInput)
+        fh_in = open(outinv,'r')
+        invtext = fh_in.read()
+        fh_in.close()
+        fh_in = open(outseq,'r')
+        seqtext = fh_in.read()
+        fh_in.close()
 
-    pass
+    return name,invtext,seqtext
 
 def parseRes():
 
@@ -161,7 +146,7 @@ def parseRes():
 
     return resOut
 
-def parseRes2():
+def parseRes2(resL):
 
     print ("Parsing results\n")
     ## File to record results
@@ -169,102 +154,73 @@ def parseRes2():
     fh_out = open(resOut,'w')
     fh_out.write("EntryName,Score,Matches,Perc,Gaps,AlignLen,5'Start,5'End,3'start,3'end,Loop\n")
 
-    ## Get list of files
-    invRes = [file for file in os.listdir('./') if file.endswith ('.inv.temp')]
-    for afile in invRes:
-        print("\nSeqeunce being parsed:%s" % (afile))
-        try:
-            if os.stat(afile).st_size > 0:
-                print ("Sequence %s - Results !!!!" % (afile.split(".")[0]))
-                fh_in = open(afile,'r')
-                invs = fh_in.read().split("\n\n")
-                # print("Empty line splitted:",invs)
-                
-                for i in invs:
-                    # print('\nInverted:',i.strip('\n'))
-                    invLines = i.strip('\n').split('\n')
-                    # print(invLines)
-                    
-                    resBlock_splt = invLines[0].split(":")
-                    # print(resBlock_splt)
-                    score = resBlock_splt[1].split()[1]
-                    # print(resBlock_splt[1].split())
-                    matchesInfo,gapsInfo = resBlock_splt[2].split(",")
-                    # print(matchesInfo,gapsInfo)
-                    gaps = gapsInfo.split()[0]
-                    
-                    # print(matchesInfo.strip().split())
-
-                    matches = matchesInfo.strip().split()[0]
-                    matched,total = matches.split("/")
-                    alignLen = int(total)*2
-                    perc = round(int(matched)/int(total),2)
-
-                    # matches,garbage1,perc,garbage2 = matchesInfo.strip().split()
-                    # alignLen = int(matches.split("/")[1])*2
-                    # print(score,matches,gaps)
-
-                    arm5 = invLines[1].strip()
-                    start5,seq5,end5 = arm5.split(" ")
-
-                    arm3 = invLines[3].strip()
-                    end3,seq3,start3 = arm3.split(" ")
-
-                    loop = int(start3)-int(end5)
-
-                    fh_out.write("%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n" % (afile.split(".")[0],score,matches,str(perc),gaps,str(alignLen),start5,end5,start3,end3,loop)) ## name of file,score,match,gaps
-            else:
-                # print ("Sequence %s - No results" % (afile.split(".")[0]))
-                pass
-
-        except OSError:
-            print ("No result file for sequence %s found - Please check" % (afile))
+    ## Results are parsed from memory
+    for name,invtext,seqtext in resL:
+        print("\nSeqeunce being parsed:%s" % (name))
+        if invtext is None:
+            print ("No result for sequence %s found - Please check" % (name))
             print("System will exit")
             sys.exit()
 
+        elif invtext.strip():
+            print ("Sequence %s - Results !!!!" % (name))
+            invs = invtext.split("\n\n")
+            
+            for i in invs:
+                if not i.strip():
+                    continue
+                invLines = i.strip('\n').split('\n')
+                
+                resBlock_splt = invLines[0].split(":")
+                score = resBlock_splt[1].split()[1]
+                matchesInfo,gapsInfo = resBlock_splt[2].split(",")
+                gaps = gapsInfo.split()[0]
+
+                matches = matchesInfo.strip().split()[0]
+                matched,total = matches.split("/")
+                alignLen = int(total)*2
+                perc = round(int(matched)/int(total),2)
+
+                arm5 = invLines[1].strip()
+                start5,seq5,end5 = arm5.split(" ")
+
+                arm3 = invLines[3].strip()
+                end3,seq3,start3 = arm3.split(" ")
+
+                loop = int(start3)-int(end5)
+
+                fh_out.write("%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n" % (name,score,matches,str(perc),gaps,str(alignLen),start5,end5,start3,end3,loop)) ## name of file,score,match,gaps
+        else:
+            # print ("Sequence %s - No results" % (name))
+            pass
+
+    fh_out.close()
+
     return resOut
 
-def combineClean():
+def combineClean(resL):
 
     print("Combining result file\n")
 
-    fastaFiles = [file for file in os.listdir('./') if file.endswith ('.fa.temp')]
-    invFiles = [file for file in os.listdir('./') if file.endswith ('.inv.temp')]
-	
     ## Combine inverted repeats alingments results
     invComb = './Inverted_Alings.inv'
     inv_out = open(invComb ,'w')
     print("\nCombining 'inverted' results file")
-    for x in invFiles:
-        print (x)
-        invfile = open('./%s' % (x), 'r')
-        #targfile.readline()
-        data = invfile.read()
-        invfile.close()
-        inv_out.write(data)
+    for name,invtext,seqtext in resL:
+        if invtext:
+            inv_out.write(invtext)
     inv_out.close()
 
     ## Combine inverted repeats sequences FASTA file
     fastaComb = './Inverted_Seqs.fa'
     fasta_out = open(fastaComb ,'w')
     print("\nCombining 'inverted' fasta file")
-    for x in fastaFiles:
-        print (x)
-        fastafile = open('./%s' % (x), 'r')
-        #targfile.readline()
-        data2 = fastafile.read()
-        fastafile.close()
-        fasta_out.write(data2)
+    for name,invtext,seqtext in resL:
+        if seqtext:
+            fasta_out.write(seqtext)
     fasta_out.close()
 
-    # Delete individual inverted files and fasta files
-    print("Combined files '%s and %s' ready - Deleting individual files\n" % (invComb,fastaComb))
-    garbage = fastaFiles + invFiles
-    for file in garbage:
-        print("Deleting %s" % (file))
-        os.remove(file)
-
-    # Delete one temp seq file
+    print("Combined files '%s and %s' ready\n" % (invComb,fastaComb))
         
     return invComb,fastaComb
 
@@ -274,11 +230,17 @@ def PP(module,alist):
     start = time.time()
     nprocPP = round((accel/int(nspread))+1) #
     print('\nnprocPP:%s\n' % (nprocPP))
+    achunk = max(1,math.ceil(len(alist)/(int(nprocPP)*IRchunks))) ## Sequences sent to workers in batches
     npool = Pool(int(nprocPP))
-    npool.map(module, alist)
+    resL = npool.map(module, alist, chunksize=achunk)
+    npool.close()
+    npool.join()
+
+    return resL
 
 def main():
 
+    resL = [] ## einverted results, held in memory
     if fastaList_step == 1:
         fastaList = readFASTA(fastaFile)
     else:
@@ -287,26 +249,21 @@ def main():
     if einverted_step == 1:
         if parallel == 0:
             print("Running einverted repeat in non-parallel mode\n")
-            batcheinverted(fastaList)
+            resL = batcheinverted(fastaList)
         elif parallel == 1:
             print("Running einverted repeat in parallel mode\n")
-            PP(einverted,fastaList)
+            resL = PP(einverted,fastaList)
         else:
             print("Please input correct value for 'parallel' variable' - System will exit now\n")
             sys.exit()
     else:
         print("No inverted repeat analysis is performed as the step is turned off\n")
     
-    if resParse_step == 1:
-        resOut = parseRes2()
+    if resL:
+        resOut = parseRes2(resL)
+        invComb,fastaComb = combineClean(resL)
     else:
-        print("Results are not combined as the step is turned off\n")
-
-    if combClean_step == 1:
-        invComb,fastaComb = combineClean()
-    else:
-        print("Results will not be combined from individual seqeunces and no cleanup will be performed, as the step is off\n")
-        print("This might generate thousands of file leaving your system unstable if you tried to open the results folder\n")
+        print("No einverted results to parse or combine - results are held in memory, so einverted step must be turned on\n")
 
 if __name__ == '__main__':
     nspread = 1
@@ -330,3 +287,8 @@ if __name__ == '__main__':
 
 ##v02 -> 04
 ## Fixed the error that "File cannot be created" in parallel mode
+
+##v04 -> v04b
+## Every einverted run uses its own temp directory, results are returned to main process and parsed in memory, no per-sequence files in working directory
+## Sequences are sent to workers in batches
+## Removed 'resParse_step' and 'combClean_step' - results are parsed and combined in the same run as einverted, as there are no result files left to read in a later run
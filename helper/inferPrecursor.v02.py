@@ -1,6 +1,6 @@
 #!/usr/local/bin/python3
 
-import os,sys,operator,time,datetime,string,subprocess
+import os,sys,operator,time,datetime,string,subprocess,math,tempfile
 import mysql.connector as sql
 from collections import Counter
 from multiprocessing import Process, Queue, Pool
@@ -18,6 +18,7 @@ msDB        = "kakrana"
 tagPosTable = "DAYLILY_priv_sRNA_TagPosSummNorm"
 dataserver  = "tarkan.ddpsc.org"
 numProc     = 24
+IRchunks    = 4         ## Batches of sequences per core for parallel einverted runs
 gap         = 12        ## Default:12 (from emboss website)
 match       = 3         ## Default:3
 mismatch    = -4        ## Default:-4
@@ -65,11 +66,14 @@ def inferCandidates(miRBlastF,miRBlastFa):
     header      = "miRcand\tputativeName\tmiRstrand\tmiRseq\tmiRlen\tmiRhits\tmappos\tacand\tprecursorSeq\tprecursorLen\tstatusFlag\tprecursorName\tscore\tmatches\tstr(perc)\tgaps\talignLen\tstart5\tend5\tstart3\tend3\tloop"
     fh_out2.write("%s\n" % (header))
     
+    ## Foldback for all precursor candidates in parallel
+    IRD = PPIR([(acand,candsFastaD[acand]) for acand in mapDict.keys()])
+
     precSummL = [] ### List to store all results
     # precSummD = {} ### Dict to store all results, Unique tag is key and entry is value
     for acand in mapDict.keys():     ## Values are bascially miRNA candidate and mapping details
         atransSeq = candsFastaD[acand]
-        candRes,IRcoords = predictPrecursor(acand,atransSeq,mapDict,miRcandsD)
+        candRes,IRcoords = predictPrecursor(acand,atransSeq,mapDict,miRcandsD,IRD)
 
         if candRes:
             for miRcand in candRes:
@@ -418,112 +422,121 @@ def map2Dict(alib):
 def IRchecker(combSeq,combName):
     '''
     This function takes a seqeunce, and runs einverted and reports back
-    coordinates
+    alignments. Every run gets its own temp directory so that parallel runs
+    do not collide, results are read back in memory and temp files removed
     '''
 
-    print("\nFUNCTION - IRchecker")
+    # print("\nFUNCTION - IRchecker")
     seq         = combSeq
     name        = combName
-    tempInput   = "tempSeq.fa"
-    fh_out      = open(tempInput,'w')
-    fh_out.write('>%s\n%s\n' % (name,seq))
-    fh_out.close()
-
-    outseq = "%s.fa.temp" % name
-    outinv = "%s.inv.temp" % name
-
-    retcode = subprocess.call(["einverted", "-sequence", tempInput, "-gap", str(gap), "-threshold", str(threshold), "-match",str(match),"-mismatch", str(mismatch), "-maxrepeat",str(maxRepLen), "-outfile",outinv, "-outseq",outseq ])
-
-    if retcode == 0:## The bowtie mapping exit with status 0, all is well
-        print('\n+einverted for %s\n' % (name) )
-    else:
-        print('Something wrong happened while running einverted for sequence: %s - - Debug for reason' % (name))
-        sys.exit()
+    with tempfile.TemporaryDirectory(prefix="einverted_") as tempdir:
+        tempInput   = os.path.join(tempdir,"tempSeq.fa")
+        outseq      = os.path.join(tempdir,"tempSeq.fa.temp")
+        outinv      = os.path.join(tempdir,"tempSeq.inv.temp")
+        fh_out      = open(tempInput,'w')
+        fh_out.write('>%s\n%s\n' % (name,seq))
+        fh_out.close()
+
+        ares    = subprocess.run(["einverted", "-sequence", tempInput, "-gap", str(gap), "-threshold", str(threshold), "-match",str(match),"-mismatch", str(mismatch), "-maxrepeat",str(maxRepLen), "-outfile",outinv, "-outseq",outseq ],stderr=subprocess.PIPE)
+        retcode = ares.returncode
+
+        if retcode == 0:## The einverted exit with status 0, all is well
+            # print('\n+einverted for %s\n' % (name) )
+            pass
+        else:
+            print('Something wrong happened while running einverted for sequence: %s - einverted reported:' % (name))
+            print(ares.stderr.decode(errors='replace').strip())
+            return None
 
-    ## Cleanup entry specifc FASTA file
-    # if os.path.exists(tempInput):
-    #     os.remove(tempInput)
+        fh_in   = open(outinv,'r')
+        invtext = fh_in.read()
+        fh_in.close()
 
-    return outseq,outinv
+    return invtext
 
-def IRparser(outseq,outinv,combName):
+def IRparser(invtext,combName):
     '''
-    parse results and delete input files
+    parse einverted results from memory
     '''
-    print("\nFUNCTION - IRparser")
-    print ("+Parsing %s results" % (outinv))
+    # print("\nFUNCTION - IRparser")
+    # print ("+Parsing %s results" % (combName))
 
-    ## File to record results
-    # resOut= "RES_%s.csv" % (combName)
-    # fh_out = open(resOut,'w')
     IRcoords = [] ## Store coordinates for this inverted repeat
-    # fh_out.write("EntryName,Score,Matches,Perc,Gaps,AlignLen,5'Start,5'End,3'start,3'end,Loop\n")
 
-    ## Get list of files
-    afile = outinv
     name = combName
-    # print("Seqeunce being parsed:%s" % (afile))
-    try:
-        if os.stat(afile).st_size > 0:
-            print ("+Sequence %s - Results !!!!" % (afile.split(".")[0]))
-            fh_in = open(afile,'r')
-            invs = fh_in.read().split("\n\n")
-            # print("Empty line splitted:",invs)
+    if invtext.strip():
+        # print ("+Sequence %s - Results !!!!" % (name))
+        invs = invtext.split("\n\n")
+        
+        for i in invs:
+            if not i.strip():
+                continue
+            invLines = i.strip('\n').split('\n')
             
-            for i in invs:
-                # print('\nInverted:',i.strip('\n'))
-                invLines = i.strip('\n').split('\n')
-                # print(invLines)
-                
-                resBlock_splt = invLines[0].split(":")
-                # print(resBlock_splt)
-                score = resBlock_splt[1].split()[1]
-                # print(resBlock_splt[1].split())
-                matchesInfo,gapsInfo = resBlock_splt[2].split(",")
-                # print(matchesInfo,gapsInfo)
-                gaps = gapsInfo.split()[0]
-                
-                # print(matchesInfo.strip().split())
-
-                matches = matchesInfo.strip().split()[0]
-                matched,total = matches.split("/")
-                alignLen = int(total)*2
-                perc = round(int(matched)/int(total),2)
-
-                # matches,garbage1,perc,garbage2 = matchesInfo.strip().split()
-                # alignLen = int(matches.split("/")[1])*2
-                # print(score,matches,gaps)
-
-                arm5 = invLines[1].strip()
-                start5,seq5,end5 = arm5.split(" ")
-
-                arm3 = invLines[3].strip()
-                end3,seq3,start3 = arm3.split(" ")
-
-                loop = int(start3)-int(end5)
-
-                IRcoords.append((name,score,matches,str(perc),gaps,str(alignLen),start5,end5,start3,end3,loop))
-                # fh_out.write("%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n" % (afile.split(".")[0],score,matches,str(perc),gaps,str(alignLen),start5,end5,start3,end3,loop)) ## name of file,score,match,gaps
-
-            #### Clean up ### 
-            garbage = [afile for afile in os.listdir('./') if afile.endswith (('.fa.temp','.inv.temp'))]
-            for afile in garbage:
-                print("+Deleting %s" % (afile))
-                os.remove(afile)
+            resBlock_splt = invLines[0].split(":")
+            score = resBlock_splt[1].split()[1]
+            matchesInfo,gapsInfo = resBlock_splt[2].split(",")
+            gaps = gapsInfo.split()[0]
 
-        else:
-            # print ("Sequence %s - No results" % (afile.split(".")[0]))
-            pass
+            matches = matchesInfo.strip().split()[0]
+            matched,total = matches.split("/")
+            alignLen = int(total)*2
+            perc = round(int(matched)/int(total),2)
 
-    except OSError:
-        print("+No result file for sequence %s found - Please check" % (afile))
-        print("+System will exit")
-        sys.exit()
+            arm5 = invLines[1].strip()
+            start5,seq5,end5 = arm5.split(" ")
+
+            arm3 = invLines[3].strip()
+            end3,seq3,start3 = arm3.split(" ")
 
+            loop = int(start3)-int(end5)
+
+            IRcoords.append((name,score,matches,str(perc),gaps,str(alignLen),start5,end5,start3,end3,loop))
+
+    else:
+        # print ("Sequence %s - No results" % (name))
+        pass
 
     return IRcoords
 
-def predictPrecursor(acand,atransSeq,mapDict,miRcandsD):
+def IRworker(aent):
+    '''
+    Runs einverted on one (name,seq) and returns parsed results, IRcoords is None if einverted failed
+    '''
+    aname,aseq  = aent
+    invtext     = IRchecker(aseq,aname)
+    if invtext is None:
+        return aname,None
+
+    return aname,IRparser(invtext,aname)
+
+def PPIR(seqL):
+    '''
+    Runs einverted on a list of (name,seq) across cores, seqeunces are sent to workers in batches and results
+    parsed in memory. Returns dict with name as key and IRcoords as value
+    '''
+
+    print("\nFUNCTION - PPIR")
+    IRD = {}
+    if not seqL:
+        return IRD
+
+    achunk  = max(1,math.ceil(len(seqL)/(nproc*IRchunks)))
+    print("+Seqeunces:%s | Cores:%s | Batch size:%s" % (len(seqL),nproc,achunk))
+    npool   = Pool(nproc)
+    resL    = npool.map(IRworker,seqL,chunksize=achunk)
+    npool.close()
+    npool.join()
+
+    for aname,IRcoords in resL:
+        if IRcoords is None:
+            print("+einverted failed for %s - System will exit" % (aname))
+            sys.exit()
+        IRD[aname] = IRcoords
+
+    return IRD
+
+def predictPrecursor(acand,atransSeq,mapDict,miRcandsD,IRD):
     '''Takes a precursor transcipt candidate, fetched FASTA, checks for foldback, 
     checks for location of miR on foldback, apply filters to resturn a falg of status'''
 
@@ -533,8 +546,7 @@ def predictPrecursor(acand,atransSeq,mapDict,miRcandsD):
     statusFlag = "" ## Flag for final status of precursor - Y or N 
 
     ## Foldback and IR coords
-    outseq,outinv   = IRchecker(atransSeq,acand)
-    IRcoords        = IRparser(outseq,outinv,acand)
+    IRcoords        = IRD[acand]
     print("Foldback coords:",IRcoords)
 
     candRes = [] ## List with results using all tags that mapped to this precursor
@@ -701,4 +713,7 @@ if __name__ == '__main__':
 
 
 #### v.01 -> v02
-#### miRNA blast results are sorted on e-val, bitscore and uniq on tags
\ No newline at end of file
+#### miRNA blast results are sorted on e-val, bitscore and uniq on tags
+
+#### v02 -> v02b
+#### Foldback of all precursor candidates computed upfront by PPIR across cores, einverted runs in own temp directory and results parsed in memory
@@ -1,6 +1,6 @@
 #!/usr/local/bin/python3
 
-import os,sys,operator,time,datetime,string,subprocess
+import os,sys,operator,time,datetime,string,subprocess,math,tempfile,multiprocessing
 import mysql.connector as sql
 from collections import Counter
 from multiprocessing import Process, Queue, Pool
@@ -40,6 +40,8 @@ match       = 3         ## Default:3
 mismatch    = -4        ## Default:-4
 threshold   = 24        ## Default:50 | 24-selected after finding suxh cases in Maize
 maxRepLen   = 2000      ## Default: 2000
+numProc     = 0         ## Cores for einverted runs, 0: Use most of the cores
+IRchunks    = 4         ## Batches of sequences per core for parallel einverted runs
 
 #### Functions ####
 
@@ -66,15 +68,16 @@ def miRmax(coords):
     bcount = 0 ### COunts precursors that do not have any sRNA in their foldback
     ccount = 0 ### Counts precursors that ahve foldback and mapped sRNAs, but expected miRNA not found
     dcount = 0 ### All precursors tested
+
+    ### Foldback for all precursors in parallel ###########################
+    IRD    = PPIR([(i[0],fastaDict[i[0]]) for i in coords])
     for i in coords:
         aname,achr,astart,aend,astrand,alen = i
         print("\nEnt:",aname,achr,astart,aend,astrand,alen,"####################################")
         dcount+=1
 
         #### Foldback Coords #################################################
-        aseq            = fastaDict[aname]
-        outseq,outinv   = IRchecker(aseq,aname)
-        IRcoords        = IRparser(outseq,outinv,aname)
+        IRcoords        = IRD[aname]
         print("IRcoords",IRcoords)
         if IRcoords:
             IRname,score,matches,perc,gaps,alignLen,start5,end5,start3,end3,loop = IRcoords[0]
@@ -269,111 +272,120 @@ def fastaReader(fastaFile):
 def IRchecker(combSeq,combName):
     '''
     This function takes a seqeunce, and runs einverted and reports back
-    coordinates
+    alignments. Every run gets its own temp directory so that parallel runs
+    do not collide, results are read back in memory and temp files removed
     '''
 
-    print("\nFUNCTION - IRchecker")
+    # print("\nFUNCTION - IRchecker")
     seq         = combSeq
     name        = combName
-    tempInput   = "tempSeq.fa"
-    fh_out      = open(tempInput,'w')
-    fh_out.write('>%s\n%s\n' % (name,seq))
-    fh_out.close()
-
-    outseq = "%s.fa.temp" % name
-    outinv = "%s.inv.temp" % name
-
-    retcode = subprocess.call(["einverted", "-sequence", tempInput, "-gap", str(gap), "-threshold", str(threshold), "-match",str(match),"-mismatch", str(mismatch), "-maxrepeat",str(maxRepLen), "-outfile",outinv, "-outseq",outseq ])
-
-    if retcode == 0:## The bowtie mapping exit with status 0, all is well
-        print('\n+einverted for %s\n' % (name) )
-    else:
-        print('Something wrong happened while running einverted for sequence: %s - - Debug for reason' % (name))
-        sys.exit()
+    with tempfile.TemporaryDirectory(prefix="einverted_") as tempdir:
+        tempInput   = os.path.join(tempdir,"tempSeq.fa")
+        outseq      = os.path.join(tempdir,"tempSeq.fa.temp")
+        outinv      = os.path.join(tempdir,"tempSeq.inv.temp")
+        fh_out      = open(tempInput,'w')
+        fh_out.write('>%s\n%s\n' % (name,seq))
+        fh_out.close()
+
+        ares    = subprocess.run(["einverted", "-sequence", tempInput, "-gap", str(gap), "-threshold", str(threshold), "-match",str(match),"-mismatch", str(mismatch), "-maxrepeat",str(maxRepLen), "-outfile",outinv, "-outseq",outseq ],stderr=subprocess.PIPE)
+        retcode = ares.returncode
+
+        if retcode == 0:## The einverted exit with status 0, all is well
+            # print('\n+einverted for %s\n' % (name) )
+            pass
+        else:
+            print('Something wrong happened while running einverted for sequence: %s - einverted reported:' % (name))
+            print(ares.stderr.decode(errors='replace').strip())
+            return None
 
-    ## Cleanup entry specifc FASTA file
-    # if os.path.exists(tempInput):
-    #     os.remove(tempInput)
+        fh_in   = open(outinv,'r')
+        invtext = fh_in.read()
+        fh_in.close()
 
-    return outseq,outinv
+    return invtext
 
-def IRparser(outseq,outinv,combName):
+def IRparser(invtext,combName):
     '''
-    parse results and delete input files
+    parse einverted results from memory
     '''
-    print("\nFUNCTION - IRparser")
-    print ("+Parsing %s results" % (outinv))
+    # print("\nFUNCTION - IRparser")
+    # print ("+Parsing %s results" % (combName))
 
-    ## File to record results
-    # resOut= "RES_%s.csv" % (combName)
-    # fh_out = open(resOut,'w')
     IRcoords = [] ## Store coordinates for this inverted repeat
-    # fh_out.write("EntryName,Score,Matches,Perc,Gaps,AlignLen,5'Start,5'End,3'start,3'end,Loop\n")
 
-    ## Get list of files
-    afile = outinv
     name = combName
-    # print("Seqeunce being parsed:%s" % (afile))
-    try:
-        if os.stat(afile).st_size > 0:
-            print ("+Sequence %s - Results !!!!" % (afile.split(".")[0]))
-            fh_in = open(afile,'r')
-            invs = fh_in.read().split("\n\n")
-            # print("Empty line splitted:",invs)
+    if invtext.strip():
+        # print ("+Sequence %s - Results !!!!" % (name))
+        invs = invtext.split("\n\n")
+        
+        for i in invs:
+            if not i.strip():
+                continue
+            invLines = i.strip('\n').split('\n')
             
-            for i in invs:
-                # print('\nInverted:',i.strip('\n'))
-                invLines = i.strip('\n').split('\n')
-                # print(invLines)
-                
-                resBlock_splt = invLines[0].split(":")
-                # print(resBlock_splt)
-                score = resBlock_splt[1].split()[1]
-                # print(resBlock_splt[1].split())
-                matchesInfo,gapsInfo = resBlock_splt[2].split(",")
-                # print(matchesInfo,gapsInfo)
-                gaps = gapsInfo.split()[0]
-                
-                # print(matchesInfo.strip().split())
-
-                matches = matchesInfo.strip().split()[0]
-                matched,total = matches.split("/")
-                alignLen = int(total)*2
-                perc = round(int(matched)/int(total),2)
-
-                # matches,garbage1,perc,garbage2 = matchesInfo.strip().split()
-                # alignLen = int(matches.split("/")[1])*2
-                # print(score,matches,gaps)
-
-                arm5 = invLines[1].strip()
-                start5,seq5,end5 = arm5.split(" ")
-
-                arm3 = invLines[3].strip()
-                end3,seq3,start3 = arm3.split(" ")
-
-                loop = int(start3)-int(end5)
-
-                IRcoords.append((name,score,matches,str(perc),gaps,str(alignLen),start5,end5,start3,end3,loop))
-                # fh_out.write("%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n" % (afile.split(".")[0],score,matches,str(perc),gaps,str(alignLen),start5,end5,start3,end3,loop)) ## name of file,score,match,gaps
-
-            #### Clean up ### 
-            garbage = [afile for afile in os.listdir('./') if afile.endswith (('.fa.temp','.inv.temp'))]
-            for afile in garbage:
-                print("+Deleting %s" % (afile))
-                os.remove(afile)
+            resBlock_splt = invLines[0].split(":")
+            score = resBlock_splt[1].split()[1]
+            matchesInfo,gapsInfo = resBlock_splt[2].split(",")
+            gaps = gapsInfo.split()[0]
 
-        else:
-            # print ("Sequence %s - No results" % (afile.split(".")[0]))
-            pass
+            matches = matchesInfo.strip().split()[0]
+            matched,total = matches.split("/")
+            alignLen = int(total)*2
+            perc = round(int(matched)/int(total),2)
+
+            arm5 = invLines[1].strip()
+            start5,seq5,end5 = arm5.split(" ")
+
+            arm3 = invLines[3].strip()
+            end3,seq3,start3 = arm3.split(" ")
 
-    except OSError:
-        print("+No result file for sequence %s found - Please check" % (afile))
-        print("+System will exit")
-        sys.exit()
+            loop = int(start3)-int(end5)
 
+            IRcoords.append((name,score,matches,str(perc),gaps,str(alignLen),start5,end5,start3,end3,loop))
+
+    else:
+        # print ("Sequence %s - No results" % (name))
+        pass
 
     return IRcoords
 
+def IRworker(aent):
+    '''
+    Runs einverted on one (name,seq) and returns parsed results, IRcoords is None if einverted failed
+    '''
+    aname,aseq  = aent
+    invtext     = IRchecker(aseq,aname)
+    if invtext is None:
+        return aname,None
+
+    return aname,IRparser(invtext,aname)
+
+def PPIR(seqL):
+    '''
+    Runs einverted on a list of (name,seq) across cores, seqeunces are sent to workers in batches and results
+    parsed in memory. Returns dict with name as key and IRcoords as value
+    '''
+
+    print("\nFUNCTION - PPIR")
+    IRD = {}
+    if not seqL:
+        return IRD
+
+    achunk  = max(1,math.ceil(len(seqL)/(nproc*IRchunks)))
+    print("+Seqeunces:%s | Cores:%s | Batch size:%s" % (len(seqL),nproc,achunk))
+    npool   = Pool(nproc)
+    resL    = npool.map(IRworker,seqL,chunksize=achunk)
+    npool.close()
+    npool.join()
+
+    for aname,IRcoords in resL:
+        if IRcoords is None:
+            print("+einverted failed for %s - System will exit" % (aname))
+            sys.exit()
+        IRD[aname] = IRcoords
+
+    return IRD
+
 def mirTagsParse(miRtags):
     '''Reads miR tags file which has miRNA name matching fasta file and coords file
     in first column and tags in second column. One miRNA name can have multiple tags 
@@ -500,6 +512,11 @@ def main():
     return None
 
 if __name__ == '__main__':
+    #### Assign Cores
+    if numProc == 0:
+        nproc = int(multiprocessing.cpu_count()*0.95)
+    else:
+        nproc = int(numProc)
     main()
     print("\nScript finished sucessfully")
     sys.exit()
@@ -518,4 +535,7 @@ if __name__ == '__main__':
 
 ###
 ### 3p are usually int shorter than miRNAs, so query to get abundance need to be modified so that +/-1 nt of miRNAs length
-### should be used in query
\ No newline at end of file
+### should be used in query
+
+### v02 -> v02b
+### Foldback of all precursors computed upfront by PPIR across cores, einverted runs in own temp directory and results parsed in memory
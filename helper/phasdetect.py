@@ -7,7 +7,7 @@
 
 #### FUNCTIONS ###########################################
 
-import os,sys,subprocess,multiprocessing,time,getpass,shutil,hashlib,datetime,collections,re,argparse
+import os,sys,subprocess,multiprocessing,time,getpass,shutil,hashlib,datetime,collections,re,argparse,gzip
 from importlib.machinery import SourceFileLoader
 from multiprocessing import Process, Queue, Pool
 from subprocess import check_output
@@ -608,12 +608,34 @@ def indexIntegrityCheck(index):
 
     return indexIntegrity,indexExt
 
+def fastaStream(fh_in):
+    '''
+    Reads FASTA line by line, yields header and sequence of one entry at a time
+    '''
+    header  = None
+    seqL    = []    ## Sequence in multiple lines
+    for line in fh_in:
+        if line.startswith('>'):
+            if header is not None:
+                yield header,''.join(seqL)
+            header  = line[1:].strip()
+            seqL    = []
+        elif header is not None:
+            seqL.append(line.strip())
+
+    if header is not None:
+        yield header,''.join(seqL)
+
 def FASTAClean(filename,mode):
     
     '''Cleans FASTA file - multi-line fasta to single line, header clean, empty lines removal'''
 
-    ## Read seqeunce file
-    fh_in       = open(filename, 'r')
+    ## Read seqeunce file - gzipped file is read as-is
+    if filename.endswith('.gz'):
+        fh_in       = gzip.open(filename, 'rt')
+        filename    = filename[:-3]
+    else:
+        fh_in       = open(filename, 'r')
     print ("PHASER uses FASTA header as key for identifying the phased loci")
     print ("Cleaning header '%s' reference FASTA file" % (filename))
     
@@ -626,29 +648,24 @@ def FASTAClean(filename,mode):
         sys.exit()
 
     ### Outfiles
-    fh_out1     = open(fastaclean, 'w')
+    fh_out1     = open(fastaclean, 'w', buffering=8388608)
     fastasumm   = ('%s/%s.summ.txt' % (os.getcwd(),filename.rpartition('/')[-1].rpartition('.')[0]))
     fh_out2     = open(fastasumm, 'w')
     fh_out2.write("Name\tLen\n")
     
     ### Read files
-    fasta       = fh_in.read()
-    fasta_splt  = fasta.split('>')
-
-    fastaD      = {}    ## Store FASTA as dict
+    nonDigit    = re.compile("[^0-9]")
     acount      = 0     ## count the number of entries
     empty_count = 0
-    for i in fasta_splt[1:]:
-        ent     = i.split('\n')
-        aname   = ent[0].split()[0].strip()
+    for header,seq in fastaStream(fh_in):
+        aname   = header.split()[0]
         
         if runType == 'G':
             ## To match with phasing-core script for genome version which removed non-numeric and preceding 0s
-            name = re.sub("[^0-9]", "", aname).lstrip('0')
+            name = nonDigit.sub("", aname).lstrip('0')
         else:
             name = aname
         
-        seq     = ''.join(x.strip() for x in ent[1:]) ## Sequence in multiple lines
         alen    = len(seq)
         if alen > 200:
             fh_out1.write('>%s\n%s\n' % (name,seq))
@@ -1075,6 +1092,7 @@ if __name__ == '__main__':
 ## "phaser" renamed to "phasdetect"
 ## Added mindepth, clustbuffer, mismat parameters to phasworks.set for user tunability
 ## Default setting hardcoded if mindepth, clustbuffer, mismat left empty by users
+## FASTAClean streams reference line by line (gzipped reference supported) and writes clean FASTA and summary in one pass
 
 ## TO-DO
 ## Add automatic index resolution
@@ -11,7 +11,7 @@
 ### Contact: atulkakrana@gmail.com
 
 import os,glob,sys,difflib,time,shutil,argparse,math,sqlite3,operator
-import operator,datetime,subprocess,multiprocessing,re
+import operator,datetime,subprocess,multiprocessing,re,hashlib,heapq
 from multiprocessing import Process, Queue, Pool
 from operator import itemgetter
 from itertools import groupby
@@ -61,6 +61,7 @@ totalAbunCut    = 500
 
 overlapPerc     = 0.1       ## Minimum percentage of PHAS covered by exon. Keep 0 for finding overlapping genes and 0.20 or above for finding precursors
 overlapCutoff   = 50       ## Values of minimum overlap in nts. This is required if PHAS overlap is checked for precursors and not overlap with any region of genes. FOr precursors one will expect an overlap of 4 phases or more
+annoDB          = 1         ## 1: Keep GTF features in a DB named by hash of GTF content and annomode, reused by later runs with same annotation | 0: Rebuild temporary DB every run
 annomode        = 3         ## 1: PASA feature (GTF) file | 2: Trinity | 3: Rocket feature (GTF) file or generic gtf file with missing "transcript" entry | 4: Both rocket and trinity feature files | 5: PacBio GTF | 6: Comprehensive transciptome (from PASA) - NOTE: New mode should be registered in overlapchecker function
 
 
@@ -1871,7 +1872,80 @@ def gtfParser2(afeatureFile):
     
     return gtfList
 
-def overlapChecker(phasList,gtfList,pcutoff):
+def annoPrepare(featureFiles):
+    '''Returns annotation DB and feature table for GTF file(s) - An existing DB made from same GTF content
+    and annomode is reused, otherwise GTF is parsed and DB is built'''
+
+    print("\n#### Fn: annoPrepare #########################")
+
+    featureTable    = "tempTable"
+
+    if annoDB == 1:
+        ## DB name from GTF content and annomode, as parsed features and their flag (P/T/R/PB) depend on both
+        ahash = hashlib.sha1(str(annomode).encode())
+        for afile in featureFiles:
+            if not os.path.isfile(afile):
+                print("---GTF file could not found")
+                print("---Please check if it exists")
+                sys.exit()
+            with open(afile,'rb') as fh_in:
+                for ablock in iter(lambda: fh_in.read(1<<20), b''):
+                    ahash.update(ablock)
+        annohash    = ahash.hexdigest()
+        DB          = "phasanno_%s.db" % (annohash[:16])
+        
+        ## Reuse only if DB was completely built i.e. hash recorded in the end
+        if os.path.isfile(DB):
+            conn = sqlite3.connect(DB)
+            try:
+                dbhash = conn.execute("SELECT value FROM annoMeta WHERE key = 'hash'").fetchone()
+            except sqlite3.Error:
+                dbhash = None
+            conn.close()
+            if dbhash and dbhash[0] == annohash:
+                print("Annotation DB '%s' exists for this GTF and annomode:%s - Skipping GTF parsing" % (DB,annomode))
+                return DB,featureTable
+            print("Annotation DB '%s' is incomplete, it will be rebuilt" % (DB))
+    else:
+        annohash    = None
+        DB          = 'tempdb'
+
+    try:
+        os.remove(DB)
+    except OSError:
+        pass
+
+    #### Parse GTF ###
+    if annomode     == 1:   ## PASA GTF for overlapping transcripts
+        gtfList     = gtfParser(featureFiles[0])
+    elif annomode   == 2 or annomode == 3 or annomode == 5 or annomode == 6: ## Trinity or Rocket GTF for overlapping transcipts
+        gtfList     = gtfParser2(featureFiles[0])
+    elif annomode   == 4: ## Trinity and Rocket both for overlapping transcipts
+        gtfList1    = gtfParser2(featureFiles[0])  ## Both lists can be identified with aflag feature
+        gtfList2    = gtfParser2(featureFiles[1])  ## Both lists can be identified with aflag feature
+        gtfList     = gtfList1 + gtfList2
+    else:
+        print("Please input correct mode in user settings - script will exit now")
+        sys.exit()
+
+    ## Prepare features table - This might include entries from two GTF files (mode-4), identified by the flags
+    conn            = sqlite3.connect(DB)
+    conn.execute("PRAGMA journal_mode = OFF") ## DB is rebuilt if incomplete, no need of rollback journal or syncs
+    conn.execute("PRAGMA synchronous = OFF")
+    featureTable    = tableMaker(gtfList,conn)
+
+    ## Record GTF, annomode and flags - hash is the last entry, marking a complete DB
+    if annohash:
+        with conn:
+            aflags = ",".join(x[0] for x in conn.execute("SELECT DISTINCT flag FROM %s" % (featureTable)))
+            conn.execute("CREATE TABLE annoMeta (key varchar(255) PRIMARY KEY, value varchar(255))")
+            conn.executemany("INSERT INTO annoMeta VALUES (?,?)", [('gtf',",".join(featureFiles)),('annomode',str(annomode)),('flags',aflags),('hash',annohash)])
+        print("Annotation DB '%s' made for annomode:%s with flags:%s" % (DB,annomode,aflags))
+    conn.close()
+
+    return DB,featureTable
+
+def overlapChecker(phasList,DB,featureTable,pcutoff):
     '''Checks for overlap between genomic PHAS and transcipts frpm GTF file'''
     
     print("\n#### Fn: Annotate ############################")
@@ -1882,16 +1956,9 @@ def overlapChecker(phasList,gtfList,pcutoff):
     fh_out  = open(outfile,'w')
     fh_out.write("Name\tP-val\tphasChr\tphasStart\tphasEnd\tidentifier\tOverlapping Transcript\toverlapping trans NTs\tPercentage Overlap to Trans\toverlapping Exon NTs\tPercentage overlap to Exon\tOverlapping Exons\tTrascript Strand\tTranscript Length\n")
     
-    ## Prepare DB and featureTables ##########################
+    ## Connect annotation DB, prepared by annoPrepare #######
     ##########################################################
-    DB = 'tempdb'
-    try:
-        os.remove(DB)
-    except OSError:
-        pass
-    ## Prepare features table - This might include entries from two GTF files (mode-2), identified by the flags
     conn            = sqlite3.connect(DB)
-    featureTable    = tableMaker(gtfList,conn) ## TURN ON ****
     
     # # Test Query
     # cur = conn.cursor()
@@ -1962,21 +2029,24 @@ def overlapChecker(phasList,gtfList,pcutoff):
                 nonOverlapList.append((aent,aphasID))
 
     #### Write results for which no overlapping transcript was found
-    writtenList = [] ## Temp list to check the result for entry has been written to avoid duplicate for PHAS which has no results
+    overlapNameSet  = set(overlapNameList)
+    writtenSet      = set() ## Temp set to check the result for entry has been written to avoid duplicate for PHAS which has no results
     # print(overlapNameList)
     for bent in nonOverlapList:
         # print(bent)
         bphasID     = bent[1]
-        if (bphasID) not in overlapNameList and (bphasID not in writtenList):
+        if (bphasID) not in overlapNameSet and (bphasID not in writtenSet):
             fh_out.write("%s\t%s\tx\tx\tx\tx\tx\tx\tx\tx\n" % ('\t'.join(str(x) for x in bent[0]),bphasID,))
-            writtenList.append(bphasID)
+            writtenSet.add(bphasID)
      
     fh_out.close()
+    conn.close()
 
     return outfile
 
 def tableMaker(alist,conn):
-    '''makes SQLlite table for query'''
+    '''makes SQLlite table for query, with an R-tree on transcript coordinates
+    and a covering index for exons of a transcript'''
 
     print("Preparing SQL table with GTF features")
 
@@ -1985,25 +2055,34 @@ def tableMaker(alist,conn):
     ## Make table
     featuretable = "tempTable"
     cur.execute('''DROP TABLE IF EXISTS %s''' % (featuretable)) ### Drop Old table - while testing    
+    cur.execute('''DROP TABLE IF EXISTS %sChr''' % (featuretable))
+    cur.execute('''DROP TABLE IF EXISTS %sIdx''' % (featuretable))
     conn.commit()
     
     try:
         cur.execute('''CREATE TABLE %s (gene varchar(255),trans varchar(255),chr varchar(255), start integer, end integer, strand varchar(10), type varchar(255),flag varchar(255))''' % (featuretable))
-        conn.commit()
-        acount = 0
-        for i in alist:
-            # print(i)
-            gid,tid,gchr,gstart,gend,gstrand,gtype,aflag = i
-            if gchr:
-                ## Check if there is a chr assigned otherwise comaprsion cant be done
-                acount+=1
-                # print ('Gene:',gid,'Trans:',tid,'| Chr:',gchr,'| Start:',gstart,'| End:',gend, '| Strand:',gstrand,'| Type:',gtype,'| Flag:',aflag)
-                cur.execute("INSERT INTO %s VALUES ('%s','%s','%s',%d,%d,'%s','%s','%s')" % (featuretable,str(gid),str(tid),str(gchr),int(gstart),int(gend),str(gstrand),str(gtype),str(aflag))) ### Integer made string to accomodate scaffolds or fragments
-                # featureList.append((str(aname),int(achr),int(astart),int(aend),str(astrand)))
-                #conn.commit()
+        
+        ## Entries with no chr assigned are skipped, comaprsion cant be done for these
+        ## Integer made string to accomodate scaffolds or fragments
+        features = ((str(gid),str(tid),str(gchr),int(gstart),int(gend),str(gstrand),str(gtype),str(aflag)) for gid,tid,gchr,gstart,gend,gstrand,gtype,aflag in alist if gchr)
+        with conn: ## Single transaction
+            cur.executemany("INSERT INTO %s VALUES (?,?,?,?,?,?,?,?)" % (featuretable),features)
+            acount = cur.rowcount
+
+            ## Chromosomes are numbered to be used as a dimension in R-tree
+            cur.execute("CREATE TABLE %sChr (id INTEGER PRIMARY KEY, chr varchar(255) UNIQUE)" % (featuretable))
+            cur.execute("INSERT INTO %sChr (chr) SELECT DISTINCT chr FROM %s" % (featuretable,featuretable))
+
+            ## R-tree on chr and coords of transcripts, id is rowid of transcript in feature table
+            cur.execute("CREATE VIRTUAL TABLE %sIdx USING rtree_i32(id, minChr, maxChr, minX, maxX)" % (featuretable))
+            cur.execute("INSERT INTO %sIdx SELECT f.rowid, c.id, c.id, f.start, f.end FROM %s f JOIN %sChr c ON c.chr = f.chr WHERE f.type = 'transcript'" % (featuretable,featuretable,featuretable))
+
+            ## Covering index for exons (and transcript) of a transcript
+            cur.execute("CREATE INDEX %sTrans ON %s (flag, trans, type, start, end)" % (featuretable,featuretable))
     
-    except sqlite3.Error:
-        print('ERROR:',Error)
+    except sqlite3.Error as e:
+        print('ERROR:',e)
+        print("Check if your python3 sqlite3 module is compiled with R-tree support")
         sys.exit()
 
     print("Feature table made with %s entries" % (acount))
@@ -2019,33 +2098,26 @@ def overlapTrans(ent,conn,featureTable,aflag):
 
     # print("-Flag being queried:%s" % (aflag))
     # print("-Query entry:",ent)
-    
-    ## trans flanking phas or enclaved in phas
-    cur.execute("SELECT * FROM %s where chr = %s AND flag = '%s' AND ((end between %s and %s) or (start between %s and %s)) AND type = 'transcript'" % (featureTable,achr,aflag,astart,aend,astart,aend))
-    flankTrans = cur.fetchall()
-
-    ## PHAS enclaved in trans
-    cur.execute("SELECT * FROM %s where chr = %s AND flag = '%s' AND (%s between start and end) AND (%s between start and end) AND type = 'transcript'" % (featureTable,achr,aflag,astart,aend))
-    bigTrans = cur.fetchall()
 
+    cur.execute("SELECT id FROM %sChr WHERE chr = ?" % (featureTable),(str(achr),))
+    chrid = cur.fetchone()
+    if chrid is None:
+        ## No features on this chr
+        return transList
+    
+    ## trans flanking phas, enclaved in phas or PHAS enclaved in trans - Any trans that overlaps PHAS
+    ## CROSS JOIN keeps R-tree as the outer loop, else the planner scans all features of a flag
+    cur.execute("SELECT f.trans, f.strand, f.start, f.end FROM %sIdx r CROSS JOIN %s f ON f.rowid = r.id WHERE r.minChr <= ? AND r.maxChr >= ? AND r.minX <= ? AND r.maxX >= ? AND f.flag = ? ORDER BY r.id" % (featureTable,featureTable),(chrid[0],chrid[0],int(aend),int(astart),aflag))
+    allTrans = cur.fetchall()
 
-    # print("flanking Trans:",flankTrans)
-    # print("Long Trans:",bigTrans)
+    # print("Overlapping Trans:",allTrans)
 
-    ## Combine both lists and report overlapping trans
-    allTrans    = flankTrans + bigTrans
+    ## Report overlapping trans
     for i in allTrans:
         # print(i)
-        atrans  = i[1]
-        astrand = i[5] 
-        alen    = i[4]-i[3]
-        cur.execute("SELECT * FROM %s where flag = '%s' AND trans = '%s' AND type = 'transcript'" % (featureTable,aflag,atrans))
-        transinfo = cur.fetchall() 
-        # print(transinfo)
-
+        atrans,astrand,tstart,tend = i
+        alen    = tend-tstart
         toverlap = 0
-        tstart  = transinfo[0][3]
-        tend    = transinfo[0][4]
         
         ## Trans is enclaved
         if astart <= tstart and aend >= tend:
@@ -2087,7 +2159,7 @@ def overlapExons(ent,conn,featureTable,atrans,aflag):
     aname,apval,achr,astart,aend = ent
     
     cur = conn.cursor()
-    cur.execute("SELECT * FROM %s where flag = '%s' AND trans = '%s' AND type = 'exon'" % (featureTable,aflag,atrans))
+    cur.execute("SELECT start, end FROM %s where flag = ? AND trans = ? AND type = 'exon'" % (featureTable),(aflag,atrans))
     exons = cur.fetchall()
     # print("-These are the exons",exons)
 
@@ -2097,8 +2169,7 @@ def overlapExons(ent,conn,featureTable,atrans,aflag):
     for aexon in exons:
         # print("-Checking exons:",aexon)
         xoverlap    = 0
-        xstart      = aexon[3]
-        xend        = aexon[4]
+        xstart,xend = aexon
 
         ## Exon is enclaved
         if astart <= xstart and aend >= xend:
@@ -2204,6 +2275,52 @@ def summparse(adir):
 
     return summL,summD,summfile
 
+def summIntervals(summL):
+    '''
+    Returns PHAS from a summary as per-chromosome interval arrays, sorted on start
+    '''
+    chrD = {}
+    for index,aphas in enumerate(summL):
+        chrD.setdefault(aphas[1],[]).append((int(aphas[2]),int(aphas[3]),index))
+    for achr in chrD:
+        chrD[achr].sort()
+    return chrD
+
+def summSweep(aintervals,bintervals):
+    '''
+    Merge-join sweep over start-sorted intervals of a chromosome from both summaries, returns
+    index pairs of overlapping PHAS. Empty PHAS (start == end) are not reported
+    '''
+    pairs   = []
+    aactive = {} ## index:end of PHAS from summary-1 that are still open
+    bactive = {}
+    aheap   = [] ## (end,index) to close PHAS in order of end
+    bheap   = []
+    ai,bi   = 0,0
+    while ai < len(aintervals) or bi < len(bintervals):
+        ## Take next PHAS by start, summary-1 first on a tie
+        if bi == len(bintervals) or (ai < len(aintervals) and aintervals[ai][0] <= bintervals[bi][0]):
+            cstart,cend,cindex = aintervals[ai]
+            ai += 1
+            active,heap,oactive,oheap,isa = aactive,aheap,bactive,bheap,True
+        else:
+            cstart,cend,cindex = bintervals[bi]
+            bi += 1
+            active,heap,oactive,oheap,isa = bactive,bheap,aactive,aheap,False
+        if cend <= cstart:
+            continue
+
+        ## Close PHAS from other summary that end before this one starts, rest overlap it
+        while oheap and oheap[0][0] <= cstart:
+            del oactive[heapq.heappop(oheap)[1]]
+        for oindex in oactive:
+            pairs.append((cindex,oindex) if isa else (oindex,cindex))
+
+        active[cindex] = cend
+        heapq.heappush(heap,(cend,cindex))
+
+    return pairs
+
 def compare(summL1,summD1,summL2,summD2):
     '''
     Compares the PHAS loci between two sumamries
@@ -2217,60 +2334,68 @@ def compare(summL1,summD1,summL2,summD2):
     ccount      = 0 ## Count of unmatched from List1
     dcount      = 0 ## Count of unmatched from List2
     ecount      = 0 ## All the matches between List1 and List2 (redundant matches)
+
+    #### Find overlapping PHAS on same chr or transcript
+    achrD   = summIntervals(summL1)
+    bchrD   = summIntervals(summL2)
+    matchD  = {} ## Index of aphas: indexes of overlapping bphas
+    for achrid,aintervals in achrD.items():
+        bintervals = bchrD.get(achrid)
+        if not bintervals:
+            continue
+        for aindex,bindex in summSweep(aintervals,bintervals):
+            matchD.setdefault(aindex,[]).append(bindex)
+        
+        ## Empty PHAS have a match ratio of 1 with other empty PHAS, like for region lists compared before
+        aempty = [x[2] for x in aintervals if x[1] <= x[0]]
+        bempty = [x[2] for x in bintervals if x[1] <= x[0]]
+        for aindex in aempty:
+            matchD.setdefault(aindex,[]).extend(bempty)
+
     #### Find Matched PHAS
-    for aphas in summL1:
+    for aindex,aphas in enumerate(summL1):
         # print(aphas)
-        aname   = aphas[0]
-        achrid  = aphas[1]
         astart  = int(aphas[2])
         aend    = int(aphas[3])
-        aid     = aphas[5]
-        akey    = 'a-%s-%s-%s' % (achrid,str(astart),str(aend)) ## 'a' added to diffrentiate the key from PHAS in different file that have same coordinates.
-        aregion = list(range(astart,aend))
+        alen    = max(aend-astart,0)
         matflag = False     ## Tracks the match stats for this aphas
 
-        for bphas in summL2:
-            bname   = bphas[0]
-            bchrid  = bphas[1]
+        for bindex in sorted(matchD.get(aindex,[])): ## In order of summary-2
+            bphas   = summL2[bindex]
             bstart  = int(bphas[2])
             bend    = int(bphas[3])
+            blen    = max(bend-bstart,0)
             bid     = bphas[5]
-            bkey    = 'b-%s-%s-%s' % (bchrid,str(bstart),str(bend)) ## 'a' added to diffrentiate the key from PHAS in different file that have same coordinates.
-            bregion = list(range(bstart,bend))
-
-            if achrid == bchrid:
-                sm1         = difflib.SequenceMatcher(None,aregion,bregion) ## Mapping bphas over aphas
-                matchratio1 = round(sm1.ratio(),5)
-
-                if (matchratio1 >= 0.25):
-                    # print("aphas",aphas)
-                    # print("bphas",bphas)
-                    # print("Match Ratio:%s" % (matchratio1))
-                    matblocks   = sm1.get_matching_blocks() ### [(0,0,200),(),...] A list of all matches with tuple
-                                                            ### corresponding to one path cof match. In tuple first
-                                                            ### two elements are coordinates for seqeunce1 and sequence2 
-                                                            ### followed my length of match. Expect just one tuple as there
-                                                            ### is just one patch of match.
-                    # print(matblocks)
-                    amatcoord   = astart+int(matblocks[0][0])
-                    bmatcoord   = bstart+int(matblocks[0][1])
-                    matcoords   = "%s:%s" % (amatcoord,bmatcoord)
-                    # print("astart:%s | bstart:%s | amatcoord:%s | bmatcoord:%s" % (astart,bstart,amatcoord,bmatcoord))
-                    matlen      = int(matblocks[0][2])
-                    abphas  = aphas+bphas
-                    resList.append((abphas,matchratio1,matcoords,matlen))
-                    negSet.add(bid)
-                    
-                    matflag = True
-                    ecount  +=1
 
-                
+            ## Match ratio of aregion and bregion, these are contiguous so matched part is the overlap
+            matstart    = max(astart,bstart)
+            matlen      = max(min(aend,bend)-matstart,0)
+            if alen+blen:
+                matchratio1 = round(2.0*matlen/(alen+blen),5)
+            else:
+                matchratio1 = 1.0 ## Both empty
+
+            if (matchratio1 >= 0.25):
+                # print("aphas",aphas)
+                # print("bphas",bphas)
+                # print("Match Ratio:%s" % (matchratio1))
+                if matlen:
+                    amatcoord   = matstart
+                    bmatcoord   = matstart
                 else:
-                    ## Different PHAS loci on same chromsome and transcript
-                    pass
-            
+                    amatcoord   = astart
+                    bmatcoord   = bstart
+                matcoords   = "%s:%s" % (amatcoord,bmatcoord)
+                # print("astart:%s | bstart:%s | amatcoord:%s | bmatcoord:%s" % (astart,bstart,amatcoord,bmatcoord))
+                abphas  = aphas+bphas
+                resList.append((abphas,matchratio1,matcoords,matlen))
+                negSet.add(bid)
+                
+                matflag = True
+                ecount  +=1
+
             else:
-                ## Different chr or trascripts
+                ## Different PHAS loci on same chromsome and transcript
                 pass
 
         #### aphas unmatched?
@@ -2293,7 +2418,6 @@ def compare(summL1,summD1,summL2,summD2):
     ############################
     for bphas in summL2:
         bid     = bphas[5]
-        ccount  = 0
         if bid not in negSet:
             ## This bphas had no match with aphas
             abphas      = emptyfill+bphas
@@ -2523,21 +2647,15 @@ def main():
         ##################
         #### ANNOTATE ####
 
-        #### Parse GTF ###
+        #### Parse GTF or reuse annotation DB ###
         featureFile     = args.gtf
-        if annomode     == 1:   ## PASA GTF for overlapping transcripts
-            gtfList     = gtfParser(featureFile)
-        elif annomode   == 2 or annomode == 3 or annomode == 5 or annomode == 6: ## Trinity or Rocket GTF for overlapping transcipts
-            gtfList     = gtfParser2(featureFile)
-        elif annomode   == 4: ## Trinity and Rocket both for overlapping transcipts
-            gtfList1    = gtfParser2(featureFile)  ## Both lists can be identified with aflag feature
-            gtfList2    = gtfParser2(featureFile2) ## Both lists can be identified with aflag feature
-            gtfList     = gtfList1 + gtfList2
+        if annomode     == 4: ## Trinity and Rocket both for overlapping transcipts
+            featureFiles = [featureFile,featureFile2]
         else:
-            print("Please input correct mode in user settings - script will exit now")
-            sys.exit()
+            featureFiles = [featureFile]
         
-        resFile     = overlapChecker(resList,gtfList,pcutoff)
+        DB,featureTable = annoPrepare(featureFiles)
+        resFile         = overlapChecker(resList,DB,featureTable,pcutoff)
 
 
 
@@ -2723,6 +2841,13 @@ if __name__ == '__main__':
 ## Added dependency checks
 ## "Safe search" implemented, default cutoff are in developer settings area
 
+## v1.23 -> v1.24
+## GTF features are loaded in a single transaction, transcripts are looked up through an R-tree on chr and coords
+#### and exons through a covering index on flag, trans and type - A transcript overlapping PHAS at boundaries is reported once
+## Added "annoDB" setting - Annotation DB is named by hash of GTF content and annomode, and reused by later runs skipping GTF parsing
+## "compare" finds overlapping PHAS by a merge-join sweep over per-chromosome sorted intervals (summIntervals, summSweep), match ratio
+#### and coords are computed from overlap instead of difflib on ranges - Fixed unmatched count of summary1 being reset in the summary
+
 ## To revert in public release
 ## Revert overlapCutoff back to 0.25 - Done
 ## Merge ratio in self merge (originally 0.40) - Done